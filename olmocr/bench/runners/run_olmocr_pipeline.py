@@ -27,6 +27,15 @@ class Args:
     model_chat_template: str = "qwen2-vl"
     max_model_len: int = 16384
     guided_decoding: bool = False
+    stream_requests: bool = False
+    repeat_abort_chars: int = 1500
+    hedge_requests: bool = False
+    hedge_percentile: float = 95.0
+    hedge_max_fraction: float = 0.05
+    skip_blank_pages: bool = False
+    blank_max_ink_coverage: float = 0.0005
+    blank_max_stddev: float = 6.0
+    blank_max_text_chars: int = 0
     gpu_memory_utilization: float = 0.8
     target_longest_image_dim: int = 1288
     target_anchor_text_len: int = -1
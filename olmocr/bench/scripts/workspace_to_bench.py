@@ -10,10 +10,12 @@ import sys
 from collections import defaultdict
 from pathlib import Path
 
+from olmocr.s3_utils import RESULTS_FILE_EXTENSIONS, decode_output_lines
+
 
 def load_jsonl_files(input_dir):
     """Load all JSONL files from the input directory."""
-    jsonl_files = list(Path(input_dir).glob("*.jsonl"))
+    jsonl_files = [path for extension in RESULTS_FILE_EXTENSIONS for path in Path(input_dir).glob(f"*{extension}")]
     if not jsonl_files:
         print(f"No JSONL files found in {input_dir}")
         return []
@@ -30,8 +32,8 @@ def parse_jsonl_entries(jsonl_files):
     for jsonl_file in jsonl_files:
         print(f"Processing {jsonl_file.name}...")
 
-        with open(jsonl_file, "r", encoding="utf-8") as f:
-            for line_num, line in enumerate(f, 1):
+        with open(jsonl_file, "rb") as f:
+            for line_num, line in enumerate(decode_output_lines(str(jsonl_file), f.read()), 1):
                 line = line.strip()
                 if not line:
                     continue
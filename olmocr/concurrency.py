@@ -0,0 +1,400 @@
+import asyncio
+import logging
+import multiprocessing
+import random
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Awaitable, Callable, Deque, List, Optional, TypeVar
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class RequestSlot:
+    """Handed out by AdaptiveConcurrencyLimiter.request(), set `overloaded` if the server answered with a 429 or 5xx."""
+
+    def __init__(self):
+        self.overloaded = False
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD limiter for in-flight inference requests.
+
+    The limit grows by one for every `limit` successful requests, and is multiplied by `decrease_factor` (at most
+    once per `cooldown_secs`) whenever a request times out, fails to connect, gets a 429/5xx, when recent latency
+    rises above `latency_tolerance` times the long run latency, or when the server reports more than
+    `max_queue_depth` waiting requests. With min_limit == max_limit it behaves like a plain semaphore.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int,
+        min_limit: int = 1,
+        max_limit: Optional[int] = None,
+        decrease_factor: float = 0.9,
+        latency_tolerance: float = 2.0,
+        max_queue_depth: Optional[int] = None,
+        cooldown_secs: float = 5.0,
+    ):
+        self.max_limit = max_limit if max_limit is not None else initial_limit
+        self.min_limit = min(min_limit, self.max_limit)
+        self.limit = float(max(self.min_limit, min(initial_limit, self.max_limit)))
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.max_queue_depth = max_queue_depth
+        self.cooldown_secs = cooldown_secs
+
+        self.in_flight = 0
+        self.queue_depth: Optional[int] = None
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._last_decrease = 0.0
+
+        # Fast and slow moving averages of request latency, the fast one tracks the last ~10 requests
+        self.recent_latency: Optional[float] = None
+        self.baseline_latency: Optional[float] = None
+
+        self.stats = {"succeeded": 0, "overloaded": 0, "errors": 0, "increases": 0, "decreases": 0}
+
+    @property
+    def current_limit(self) -> int:
+        return max(self.min_limit, int(self.limit))
+
+    async def acquire(self) -> None:
+        if self.in_flight < self.current_limit and not self._waiters:
+            self.in_flight += 1
+            return
+
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # The slot was granted just as we got cancelled, hand it to the next waiter
+                self._release_slot()
+            else:
+                self._waiters.remove(fut)
+            raise
+
+    def release(self, latency: Optional[float] = None, overloaded: bool = False, error: bool = False) -> None:
+        """Returns a slot, and adjusts the limit based on how the request went."""
+        now = time.monotonic()
+
+        if error:
+            self.stats["errors"] += 1
+            self._decrease(now)
+        elif overloaded:
+            self.stats["overloaded"] += 1
+            self._decrease(now)
+        elif latency is not None:
+            self.stats["succeeded"] += 1
+            self._observe_latency(latency)
+
+            if self._latency_congested() or self._queue_congested():
+                self._decrease(now)
+            elif self.in_flight >= self.current_limit / 2:
+                # Only grow while the current limit is actually being used
+                previous = self.current_limit
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                if self.current_limit > previous:
+                    self.stats["increases"] += 1
+
+        self._release_slot()
+
+    def request(self):
+        """Async context manager wrapping acquire() and release(), timing the request and counting connection errors."""
+        return _LimitedRequest(self)
+
+    def observe_queue_depth(self, queue_depth: Optional[int]) -> None:
+        self.queue_depth = queue_depth
+
+    def _observe_latency(self, latency: float) -> None:
+        if self.recent_latency is None or self.baseline_latency is None:
+            self.recent_latency = self.baseline_latency = latency
+            return
+        self.recent_latency += 0.1 * (latency - self.recent_latency)
+        self.baseline_latency += 0.01 * (latency - self.baseline_latency)
+
+    def _latency_congested(self) -> bool:
+        if self.recent_latency is None or self.baseline_latency is None:
+            return False
+        return self.recent_latency > self.latency_tolerance * self.baseline_latency
+
+    def _queue_congested(self) -> bool:
+        return self.max_queue_depth is not None and self.queue_depth is not None and self.queue_depth > self.max_queue_depth
+
+    def _decrease(self, now: float) -> None:
+        if now - self._last_decrease < self.cooldown_secs:
+            return
+        previous = self.current_limit
+        self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+        self._last_decrease = now
+        if self.current_limit < previous:
+            self.stats["decreases"] += 1
+
+    def _release_slot(self) -> None:
+        self.in_flight -= 1
+        while self._waiters and self.in_flight < self.current_limit:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self.in_flight += 1
+                fut.set_result(None)
+
+    def __str__(self) -> str:
+        queue_depth = "unknown" if self.queue_depth is None else self.queue_depth
+        latency = "n/a" if self.recent_latency is None else f"{self.recent_latency:.2f}s (baseline {self.baseline_latency:.2f}s)"
+        return (
+            f"Concurrency limit: {self.current_limit} (range {self.min_limit}-{self.max_limit}), {self.in_flight} in flight, {len(self._waiters)} waiting, "
+            f"server queue {queue_depth}, latency {latency}, " + ", ".join(f"{k}={v:,}" for k, v in self.stats.items())
+        )
+
+
+class _LimitedRequest:
+    def __init__(self, limiter: AdaptiveConcurrencyLimiter):
+        self.limiter = limiter
+        self.slot = RequestSlot()
+        self.start = 0.0
+
+    async def __aenter__(self) -> RequestSlot:
+        await self.limiter.acquire()
+        self.start = time.monotonic()
+        return self.slot
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        if exc_type is not None and issubclass(exc_type, (ConnectionError, OSError, asyncio.TimeoutError)):
+            self.limiter.release(error=True)
+        elif exc_type is not None:
+            # Cancellations and bugs say nothing about the server
+            self.limiter.release()
+        else:
+            self.limiter.release(latency=time.monotonic() - self.start, overloaded=self.slot.overloaded)
+
+
+class BoundedProcessPool:
+    """
+    Process pool for CPU bound work that would otherwise block the event loop. At most max_pending jobs are handed to
+    the pool at once, further callers wait their turn in run(), so a burst of documents can't pile up unbounded work.
+    Processes are spawned rather than forked, since the parent has threads running. If a process dies, ex. killed for
+    running out of memory, the pool is restarted and the job that was running is retried once.
+    """
+
+    def __init__(self, max_workers: int, max_pending: Optional[int] = None, name: str = "CPU"):
+        self.max_workers = max_workers
+        self.name = name
+        self.max_pending = max_pending if max_pending is not None else 2 * max_workers
+        self._executor = self._make_executor()
+        self._slots = asyncio.Semaphore(self.max_pending)
+
+        self.pending = 0
+        self.running = 0
+        self.stats = {"jobs": 0, "failed": 0, "restarts": 0}
+        self.queue_wait_secs = 0.0
+        self.run_secs = 0.0
+
+    def _make_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    async def run(self, fn: Callable[..., T], *args) -> T:
+        """Runs fn(*args) in a worker process, fn and its arguments must be picklable."""
+        wait_start = time.monotonic()
+        self.pending += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.pending -= 1
+
+        run_start = time.monotonic()
+        self.queue_wait_secs += run_start - wait_start
+        self.running += 1
+        try:
+            return await self._run_in_executor(fn, *args)
+        except Exception:
+            self.stats["failed"] += 1
+            raise
+        finally:
+            self.running -= 1
+            self.run_secs += time.monotonic() - run_start
+            self.stats["jobs"] += 1
+            self._slots.release()
+
+    async def _run_in_executor(self, fn: Callable[..., T], *args) -> T:
+        loop = asyncio.get_running_loop()
+        executor = self._executor
+        try:
+            return await loop.run_in_executor(executor, fn, *args)
+        except BrokenProcessPool:
+            if executor is self._executor:
+                logger.warning(f"{self.name} process pool broke, a worker process died, restarting it")
+                self.stats["restarts"] += 1
+                self._executor = self._make_executor()
+                executor.shutdown(wait=False, cancel_futures=True)
+            return await loop.run_in_executor(self._executor, fn, *args)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def __str__(self) -> str:
+        done = self.stats["jobs"]
+        avg_wait = self.queue_wait_secs / done if done else 0.0
+        avg_run = self.run_secs / done if done else 0.0
+        return (
+            f"{self.name} pool: {self.max_workers} processes, {self.running} running, {self.pending} waiting, "
+            f"avg wait {avg_wait:.2f}s, avg run {avg_run:.2f}s, " + ", ".join(f"{k}={v:,}" for k, v in self.stats.items())
+        )
+
+
+class InferenceEndpoint:
+    """One OpenAI compatible server that requests can be routed to, ex. http://localhost:30024/v1"""
+
+    def __init__(self, url: str, weight: float = 1.0, api_key: Optional[str] = None):
+        if weight <= 0:
+            raise ValueError(f"Endpoint weight must be positive, got {weight} for {url}")
+        self.url = url.rstrip("/")
+        self.weight = weight
+        self.api_key = api_key
+
+        self.name = urlparse(self.url).netloc or self.url
+        self.outstanding = 0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.latency: Optional[float] = None
+        self.stats = {"requests": 0, "failures": 0, "ejections": 0}
+
+    def __repr__(self) -> str:
+        return f"InferenceEndpoint({self.url!r}, weight={self.weight})"
+
+
+def parse_server_endpoints(server: str, default_api_key: Optional[str] = None) -> List[InferenceEndpoint]:
+    """
+    Parses a --server value, a comma separated list of endpoint urls, each optionally followed by ;weight=N and ;api_key=KEY,
+    ex. "http://node1:30024/v1;weight=2,https://api.example.com/v1;api_key=secret". Endpoints without their own api_key use default_api_key.
+    """
+    endpoints = []
+    for entry in server.split(","):
+        url, *options = [part.strip() for part in entry.split(";")]
+        if not url:
+            continue
+
+        weight, api_key = 1.0, default_api_key
+        for option in options:
+            name, _, value = option.partition("=")
+            if name == "weight":
+                weight = float(value)
+            elif name == "api_key":
+                api_key = value
+            else:
+                raise ValueError(f"Unknown endpoint option {name!r} in {entry!r}, expected weight or api_key")
+        endpoints.append(InferenceEndpoint(url, weight, api_key))
+
+    if not endpoints:
+        raise ValueError(f"No endpoints in server {server!r}")
+    return endpoints
+
+
+class EndpointRouter:
+    """
+    Routes each request to the healthy endpoint with the fewest outstanding requests relative to its weight.
+
+    An endpoint is ejected after `failure_threshold` consecutive failures (connection errors, timeouts or 5xx responses),
+    unless it is the last healthy one, and is only routed to again once a health probe marks it as restored.
+    """
+
+    def __init__(self, endpoints: List[InferenceEndpoint], failure_threshold: int = 5):
+        self.endpoints = endpoints
+        self.failure_threshold = failure_threshold
+
+    @property
+    def healthy_endpoints(self) -> List[InferenceEndpoint]:
+        return [endpoint for endpoint in self.endpoints if endpoint.healthy]
+
+    def pick(self, exclude: Optional[InferenceEndpoint] = None) -> InferenceEndpoint:
+        """Picks the endpoint for a request, one other than exclude if there is another healthy one."""
+        candidates = self.healthy_endpoints
+        if not candidates:
+            raise ConnectionError("No healthy inference endpoints, waiting for health probes to restore one")
+        if exclude is not None and len(candidates) > 1:
+            candidates = [endpoint for endpoint in candidates if endpoint is not exclude]
+        best = min((endpoint.outstanding + 1) / endpoint.weight for endpoint in candidates)
+        return random.choice([endpoint for endpoint in candidates if (endpoint.outstanding + 1) / endpoint.weight == best])
+
+    def request(self, exclude: Optional[InferenceEndpoint] = None):
+        """Async context manager picking an endpoint and tracking the request on it, set `failed` on the yielded slot for 5xx responses."""
+        return _RoutedRequest(self, exclude)
+
+    def record_success(self, endpoint: InferenceEndpoint, latency: float) -> None:
+        endpoint.consecutive_failures = 0
+        endpoint.latency = latency if endpoint.latency is None else endpoint.latency + 0.1 * (latency - endpoint.latency)
+
+    def record_failure(self, endpoint: InferenceEndpoint) -> None:
+        endpoint.stats["failures"] += 1
+        endpoint.consecutive_failures += 1
+        if endpoint.healthy and endpoint.consecutive_failures >= self.failure_threshold and len(self.healthy_endpoints) > 1:
+            self.eject(endpoint)
+
+    def eject(self, endpoint: InferenceEndpoint) -> None:
+        if endpoint.healthy:
+            logger.warning(f"Ejecting inference endpoint {endpoint.url} after {endpoint.consecutive_failures} consecutive failures")
+            endpoint.healthy = False
+            endpoint.stats["ejections"] += 1
+
+    def restore(self, endpoint: InferenceEndpoint) -> None:
+        if not endpoint.healthy:
+            logger.info(f"Inference endpoint {endpoint.url} passed its health probe, routing requests to it again")
+            endpoint.healthy = True
+            endpoint.consecutive_failures = 0
+
+    async def run_health_probes(self, probe: Callable[[InferenceEndpoint], Awaitable[bool]], interval: float = 10.0) -> None:
+        """Probes the ejected endpoints every interval seconds, restoring the ones for which probe returns True."""
+        while True:
+            await asyncio.sleep(interval)
+            for endpoint in self.endpoints:
+                if not endpoint.healthy and await probe(endpoint):
+                    self.restore(endpoint)
+
+    def __str__(self) -> str:
+        lines = [f"{'Endpoint':<40} {'Weight':>6} {'Status':>8} {'Outstanding':>11} {'Requests':>10} {'Failures':>9} {'Latency':>9}"]
+        for endpoint in self.endpoints:
+            latency = "n/a" if endpoint.latency is None else f"{endpoint.latency:.2f}s"
+            status = "healthy" if endpoint.healthy else "ejected"
+            lines.append(
+                f"{endpoint.url:<40} {endpoint.weight:>6g} {status:>8} {endpoint.outstanding:>11} {endpoint.stats['requests']:>10,} {endpoint.stats['failures']:>9,} {latency:>9}"
+            )
+        return "\n".join(lines)
+
+
+class RoutedSlot:
+    """Handed out by EndpointRouter.request(), with the endpoint to send the request to."""
+
+    def __init__(self, endpoint: InferenceEndpoint):
+        self.endpoint = endpoint
+        self.failed = False
+
+
+class _RoutedRequest:
+    def __init__(self, router: EndpointRouter, exclude: Optional[InferenceEndpoint] = None):
+        self.router = router
+        self.exclude = exclude
+        self.slot: Optional[RoutedSlot] = None
+        self.start = 0.0
+
+    async def __aenter__(self) -> RoutedSlot:
+        self.slot = RoutedSlot(self.router.pick(self.exclude))
+        self.slot.endpoint.outstanding += 1
+        self.slot.endpoint.stats["requests"] += 1
+        self.start = time.monotonic()
+        return self.slot
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        endpoint = self.slot.endpoint
+        endpoint.outstanding -= 1
+        if exc_type is not None and issubclass(exc_type, (ConnectionError, OSError, asyncio.TimeoutError)):
+            self.router.record_failure(endpoint)
+        elif exc_type is None and self.slot.failed:
+            self.router.record_failure(endpoint)
+        elif exc_type is None:
+            self.router.record_success(endpoint, time.monotonic() - self.start)
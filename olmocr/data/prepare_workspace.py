@@ -22,7 +22,12 @@ import boto3
 from pypdf import PdfReader, PdfWriter
 from tqdm import tqdm
 
-from olmocr.s3_utils import parse_s3_path
+from olmocr.s3_utils import (
+    RESULTS_FILE_EXTENSIONS,
+    decode_output_lines,
+    get_s3_bytes,
+    parse_s3_path,
+)
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -53,7 +58,7 @@ def fetch_s3_file(s3_url: str, local_path: str) -> str:
 
 
 def list_s3_result_files(s3_client, workspace_path: str) -> List[str]:
-    """List all JSONL files in the S3 workspace results directory."""
+    """List all JSONL files in the S3 workspace results directory, including compressed ones."""
     bucket, prefix = parse_s3_path(workspace_path)
     results_prefix = os.path.join(prefix, "results").rstrip("/") + "/"
 
@@ -61,22 +66,20 @@ def list_s3_result_files(s3_client, workspace_path: str) -> List[str]:
     paginator = s3_client.get_paginator("list_objects_v2")
     for page in paginator.paginate(Bucket=bucket, Prefix=results_prefix):
         if "Contents" in page:
-            all_files.extend([f"s3://{bucket}/{obj['Key']}" for obj in page["Contents"] if obj["Key"].endswith(".jsonl")])
+            all_files.extend([f"s3://{bucket}/{obj['Key']}" for obj in page["Contents"] if obj["Key"].endswith(RESULTS_FILE_EXTENSIONS)])
 
     logger.info(f"Found {len(all_files)} JSONL files in S3 workspace")
     return all_files
 
 
-def download_s3_file(s3_client, s3_path: str) -> str:
-    """Download an S3 file and return its contents as a string."""
-    bucket, key = parse_s3_path(s3_path)
-    response = s3_client.get_object(Bucket=bucket, Key=key)
-    return response["Body"].read().decode("utf-8")
+def read_result_lines(s3_client, path: str) -> List[str]:
+    """Read a results file, local or on S3, and return its lines, decompressed if needed."""
+    return decode_output_lines(path, get_s3_bytes(s3_client, path))
 
 
 def load_jsonl_files(results_dir: Path) -> List[Path]:
-    """Load all JSONL files from the workspace results directory."""
-    jsonl_files = list(results_dir.glob("*.jsonl"))
+    """Load all JSONL files from the workspace results directory, including compressed ones."""
+    jsonl_files = [path for extension in RESULTS_FILE_EXTENSIONS for path in results_dir.glob(f"*{extension}")]
     if not jsonl_files:
         logger.error(f"No JSONL files found in {results_dir}")
         return []
@@ -326,8 +329,7 @@ def process_workspace(workspace_path: str, output_dir: Path, max_examples: Optio
         for s3_file in jsonl_files:
             logger.info(f"Reading {s3_file}...")
             try:
-                content = download_s3_file(s3_client, s3_file)
-                for line in content.splitlines():
+                for line in read_result_lines(s3_client, s3_file):
                     line = line.strip()
                     if not line:
                         continue
@@ -355,19 +357,18 @@ def process_workspace(workspace_path: str, output_dir: Path, max_examples: Optio
 
         for jsonl_file in jsonl_files:
             logger.info(f"Reading {jsonl_file.name}...")
-            with open(jsonl_file, "r", encoding="utf-8") as f:
-                for line in f:
-                    line = line.strip()
-                    if not line:
-                        continue
-
-                    try:
-                        entry = json.loads(line)
-                        parsed_entry = parse_jsonl_entry(entry)
-                        if parsed_entry:
-                            all_entries.append(parsed_entry)
-                    except json.JSONDecodeError as e:
-                        logger.error(f"JSON decode error: {e}")
+            for line in read_result_lines(s3_client, str(jsonl_file)):
+                line = line.strip()
+                if not line:
+                    continue
+
+                try:
+                    entry = json.loads(line)
+                    parsed_entry = parse_jsonl_entry(entry)
+                    if parsed_entry:
+                        all_entries.append(parsed_entry)
+                except json.JSONDecodeError as e:
+                    logger.error(f"JSON decode error: {e}")
 
     logger.info(f"Found {len(all_entries)} valid documents to process")
 
@@ -1,10 +1,25 @@
+import abc
 import base64
 import io
+import os
 import subprocess
-from typing import List
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Literal, Optional, Set, Tuple
 
+import pypdfium2 as pdfium
 from PIL import Image
 
+RenderEngine = Literal["pdfium", "pdftoppm"]
+
+# pdfium is not thread-safe, not even across different documents, so every call into it is serialized here. Concurrent
+# rendering with pdfium needs processes, see render_pdfium_page_png
+_pdfium_lock = threading.Lock()
+
+# Documents kept open by render_pdfium_page_png in a render process, by path, size and mtime
+_process_documents: "OrderedDict[Tuple[str, int, int], pdfium.PdfDocument]" = OrderedDict()
+MAX_PROCESS_OPEN_DOCUMENTS = 4
+
 
 def get_pdf_media_box_width_height(local_pdf_path: str, page_num: int) -> tuple[float, float]:
     """
@@ -36,9 +51,7 @@ def get_pdf_media_box_width_height(local_pdf_path: str, page_num: int) -> tuple[
     raise ValueError("MediaBox not found in the PDF info.")
 
 
-def render_pdf_to_base64png(local_pdf_path: str, page_num: int, target_longest_image_dim: int = 2048) -> str:
-    longest_dim = max(get_pdf_media_box_width_height(local_pdf_path, page_num))
-
+def _render_pdftoppm_png(local_pdf_path: str, page_num: int, longest_dim: float, target_longest_image_dim: int) -> bytes:
     # Convert PDF page to PNG using pdftoppm
     pdftoppm_result = subprocess.run(
         [
@@ -57,7 +70,163 @@ def render_pdf_to_base64png(local_pdf_path: str, page_num: int, target_longest_i
         stderr=subprocess.PIPE,
     )
     assert pdftoppm_result.returncode == 0, pdftoppm_result.stderr
-    return base64.b64encode(pdftoppm_result.stdout).decode("utf-8")
+    return pdftoppm_result.stdout
+
+
+def render_pdf_to_base64png(local_pdf_path: str, page_num: int, target_longest_image_dim: int = 2048) -> str:
+    longest_dim = max(get_pdf_media_box_width_height(local_pdf_path, page_num))
+    return base64.b64encode(_render_pdftoppm_png(local_pdf_path, page_num, longest_dim, target_longest_image_dim)).decode("utf-8")
+
+
+class PdfRenderer(abc.ABC):
+    """
+    Renders pages of a single PDF document to PNG bytes.
+
+    A renderer is meant to be opened once per document and reused for every page and every retry of that page,
+    so that any per-document setup (parsing, page box lookups) is only paid once.
+    """
+
+    engine: RenderEngine
+
+    def __init__(self, local_pdf_path: str):
+        self.local_pdf_path = local_pdf_path
+
+    @abc.abstractmethod
+    def render_page_to_png(self, page_num: int, target_longest_image_dim: int) -> bytes:
+        """Render a 1-indexed page so that its longest side is target_longest_image_dim pixels."""
+        pass
+
+    def close(self) -> None:
+        """Release any resources held for the document."""
+        pass
+
+
+class PdftoppmRenderer(PdfRenderer):
+    """Poppler based renderer, spawns one pdftoppm process per page, but only looks up each page's MediaBox once."""
+
+    engine: RenderEngine = "pdftoppm"
+
+    def __init__(self, local_pdf_path: str):
+        super().__init__(local_pdf_path)
+        self._longest_dims: Dict[int, float] = {}
+
+    def render_page_to_png(self, page_num: int, target_longest_image_dim: int) -> bytes:
+        if page_num not in self._longest_dims:
+            self._longest_dims[page_num] = max(get_pdf_media_box_width_height(self.local_pdf_path, page_num))
+
+        return _render_pdftoppm_png(self.local_pdf_path, page_num, self._longest_dims[page_num], target_longest_image_dim)
+
+
+class PdfiumRenderer(PdfRenderer):
+    """In-process renderer using pypdfium2, the document is parsed once when the renderer is opened and kept open until close()."""
+
+    engine: RenderEngine = "pdfium"
+
+    def __init__(self, local_pdf_path: str):
+        super().__init__(local_pdf_path)
+        with _pdfium_lock:
+            self._pdf = pdfium.PdfDocument(local_pdf_path)
+
+    def render_page_to_png(self, page_num: int, target_longest_image_dim: int) -> bytes:
+        with _pdfium_lock:
+            image = _render_pdfium_page(self._pdf, page_num, target_longest_image_dim)
+
+        # PNG encoding is the other half of the cost, and doesn't need pdfium, so it happens outside the lock
+        return _encode_png(image)
+
+    def close(self) -> None:
+        with _pdfium_lock:
+            self._pdf.close()
+
+
+def _render_pdfium_page(pdf: pdfium.PdfDocument, page_num: int, target_longest_image_dim: int) -> Image.Image:
+    assert page_num > 0, "Pages are 1-indexed in pdf-land"
+
+    page = pdf[page_num - 1]
+    try:
+        # Page size is in points (1/72 inch) and already accounts for the page's /Rotate
+        width, height = page.get_size()
+        bitmap = page.render(scale=target_longest_image_dim / max(width, height))
+        try:
+            # Copy out of pdfium's buffer so the bitmap can be freed right away
+            return bitmap.to_pil().copy()
+        finally:
+            bitmap.close()
+    finally:
+        page.close()
+
+
+def _encode_png(image: Image.Image) -> bytes:
+    buffered = io.BytesIO()
+    image.save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+def render_pdfium_page_png(local_pdf_path: str, page_num: int, target_longest_image_dim: int) -> bytes:
+    """
+    Renders a page with pdfium in a worker process of a render pool, where it can run in parallel with the other processes.
+    Each process keeps the last MAX_PROCESS_OPEN_DOCUMENTS documents it rendered open, so it only parses a document once.
+    Pool processes run one job at a time, and with nothing else calling into pdfium there is no need for the lock.
+    """
+    stat = os.stat(local_pdf_path)
+    key = (local_pdf_path, stat.st_size, stat.st_mtime_ns)
+    pdf = _process_documents.get(key)
+    if pdf is None:
+        pdf = _process_documents[key] = pdfium.PdfDocument(local_pdf_path)
+    _process_documents.move_to_end(key)
+    while len(_process_documents) > MAX_PROCESS_OPEN_DOCUMENTS:
+        _process_documents.popitem(last=False)[1].close()
+
+    return _encode_png(_render_pdfium_page(pdf, page_num, target_longest_image_dim))
+
+
+class RenderedPageCache:
+    """
+    Bounded LRU of rendered page PNGs for a single document, keyed by (page_num, target_longest_image_dim).
+
+    Most pages are rendered once and never asked for again, so a page is only admitted into the cache the second time
+    it gets rendered, ie. once it's known to be retrying. That keeps the slots for pages which will actually be reused.
+    """
+
+    def __init__(self, max_pages: int):
+        self.max_pages = max_pages
+        self._pages: OrderedDict[Tuple[int, int], bytes] = OrderedDict()
+        self._rendered_once: Set[Tuple[int, int]] = set()
+
+    def get(self, page_num: int, target_longest_image_dim: int) -> Optional[bytes]:
+        key = (page_num, target_longest_image_dim)
+        png = self._pages.get(key)
+        if png is not None:
+            self._pages.move_to_end(key)
+        return png
+
+    def put(self, page_num: int, target_longest_image_dim: int, png: bytes, admit: bool = False) -> None:
+        """Caches a render of a page the second time it's rendered, or right away with admit, for pages known to be rendered again."""
+        key = (page_num, target_longest_image_dim)
+        if not admit and key not in self._rendered_once:
+            self._rendered_once.add(key)
+            return
+
+        self._pages[key] = png
+        self._pages.move_to_end(key)
+        while len(self._pages) > self.max_pages:
+            self._pages.popitem(last=False)
+
+    def clear(self) -> None:
+        self._pages.clear()
+        self._rendered_once.clear()
+
+    def __len__(self) -> int:
+        return len(self._pages)
+
+
+def open_pdf_renderer(local_pdf_path: str, engine: RenderEngine = "pdfium") -> PdfRenderer:
+    if engine == "pdfium":
+        return PdfiumRenderer(local_pdf_path)
+    elif engine == "pdftoppm":
+        return PdftoppmRenderer(local_pdf_path)
+    else:
+        raise NotImplementedError(f"Unknown render engine {engine}")
 
 
 def render_pdf_to_base64webp(local_pdf_path: str, page: int, target_longest_image_dim: int = 1024):
@@ -1 +1,2 @@
+from .blank_page import BlankPageDetector
 from .filter import PdfFilter
@@ -0,0 +1,53 @@
+from io import BytesIO
+from typing import Tuple
+
+from PIL import Image, ImageStat
+
+
+class BlankPageDetector:
+    """
+    Flags pages which are confidently blank, so they don't need to go through the model at all.
+
+    A page is blank when a downscaled grayscale copy of its render has next to no ink and is almost flat, and its text layer is empty.
+    Ink is measured against the page's own background level rather than against white, so that off-white paper, grey scanner
+    backs and dark covers are all treated alike.
+    """
+
+    def __init__(
+        self,
+        max_ink_coverage: float = 0.0005,
+        max_stddev: float = 6.0,
+        max_text_chars: int = 0,
+        ink_delta: int = 32,
+        downscale_dim: int = 512,
+    ):
+        self.max_ink_coverage = max_ink_coverage
+        self.max_stddev = max_stddev
+        self.max_text_chars = max_text_chars
+        self.ink_delta = ink_delta
+        self.downscale_dim = downscale_dim
+
+    def image_stats(self, png_bytes: bytes) -> Tuple[float, float]:
+        """Returns the fraction of ink pixels, and the standard deviation of the grayscale levels of a rendered page."""
+        with Image.open(BytesIO(png_bytes)) as img:
+            img.thumbnail((self.downscale_dim, self.downscale_dim), Image.Resampling.BOX)
+            gray = img.convert("L")
+
+        histogram = gray.histogram()
+        num_pixels = sum(histogram)
+
+        # The background is the median level, as a blank page is mostly background by definition
+        background, seen = 0, 0
+        while seen + histogram[background] <= num_pixels // 2:
+            seen += histogram[background]
+            background += 1
+
+        ink_pixels = sum(histogram[: max(0, background - self.ink_delta)]) + sum(histogram[background + self.ink_delta + 1 :])
+        return ink_pixels / num_pixels, ImageStat.Stat(gray).stddev[0]
+
+    def is_blank_image(self, png_bytes: bytes) -> bool:
+        ink_coverage, stddev = self.image_stats(png_bytes)
+        return ink_coverage <= self.max_ink_coverage and stddev <= self.max_stddev
+
+    def is_blank_text(self, page_text: str) -> bool:
+        return sum(not c.isspace() for c in page_text) <= self.max_text_chars
@@ -2,11 +2,13 @@ import logging
 import re
 import subprocess
 from collections import Counter
-from typing import List
+from typing import List, Optional
 
 from lingua import Language, LanguageDetectorBuilder
 from pypdf import PdfReader
 
+from olmocr.prompts.anchor import PdfTextLayer
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
@@ -62,7 +64,8 @@ class PdfFilter:
         return (seo_score / total_words) > self.download_spam_threshold
 
     # Returns True if there is something wrong with this PDF
-    def filter_out_pdf(self, local_pdf_path: str) -> bool:
+    # Pass the document's text layer to reuse the text extracted for it, or to keep the text extracted here for later
+    def filter_out_pdf(self, local_pdf_path: str, text_layer: Optional[PdfTextLayer] = None) -> bool:
         try:
             # Attempt to read the PDF at the beginning
             pdf_reader = PdfReader(local_pdf_path)
@@ -76,18 +79,14 @@ class PdfFilter:
             return True  # Filter out the PDF if an exception occurs
 
         # Read the first five pages of text for language calculation
-        pdftotext_result = subprocess.run(
-            ["pdftotext", "-f", "1", "-l", "5", local_pdf_path, "-"],
-            timeout=60,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        if pdftotext_result.returncode != 0:
-            logger.warning(f"pdftotext returned {pdftotext_result.returncode} on {local_pdf_path}")
+        if text_layer is None:
+            text_layer = PdfTextLayer(local_pdf_path)
+        try:
+            base_text = "".join(text_layer.get_pages(1, 5, whole_document=False))
+        except subprocess.CalledProcessError as e:
+            logger.warning(f"pdftotext returned {e.returncode} on {local_pdf_path}")
             return True  # Filter out
 
-        base_text = pdftotext_result.stdout.decode("utf-8")
-
         alpha_count = sum(c.isalpha() for c in base_text)
 
         if len(base_text) < 200:
@@ -1,7 +1,8 @@
 import asyncio
+import math
 import time
 from collections import defaultdict, deque
-from typing import Any, Deque, Dict, List, Set
+from typing import Any, Deque, Dict, List, Optional, Set
 
 
 class MetricsKeeper:
@@ -17,6 +18,7 @@ class MetricsKeeper:
         self.total_metrics = defaultdict(int)  # Cumulative metrics since start
         self.window_metrics: Deque[Any] = deque()  # Deque to store (timestamp, metrics_dict)
         self.window_sum = defaultdict(int)  # Sum of metrics within the window
+        self.window_samples: Dict[str, Deque[Any]] = defaultdict(deque)  # (timestamp, value) of samples within the window, ex. latencies
 
     def add_metrics(self, **kwargs):
         """
@@ -45,6 +47,24 @@ class MetricsKeeper:
                 if self.window_sum[key] <= 0:
                     del self.window_sum[key]  # Clean up to prevent negative counts
 
+    def add_sample(self, key: str, value: float):
+        """Records one observation of a distribution, ex. a request latency, for percentile() over the window."""
+        current_time = time.time()
+        samples = self.window_samples[key]
+        samples.append((current_time, value))
+        while samples[0][0] < current_time - self.window:
+            samples.popleft()
+
+    def sample_count(self, key: str) -> int:
+        return len(self.window_samples.get(key, ()))
+
+    def percentile(self, key: str, q: float) -> Optional[float]:
+        """The q-th percentile (0-100) of the samples recorded for key within the window, or None if there are none."""
+        values = sorted(value for timestamp, value in self.window_samples.get(key, ()) if timestamp >= time.time() - self.window)
+        if not values:
+            return None
+        return values[min(len(values) - 1, max(0, math.ceil(q / 100 * len(values)) - 1))]
+
     def __str__(self):
         """
         Returns a formatted string of metrics showing tokens/sec since start and within the window.
@@ -175,26 +195,103 @@ class WorkerTracker:
         raise NotImplementedError("Use 'await get_status_table()' to get the status table.")
 
 
+class EventLoopMonitor:
+    """
+    Measures how late the event loop wakes up from a short sleep, which is how long any coroutine (HTTP requests,
+    the metrics reporter) may be kept waiting by blocking work, along with the share of wall-clock time spent on CPU.
+    """
+
+    def __init__(self, interval: float = 0.1, window: float = 60, stall_threshold: float = 0.1):
+        self.interval = interval
+        self.window = window
+        self.stall_threshold = stall_threshold
+
+        self.samples: Deque[tuple[float, float]] = deque()  # (timestamp, lag)
+        self.stalls = 0
+        self.max_lag = 0.0
+        self.cpu_load = 0.0
+
+    async def run(self) -> None:
+        """Samples forever, run as a background task."""
+        last_wall = time.perf_counter()
+        last_cpu = time.process_time()
+
+        while True:
+            await asyncio.sleep(self.interval)
+
+            wall_now = time.perf_counter()
+            cpu_now = time.process_time()
+            wall_delta = wall_now - last_wall
+            cpu_delta = cpu_now - last_cpu
+            last_wall, last_cpu = wall_now, cpu_now
+
+            # On a single core, 100 % means fully CPU-bound.
+            self.cpu_load = 100.0 * cpu_delta / wall_delta if wall_delta else 0.0
+            self.observe_lag(max(0.0, wall_delta - self.interval), now=wall_now)
+
+    def observe_lag(self, lag: float, now: float | None = None) -> None:
+        now = time.perf_counter() if now is None else now
+        self.samples.append((now, lag))
+        while self.samples and self.samples[0][0] < now - self.window:
+            self.samples.popleft()
+
+        self.max_lag = max(self.max_lag, lag)
+        if lag >= self.stall_threshold:
+            self.stalls += 1
+
+    def recent_lag(self) -> tuple[float, float]:
+        """Mean and max lag over the window, in seconds."""
+        if not self.samples:
+            return 0.0, 0.0
+        lags = [lag for _, lag in self.samples]
+        return sum(lags) / len(lags), max(lags)
+
+    def __str__(self) -> str:
+        mean_lag, max_lag = self.recent_lag()
+        return (
+            f"Event loop lag over {self.window:.0f}s: mean {mean_lag * 1000:.1f}ms, max {max_lag * 1000:.1f}ms, "
+            f"{self.stalls:,} stalls over {self.stall_threshold * 1000:.0f}ms in total (worst {self.max_lag:.2f}s), CPU load {self.cpu_load:.1f} %"
+        )
+
+
 async def cpu_vs_wall(interval: float = 1.0):
     """
     Periodically print the percentage of wall-clock time that was
     consumed as CPU time since the previous sample.
     """
-    last_wall = time.perf_counter()
-    last_cpu = time.process_time()
-
-    while True:
-        await asyncio.sleep(interval)
+    monitor = EventLoopMonitor(interval=interval)
+    monitor_task = asyncio.create_task(monitor.run())
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            print(f"CPU load (over {interval:.1f}s): {monitor.cpu_load:5.1f} %")
+    finally:
+        monitor_task.cancel()
 
-        # elapsed times
-        wall_now = time.perf_counter()
-        cpu_now = time.process_time()
 
-        wall_delta = wall_now - last_wall
-        cpu_delta = cpu_now - last_cpu
-
-        last_wall, last_cpu = wall_now, cpu_now
+def parse_prometheus_metrics(text: str) -> Dict[str, List[float]]:
+    """
+    Parses the Prometheus text exposition format, as served by vLLM's /metrics endpoint.
 
-        # On a single core, 100 % means fully CPU-bound.
-        pct = 100.0 * cpu_delta / wall_delta if wall_delta else 0.0
-        print(f"CPU load (over {interval:.1f}s): {pct:5.1f} %")
+    Returns:
+        dict: Metric name to the values of all of its samples, one per label set (ex. one per engine with data parallelism).
+    """
+    samples: Dict[str, List[float]] = defaultdict(list)
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+
+        if "{" in line.split(" ", 1)[0]:
+            name, _, rest = line.partition("{")
+            rest = rest[rest.rfind("}") + 1 :]
+        else:
+            name, _, rest = line.partition(" ")
+
+        try:
+            value = float(rest.split()[0])
+        except (IndexError, ValueError):
+            continue
+        samples[name].append(value)
+
+    return dict(samples)
@@ -0,0 +1,146 @@
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import threading
+from typing import Any, Dict, List, Optional
+
+import zstandard
+
+from olmocr.s3_utils import parse_s3_path
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINTS_DIR = "checkpoints"
+
+
+class PageJournal:
+    """
+    Append-only journal of the page results of one work item, so that a worker which claims the item after a crash or
+    preemption only runs the pages that aren't in it yet.
+
+    Records are json-serializable dicts by key. Each flush appends the records since the last one to a local file as a zstd frame
+    of JSONL, and copies that file to checkpoints/{work_hash}.jsonl.zstd in the workspace. Concatenated zstd frames decompress
+    as one stream, and a frame cut short by a crash only loses the records written in it.
+
+    Methods other than record() are blocking, the pipeline calls them from threads.
+    """
+
+    def __init__(self, workspace: str, work_hash: str, s3_client=None):
+        self.work_hash = work_hash
+        self.path = os.path.join(workspace, CHECKPOINTS_DIR, f"{work_hash}.jsonl.zstd")
+        self.s3_client = s3_client
+
+        # Local workspaces append to the checkpoint itself, S3 workspaces spool to a local file that gets uploaded
+        if self.path.startswith("s3://"):
+            fd, self.local_path = tempfile.mkstemp(prefix=f"journal_{work_hash}_", suffix=".jsonl.zstd")
+            os.close(fd)
+        else:
+            self.local_path = self.path
+
+        self.records: Dict[str, Dict[str, Any]] = {}
+        self._pending: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def _read_checkpoint(self) -> Optional[bytes]:
+        if self.path.startswith("s3://"):
+            bucket, key = parse_s3_path(self.path)
+            try:
+                return self.s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()
+            except self.s3_client.exceptions.NoSuchKey:
+                return None
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    @staticmethod
+    def _decode_records(data: bytes) -> Dict[str, Dict[str, Any]]:
+        text = bytearray()
+        reader = zstandard.ZstdDecompressor().stream_reader(data, read_across_frames=True)
+        try:
+            while chunk := reader.read(1 << 20):
+                text.extend(chunk)
+        except zstandard.ZstdError as e:
+            logger.warning(f"Page journal ends in a truncated frame, keeping the records before it: {e}")
+
+        records = {}
+        for line in text.decode("utf-8", errors="replace").splitlines():
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Only the last line of a truncated frame can be partial
+                break
+            records[entry["key"]] = entry["value"]
+        return records
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        """Loads the records of an existing checkpoint of this work item, and keeps them as the start of this journal."""
+        data = self._read_checkpoint()
+        if data is None:
+            return {}
+
+        self.records = self._decode_records(data)
+
+        # Start over from one clean frame, so that frames appended later don't follow a truncated one
+        os.makedirs(os.path.dirname(self.local_path) or ".", exist_ok=True)
+        temp_path = f"{self.local_path}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(self._encode_frame([{"key": key, "value": value} for key, value in self.records.items()]))
+        os.replace(temp_path, self.local_path)
+        return self.records
+
+    @staticmethod
+    def _encode_frame(entries: List[Dict[str, Any]]) -> bytes:
+        return zstandard.ZstdCompressor().compress("".join(json.dumps(entry) + "\n" for entry in entries).encode("utf-8"))
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return self.records.get(key)
+
+    def record(self, key: str, value: Dict[str, Any]) -> None:
+        """Adds a record, which is written out by the next flush()."""
+        with self._lock:
+            self._pending.append({"key": key, "value": value})
+            self.records[key] = value
+
+    def flush(self) -> int:
+        """Appends the records added since the last flush to the journal and checkpoints it, returns how many there were."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return 0
+
+            os.makedirs(os.path.dirname(self.local_path) or ".", exist_ok=True)
+            with open(self.local_path, "ab") as f:
+                f.write(self._encode_frame(pending))
+
+            if self.path.startswith("s3://"):
+                bucket, key = parse_s3_path(self.path)
+                self.s3_client.upload_file(self.local_path, bucket, key)
+            return len(pending)
+
+    async def run_flusher(self, interval_secs: float = 60) -> None:
+        """Flushes the journal every interval_secs. Run as a background task."""
+        while True:
+            await asyncio.sleep(interval_secs)
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception as e:
+                logger.warning(f"Failed to checkpoint page journal of {self.work_hash}: {e}")
+
+    def close(self) -> None:
+        """Flushes the journal and removes the local spool file of S3 journals, keeping the checkpoint for whoever claims the item next."""
+        self.flush()
+        if self.local_path != self.path and os.path.exists(self.local_path):
+            os.remove(self.local_path)
+
+    def delete(self) -> None:
+        """Deletes the checkpoint and the local journal, once the work item is done."""
+        if self.path.startswith("s3://"):
+            bucket, key = parse_s3_path(self.path)
+            self.s3_client.delete_object(Bucket=bucket, Key=key)
+        if os.path.exists(self.local_path):
+            os.remove(self.local_path)
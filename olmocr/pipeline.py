@@ -2,7 +2,11 @@ import argparse
 import asyncio
 import atexit
 import base64
+import contextlib
+import contextvars
 import datetime
+import glob
+import gzip
 import hashlib
 import json
 import logging
@@ -12,17 +16,22 @@ import random
 import re
 import shutil
 import ssl
+import subprocess
 import sys
 import tarfile
 import tempfile
+import threading
+import time
 from concurrent.futures import ThreadPoolExecutor
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass
 from functools import cache
 from io import BytesIO
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlunparse
 
 import boto3
 import httpx
+import zstandard
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from huggingface_hub import snapshot_download
 from PIL import Image
@@ -33,23 +42,56 @@ from olmocr.check import (
     check_poppler_version,
     check_torch_gpu_available,
 )
-from olmocr.data.renderpdf import render_pdf_to_base64png
+from olmocr.concurrency import (
+    AdaptiveConcurrencyLimiter,
+    BoundedProcessPool,
+    EndpointRouter,
+    InferenceEndpoint,
+    parse_server_endpoints,
+)
+from olmocr.data.renderpdf import (
+    PdfRenderer,
+    PdftoppmRenderer,
+    RenderedPageCache,
+    RenderEngine,
+    open_pdf_renderer,
+    render_pdfium_page_png,
+)
+from olmocr.filter.blank_page import BlankPageDetector
 from olmocr.filter.filter import Language, PdfFilter
 from olmocr.image_utils import convert_image_to_pdf_bytes, is_jpeg, is_png
-from olmocr.metrics import MetricsKeeper, WorkerTracker
+from olmocr.metrics import (
+    EventLoopMonitor,
+    MetricsKeeper,
+    WorkerTracker,
+    parse_prometheus_metrics,
+)
+from olmocr.page_journal import PageJournal
 from olmocr.prompts import PageResponse, build_no_anchoring_v4_yaml_prompt
-from olmocr.prompts.anchor import get_anchor_text
+from olmocr.prompts.anchor import PdfTextLayer
+from olmocr.repeatdetect import RepeatDetector
+from olmocr.result_cache import PageResultCache, open_page_result_cache
 from olmocr.s3_utils import (
+    S3RangeReader,
+    decode_output_lines,
     download_directory,
-    download_zstd_csv,
+    download_s3_file,
     expand_s3_glob,
     get_s3_bytes,
-    get_s3_bytes_with_backoff,
+    open_s3_stream,
     parse_s3_path,
+    put_s3_bytes,
 )
 from olmocr.train.front_matter import FrontMatterParser
 from olmocr.version import VERSION
-from olmocr.work_queue import LocalBackend, S3Backend, WorkQueue
+from olmocr.work_queue import (
+    WORKER_LOCK_TIMEOUT_SECS,
+    LocalBackend,
+    S3Backend,
+    WorkItem,
+    WorkQueue,
+    parse_page_range_path,
+)
 
 # Initialize logger
 logger = logging.getLogger(__name__)
@@ -81,15 +123,76 @@ tracker = WorkerTracker()
 # Global variable for vLLM queue status (updated by vllm_server_task)
 vllm_queued_requests = None
 
+# Latest gauges read from the inference server's prometheus /metrics endpoint, empty if it doesn't expose one
+vllm_server_stats: dict[str, float] = {}
+
 # Temperature values for retry attempts - higher temperature helps overcome repetition issues
 TEMPERATURE_BY_ATTEMPT = [0.1, 0.1, 0.2, 0.3, 0.5, 0.8, 0.9, 1.0]
 
 pdf_render_max_workers_limit = asyncio.BoundedSemaphore(int(float(os.environ.get("BEAKER_ASSIGNED_CPU_COUNT", max(1, multiprocessing.cpu_count() - 2)))))
-max_concurrent_requests_limit = asyncio.BoundedSemaphore(1)  # Actual value set by args in main()
+max_concurrent_requests_limit = AdaptiveConcurrencyLimiter(1)  # Actual value set by args in main()
+
+# Routes requests across the endpoints of --server, see get_endpoint_router()
+endpoint_router: EndpointRouter | None = None
+
+# Page renderers for the documents currently in flight, keyed by local pdf path, so each document is only opened once
+# no matter how many of its pages and retries are being rendered
+document_renderers: dict[str, PdfRenderer] = {}
+
+# Recently rendered pages of the documents in flight, also keyed by local pdf path, so retries and rotation corrections reuse the same render
+document_page_caches: dict[str, RenderedPageCache] = {}
+
+# pdftotext output of the documents in flight, also keyed by local pdf path, extracted once for the filter and all fallback pages
+document_text_layers: dict[str, PdfTextLayer] = {}
+
+# Byte-identical duplicates of queued documents, by canonical path, whose output is copied from the canonical document's, set in main()
+document_duplicates: dict[str, list[str]] = {}
 
 # Filter object, cached so it will only get loaded when/if you need it
 get_pdf_filter = cache(lambda: PdfFilter(languages_to_keep={Language.ENGLISH, None}, apply_download_spam_check=True, apply_form_check=True))
 
+# Process pool for the CPU bound steps of a document (page counting, filtering, pdftotext fallbacks), set by args in main()
+cpu_pool: BoundedProcessPool | None = None
+
+# Process pool that renders pages with pdfium, which serializes every call within a process, so that pages of all the documents
+# in flight render in parallel. Set by --render_workers in main(), without it pages render in threads of this process
+render_pool: BoundedProcessPool | None = None
+
+# Reports how long the event loop gets blocked for, started in main()
+event_loop_monitor = EventLoopMonitor()
+
+# Threads that encode and upload results and markdown files, sized by --upload_workers in main(). Without it, ex. when used as
+# a library, they run in the default executor
+output_pool: ThreadPoolExecutor | None = None
+
+# Page results shared across runs and workspaces, set in main() with --page_result_cache
+page_result_cache: PageResultCache | None = None
+
+# Page result journal of the work item being processed, set by worker() with --checkpoint_pages. Every task a worker creates
+# for an item inherits it, so it follows the item's pages through the TaskGroups and threads they run in
+current_page_journal: contextvars.ContextVar[PageJournal | None] = contextvars.ContextVar("current_page_journal", default=None)
+
+
+async def run_cpu_bound(fn, *args):
+    """Runs fn(*args) off the event loop, in the CPU process pool, or in a thread if the pool isn't started, ex. when used as a library."""
+    if cpu_pool is None:
+        return await asyncio.to_thread(fn, *args)
+    return await cpu_pool.run(fn, *args)
+
+
+def count_local_pdf_pages(local_pdf_path: str) -> int:
+    return PdfReader(local_pdf_path).get_num_pages()
+
+
+def pdf_is_filtered_out(local_pdf_path: str, text_layer: PdfTextLayer | None = None) -> bool:
+    return get_pdf_filter().filter_out_pdf(local_pdf_path, text_layer)
+
+
+def get_document_text_layer(local_pdf_path: str) -> PdfTextLayer:
+    """The text layer of a document in flight, or a new one for documents processed outside of process_single_pdf."""
+    text_layer = document_text_layers.get(local_pdf_path)
+    return text_layer if text_layer is not None else PdfTextLayer(local_pdf_path)
+
 
 @dataclass(frozen=True)
 class PageResult:
@@ -101,18 +204,100 @@ class PageResult:
     output_tokens: int
     is_fallback: bool
     is_valid: bool
+    is_blank: bool = False
+
+
+def open_document_renderer(local_pdf_path: str, engine: RenderEngine, max_cached_pages: int = 0) -> PdfRenderer:
+    """Open a renderer and page cache for a document and register them so every page of that document reuses them."""
+    try:
+        renderer = open_pdf_renderer(local_pdf_path, engine)
+    except Exception as e:
+        if engine == "pdftoppm":
+            raise
+        logger.warning(f"Could not open {local_pdf_path} with {engine}, falling back to pdftoppm: {type(e).__name__}: {e}")
+        renderer = PdftoppmRenderer(local_pdf_path)
+
+    document_renderers[local_pdf_path] = renderer
+    if max_cached_pages > 0:
+        document_page_caches[local_pdf_path] = RenderedPageCache(max_cached_pages)
+    return renderer
+
+
+def close_document_renderer(local_pdf_path: str) -> None:
+    page_cache = document_page_caches.pop(local_pdf_path, None)
+    if page_cache is not None:
+        page_cache.clear()
+
+    renderer = document_renderers.pop(local_pdf_path, None)
+    if renderer is not None:
+        renderer.close()
+
+
+def render_page_png(local_pdf_path: str, page: int, target_longest_image_dim: int) -> bytes:
+    """Render a page to PNG bytes using the document's open renderer, falling back to pdftoppm if the in-process engine fails."""
+    renderer = document_renderers.get(local_pdf_path)
+    owns_renderer = renderer is None
+
+    # Pages can be rendered outside of process_single_pdf (ex. when calling process_page directly), then just open the document for this one page
+    if renderer is None:
+        renderer = open_pdf_renderer(local_pdf_path, "pdfium")
+
+    try:
+        return renderer.render_page_to_png(page, target_longest_image_dim)
+    except Exception as e:
+        if renderer.engine == "pdftoppm":
+            raise
+        logger.warning(f"{renderer.engine} failed to render {local_pdf_path}-{page}, falling back to pdftoppm: {type(e).__name__}: {e}")
+        metrics.add_metrics(render_fallback_pages=1)
+        return PdftoppmRenderer(local_pdf_path).render_page_to_png(page, target_longest_image_dim)
+    finally:
+        if owns_renderer:
+            renderer.close()
+
+
+async def render_page_png_in_pool(pool: BoundedProcessPool, local_pdf_path: str, page: int, target_longest_image_dim: int) -> bytes:
+    """Render a page with pdfium in the given pool, falling back to pdftoppm if pdfium fails or crashes its process."""
+    try:
+        return await pool.run(render_pdfium_page_png, local_pdf_path, page, target_longest_image_dim)
+    except Exception as e:
+        logger.warning(f"pdfium failed to render {local_pdf_path}-{page}, falling back to pdftoppm: {type(e).__name__}: {e}")
+        metrics.add_metrics(render_fallback_pages=1)
+        return await asyncio.to_thread(PdftoppmRenderer(local_pdf_path).render_page_to_png, page, target_longest_image_dim)
+
+
+async def get_page_png(local_pdf_path: str, page: int, target_longest_image_dim: int) -> bytes:
+    # Retries and rotation corrections of a page start from the same unrotated render, so check the document's cache first
+    page_cache = document_page_caches.get(local_pdf_path)
+    image_bytes = page_cache.get(page, target_longest_image_dim) if page_cache is not None else None
+
+    if image_bytes is not None:
+        metrics.add_metrics(render_cache_hits=1)
+    else:
+        # Allow the page rendering to process in the background, but limit the number of workers otherwise you can overload the system
+        renderer = document_renderers.get(local_pdf_path)
+        pool = render_pool
+        async with pdf_render_max_workers_limit:
+            if pool is not None and (renderer is None or renderer.engine == "pdfium"):
+                image_bytes = await render_page_png_in_pool(pool, local_pdf_path, page, target_longest_image_dim)
+            else:
+                image_bytes = await asyncio.to_thread(render_page_png, local_pdf_path, page, target_longest_image_dim)
+
+        if page_cache is not None:
+            metrics.add_metrics(render_cache_misses=1)
+            page_cache.put(page, target_longest_image_dim, image_bytes)
+
+    return image_bytes
 
 
 async def build_page_query(local_pdf_path: str, page: int, target_longest_image_dim: int, image_rotation: int = 0, model_name: str = "olmocr") -> dict:
     MAX_TOKENS = 8000
     assert image_rotation in [0, 90, 180, 270], "Invalid image rotation provided in build_page_query"
 
-    # Allow the page rendering to process in the background, but limit the number of workers otherwise you can overload the system
-    async with pdf_render_max_workers_limit:
-        image_base64 = await asyncio.to_thread(render_pdf_to_base64png, local_pdf_path, page, target_longest_image_dim=target_longest_image_dim)
+    image_bytes = await get_page_png(local_pdf_path, page, target_longest_image_dim)
 
-    if image_rotation != 0:
-        image_bytes = base64.b64decode(image_base64)
+    if image_rotation == 0:
+        image_base64 = base64.b64encode(image_bytes).decode("utf-8")
+    else:
         with Image.open(BytesIO(image_bytes)) as img:
             if image_rotation == 90:
                 tranpose = Image.Transpose.ROTATE_90
@@ -146,6 +331,92 @@ async def build_page_query(local_pdf_path: str, page: int, target_longest_image_
     }
 
 
+class PageRequest:
+    """One request for a page to the inference server, routed to one of the endpoints of args.server."""
+
+    def __init__(self, args, query: dict):
+        self.args = args
+        self.query = query
+        self.completion = StreamedCompletion(args.repeat_abort_chars) if args.stream_requests else None
+        self.endpoint: InferenceEndpoint | None = None
+        self.status_code: int | None = None
+        self.response_body: bytes | None = None
+        # Set once the request holds a concurrency slot and an endpoint, time waiting for those isn't latency
+        self.in_flight = asyncio.Event()
+
+    @property
+    def succeeded(self) -> bool:
+        return self.status_code == 200 and not (self.completion is not None and self.completion.repeat_detected)
+
+    async def send(self, exclude: InferenceEndpoint | None = None) -> "PageRequest":
+        """Sends the request, to an endpoint other than exclude if there is another healthy one."""
+        async with max_concurrent_requests_limit.request() as slot, get_endpoint_router(self.args).request(exclude) as routed:
+            self.endpoint = routed.endpoint
+            self.in_flight.set()
+            start_time = time.perf_counter()
+            completion_url = f"{self.endpoint.url}/chat/completions"
+            if self.completion is not None:
+                self.status_code, self.response_body = await apost(
+                    completion_url, json_data=self.query, api_key=self.endpoint.api_key, on_chunk=self.completion.feed
+                )
+            else:
+                self.status_code, self.response_body = await apost(completion_url, json_data=self.query, api_key=self.endpoint.api_key)
+            latency = time.perf_counter() - start_time
+            slot.overloaded = self.status_code == 429 or self.status_code >= 500
+            routed.failed = self.status_code >= 500
+
+        metrics.add_metrics(page_requests=1)
+        if self.succeeded:
+            metrics.add_sample("page_request_secs", latency)
+        return self
+
+
+async def send_hedged_page_request(args, query: dict) -> PageRequest:
+    """
+    Sends a page request, and if it has been in flight for longer than the hedge_percentile latency of recent page requests,
+    sends a duplicate of it to another endpoint when there is one. Whichever succeeds first is used and the other is cancelled.
+    Requests still waiting for a concurrency slot are never hedged, and hedges are capped at hedge_max_fraction of all page requests.
+    """
+    MIN_LATENCY_SAMPLES = 20
+
+    primary = PageRequest(args, query)
+    primary_task = asyncio.create_task(primary.send())
+    in_flight_task = asyncio.create_task(primary.in_flight.wait())
+    tasks = {primary_task}
+    try:
+        if metrics.sample_count("page_request_secs") < MIN_LATENCY_SAMPLES:
+            return await primary_task
+
+        # The hedge timer starts once the primary request is actually sent
+        done, _ = await asyncio.wait({primary_task, in_flight_task}, return_when=asyncio.FIRST_COMPLETED)
+        if primary_task in done:
+            return await primary_task
+
+        done, _ = await asyncio.wait(tasks, timeout=metrics.percentile("page_request_secs", args.hedge_percentile))
+        within_budget = metrics.total_metrics["hedged_requests"] < args.hedge_max_fraction * metrics.total_metrics["page_requests"]
+        if done or not within_budget:
+            return await primary_task
+
+        metrics.add_metrics(hedged_requests=1)
+        hedge = PageRequest(args, query)
+        tasks.add(asyncio.create_task(hedge.send(exclude=primary.endpoint)))
+
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and task.result().succeeded:
+                    metrics.add_metrics(**{"hedge_wins" if task.result() is hedge else "hedge_losses": 1})
+                    return task.result()
+
+        # Neither succeeded, so the primary request's outcome is handled as if it was never hedged
+        return primary_task.result()
+    finally:
+        in_flight_task.cancel()
+        for task in tasks:
+            task.cancel()
+
+
 async def try_single_page(
     args,
     pdf_orig_path: str,
@@ -158,14 +429,11 @@ async def try_single_page(
     Try processing a single page once. Returns PageResult on success, None on failure.
     Does NOT handle retries - caller is responsible for retry logic.
     """
-    COMPLETION_URL = f"{args.server.rstrip('/')}/chat/completions"
     MODEL_MAX_CONTEXT = 16384
 
     temp_idx = min(attempt, len(TEMPERATURE_BY_ATTEMPT) - 1)
     temperature = TEMPERATURE_BY_ATTEMPT[temp_idx]
 
-    api_key = args.api_key if args.server and hasattr(args, "api_key") else None
-
     try:
         query = await build_page_query(
             pdf_local_path,
@@ -181,8 +449,12 @@ async def try_single_page(
                 r"---\nprimary_language: (?:[a-z]{2}|null)\nis_rotation_valid: (?:True|False|true|false)\nrotation_correction: (?:0|90|180|270)\nis_table: (?:True|False|true|false)\nis_diagram: (?:True|False|true|false)\n(?:---|---\n[\s\S]+)"
             )
 
-        async with max_concurrent_requests_limit:
-            status_code, response_body = await apost(COMPLETION_URL, json_data=query, api_key=api_key)
+        if args.stream_requests:
+            query["stream"] = True
+            query["stream_options"] = {"include_usage": True}
+
+        request = await (send_hedged_page_request(args, query) if args.hedge_requests else PageRequest(args, query).send())
+        status_code, response_body, completion, endpoint = request.status_code, request.response_body, request.completion, request.endpoint
 
         if status_code != 200:
             logger.warning(
@@ -190,12 +462,25 @@ async def try_single_page(
             )
             return None
 
-        base_response_data = json.loads(response_body)
+        if completion is not None and completion.repeat_detected:
+            # Closing the connection makes the server abort the request, instead of generating up to max_tokens
+            metrics.add_metrics(
+                server_output_tokens=completion.streamed_tokens,
+                repeat_aborted_requests=1,
+                repeat_aborted_output_tokens=completion.streamed_tokens,
+                repeat_saved_output_tokens=max(0, query["max_tokens"] - completion.streamed_tokens),
+            )
+            logger.info(f"Aborted {pdf_orig_path}-{page_num} attempt {attempt} after {completion.streamed_tokens} tokens, output fell into a repetition loop")
+            return None
+
+        base_response_data = completion.response_data() if completion is not None else json.loads(response_body)
 
         metrics.add_metrics(
             server_input_tokens=base_response_data["usage"].get("prompt_tokens", 0),
             server_output_tokens=base_response_data["usage"].get("completion_tokens", 0),
         )
+        if len(get_endpoint_router(args).endpoints) > 1:
+            metrics.add_metrics(**{f"server_output_tokens@{endpoint.name}": base_response_data["usage"].get("completion_tokens", 0)})
 
         is_valid = True
 
@@ -230,13 +515,14 @@ async def try_single_page(
         return None
 
 
-def make_fallback_result(pdf_orig_path: str, pdf_local_path: str, page_num: int) -> PageResult:
+async def make_fallback_result(pdf_orig_path: str, pdf_local_path: str, page_num: int) -> PageResult:
     """Create a fallback PageResult using pdftotext."""
+    natural_text = await asyncio.to_thread(get_document_text_layer(pdf_local_path).get_page, page_num)
     return PageResult(
         pdf_orig_path,
         page_num,
         PageResponse(
-            natural_text=get_anchor_text(pdf_local_path, page_num, pdf_engine="pdftotext"),
+            natural_text=natural_text,
             primary_language=None,
             is_rotation_valid=True,
             rotation_correction=0,
@@ -250,6 +536,43 @@ def make_fallback_result(pdf_orig_path: str, pdf_local_path: str, page_num: int)
     )
 
 
+def is_blank_page(args, pdf_local_path: str, page_num: int, image_bytes: bytes) -> bool:
+    """Checks the render first, as it's cheap, and the text layer only for pages that look blank."""
+    detector = BlankPageDetector(
+        max_ink_coverage=args.blank_max_ink_coverage,
+        max_stddev=args.blank_max_stddev,
+        max_text_chars=args.blank_max_text_chars,
+    )
+    if not detector.is_blank_image(image_bytes):
+        return False
+
+    try:
+        return detector.is_blank_text(get_document_text_layer(pdf_local_path).get_page(page_num))
+    except subprocess.CalledProcessError:
+        return False  # Without a text layer to confirm it, the page isn't confidently blank
+
+
+def make_blank_result(pdf_orig_path: str, page_num: int) -> PageResult:
+    """An empty PageResult for a page that is confidently blank, so it never has to go through the server."""
+    return PageResult(
+        pdf_orig_path,
+        page_num,
+        PageResponse(
+            natural_text="",
+            primary_language=None,
+            is_rotation_valid=True,
+            rotation_correction=0,
+            is_table=False,
+            is_diagram=False,
+        ),
+        input_tokens=0,
+        output_tokens=0,
+        is_fallback=False,
+        is_valid=True,
+        is_blank=True,
+    )
+
+
 async def try_single_page_with_backoff(
     args,
     pdf_orig_path: str,
@@ -278,7 +601,73 @@ async def try_single_page_with_backoff(
     sys.exit(1)
 
 
+async def get_cached_page_result(cache: PageResultCache, cache_key: str, pdf_orig_path: str, page_num: int) -> PageResult | None:
+    try:
+        cached = await asyncio.to_thread(cache.get, cache_key)
+    except Exception as e:
+        logger.warning(f"Could not read page result cache for {pdf_orig_path}-{page_num}: {type(e).__name__}: {e}")
+        return None
+
+    if cached is None:
+        return None
+    return PageResult(pdf_orig_path, page_num, PageResponse(**cached["response"]), input_tokens=0, output_tokens=0, is_fallback=False, is_valid=True)
+
+
+async def put_cached_page_result(cache: PageResultCache, cache_key: str, page_result: PageResult) -> None:
+    try:
+        await asyncio.to_thread(cache.put, cache_key, {"response": asdict(page_result.response)})
+    except Exception as e:
+        logger.warning(f"Could not write page result cache for {page_result.s3_path}-{page_result.page_num}: {type(e).__name__}: {e}")
+
+
 async def process_page(args, worker_id: int, pdf_orig_path: str, pdf_local_path: str, page_num: int) -> PageResult:
+    """
+    Process a single page, unless it's blank (with --skip_blank_pages) or its result is in the page result cache.
+    Checking either works off the same render that the first attempt then sends.
+    """
+    await tracker.track_work(worker_id, f"{pdf_orig_path}-{page_num}", "started")
+
+    journal = current_page_journal.get()
+    if journal is not None and (recorded := journal.get(f"{pdf_orig_path}-{page_num}")) is not None:
+        metrics.add_metrics(checkpoint_pages_replayed=1)
+        await tracker.track_work(worker_id, f"{pdf_orig_path}-{page_num}", "replayed")
+        return PageResult(**{**recorded, "response": PageResponse(**recorded["response"])})
+
+    cache = page_result_cache
+    cache_key = None
+    if args.skip_blank_pages or cache is not None:
+        image_bytes = await get_page_png(pdf_local_path, page_num, args.target_longest_image_dim)
+
+        if args.skip_blank_pages and await asyncio.to_thread(is_blank_page, args, pdf_local_path, page_num, image_bytes):
+            metrics.add_metrics(blank_pages_skipped=1)
+            await tracker.track_work(worker_id, f"{pdf_orig_path}-{page_num}", "blank")
+            return make_blank_result(pdf_orig_path, page_num)
+
+        if cache is not None:
+            cache_key = cache.key(image_bytes, build_no_anchoring_v4_yaml_prompt(), args.target_longest_image_dim)
+            result = await get_cached_page_result(cache, cache_key, pdf_orig_path, page_num)
+            if result is not None:
+                metrics.add_metrics(page_result_cache_hits=1)
+                await tracker.track_work(worker_id, f"{pdf_orig_path}-{page_num}", "cached")
+                return result
+            metrics.add_metrics(page_result_cache_misses=1)
+
+        # The first attempt renders this page again right away, keep it so that it's a cache hit
+        page_cache = document_page_caches.get(pdf_local_path)
+        if page_cache is not None:
+            page_cache.put(page_num, args.target_longest_image_dim, image_bytes, admit=True)
+
+    result = await process_page_with_retries(args, worker_id, pdf_orig_path, pdf_local_path, page_num)
+    if journal is not None:
+        journal.record(f"{pdf_orig_path}-{page_num}", asdict(result))
+
+    # Fallback results are pdftotext output, not a model response for this render, so they aren't cached
+    if cache is not None and cache_key is not None and not result.is_fallback:
+        await put_cached_page_result(cache, cache_key, result)
+    return result
+
+
+async def process_page_with_retries(args, worker_id: int, pdf_orig_path: str, pdf_local_path: str, page_num: int) -> PageResult:
     """
     Process a single page with retry logic:
     1. Try first attempt
@@ -290,8 +679,6 @@ async def process_page(args, worker_id: int, pdf_orig_path: str, pdf_local_path:
     retry_attempts = list(range(1, MAX_RETRIES))
     cumulative_rotation = 0
 
-    await tracker.track_work(worker_id, f"{pdf_orig_path}-{page_num}", "started")
-
     # === First attempt ===
     result = await try_single_page_with_backoff(args, pdf_orig_path, pdf_local_path, page_num, attempt=0, rotation=cumulative_rotation)
 
@@ -329,7 +716,7 @@ async def process_page(args, worker_id: int, pdf_orig_path: str, pdf_local_path:
         logger.error(f"Failed {pdf_orig_path}-{page_num} after {MAX_RETRIES} rotation retries")
         metrics.add_metrics(failed_pages=1)
         await tracker.track_work(worker_id, f"{pdf_orig_path}-{page_num}", "errored")
-        return make_fallback_result(pdf_orig_path, pdf_local_path, page_num)
+        return await make_fallback_result(pdf_orig_path, pdf_local_path, page_num)
 
     # === Non-rotation error path: sequential, but switch to parallel if queue empties ===
     for i, attempt in enumerate(retry_attempts):
@@ -349,17 +736,22 @@ async def process_page(args, worker_id: int, pdf_orig_path: str, pdf_local_path:
                 for a in remaining_attempts
             ]
 
-            for coro in asyncio.as_completed(tasks):
-                try:
-                    result = await coro
-                    if result is not None and result.is_valid and result.response.is_rotation_valid:
-                        for t in tasks:
-                            t.cancel()
-                        metrics.add_metrics(**{"completed_pages": 1, "finished_on_parallel_retry": 1})
-                        await tracker.track_work(worker_id, f"{pdf_orig_path}-{page_num}", "finished")
-                        return result
-                except asyncio.CancelledError:
-                    continue
+            try:
+                for coro in asyncio.as_completed(tasks):
+                    try:
+                        result = await coro
+                        if result is not None and result.is_valid and result.response.is_rotation_valid:
+                            metrics.add_metrics(**{"completed_pages": 1, "finished_on_parallel_retry": 1})
+                            await tracker.track_work(worker_id, f"{pdf_orig_path}-{page_num}", "finished")
+                            return result
+                    except asyncio.CancelledError:
+                        if asyncio.current_task().cancelling():
+                            raise
+                        continue
+            finally:
+                # Also reached when the page itself is cancelled, e.g. its document ran out of fallback budget
+                for t in tasks:
+                    t.cancel()
             break  # Parallel attempts exhausted
 
     # If you tried many times and a least had a valid response, then return that in the end
@@ -372,14 +764,212 @@ async def process_page(args, worker_id: int, pdf_orig_path: str, pdf_local_path:
     logger.error(f"Failed {pdf_orig_path}-{page_num} after {MAX_RETRIES} attempts")
     metrics.add_metrics(failed_pages=1)
     await tracker.track_work(worker_id, f"{pdf_orig_path}-{page_num}", "errored")
-    return make_fallback_result(pdf_orig_path, pdf_local_path, page_num)
+    return await make_fallback_result(pdf_orig_path, pdf_local_path, page_num)
+
+
+@dataclass
+class PooledConnection:
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    key: tuple[str, int, bool]
+    requests_served: int = 0
+    last_used: float = 0.0
+
+
+class HttpConnectionPool:
+    """
+    Keep-alive connections for apost, one stack of idle connections per (host, port, ssl).
+
+    This is deliberately simple: there are no locks, all bookkeeping happens synchronously on the event loop
+    in between awaits. A connection is either checked out by exactly one request, or sitting idle in the pool.
+    It only goes back to the pool once its response was read completely, anything unexpected just closes it.
+
+    The number of in-flight connections is already bounded by max_concurrent_requests_limit, so the pool only
+    caps how many idle connections it holds on to per host, the rest get closed when they are released.
+    """
+
+    def __init__(self, max_idle_per_host: int = 256, max_requests_per_connection: int = 1000, idle_timeout_secs: float = 4.0):
+        self.max_idle_per_host = max_idle_per_host
+        self.max_requests_per_connection = max_requests_per_connection
+        # Should stay below the server's keep-alive timeout, vLLM's uvicorn closes idle connections after 5 seconds
+        self.idle_timeout_secs = idle_timeout_secs
+        self._idle: dict[tuple[str, int, bool], list[PooledConnection]] = {}
+        self._ssl_context: ssl.SSLContext | None = None
+        self.stats: dict[str, int] = {"opened": 0, "reused": 0, "closed_stale": 0, "closed_recycled": 0, "closed_overflow": 0, "stale_retries": 0}
+
+    def _is_usable(self, conn: PooledConnection) -> bool:
+        if conn.writer.is_closing() or conn.reader.at_eof():
+            return False
+        return time.monotonic() - conn.last_used < self.idle_timeout_secs
+
+    async def acquire(self, host: str, port: int, use_ssl: bool) -> PooledConnection:
+        key = (host, port, use_ssl)
+        idle = self._idle.get(key)
+
+        # Most recently used first, so rarely needed connections age out
+        while idle:
+            conn = idle.pop()
+            if self._is_usable(conn):
+                self.stats["reused"] += 1
+                return conn
+            self.stats["closed_stale"] += 1
+            conn.writer.close()
+
+        if use_ssl:
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            reader, writer = await asyncio.open_connection(host, port, ssl=self._ssl_context)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+
+        self.stats["opened"] += 1
+        return PooledConnection(reader, writer, key)
+
+    def release(self, conn: PooledConnection, reusable: bool) -> None:
+        conn.requests_served += 1
+        conn.last_used = time.monotonic()
+
+        if reusable and conn.requests_served >= self.max_requests_per_connection:
+            self.stats["closed_recycled"] += 1
+            reusable = False
+
+        idle = self._idle.setdefault(conn.key, [])
+        if reusable and len(idle) >= self.max_idle_per_host:
+            self.stats["closed_overflow"] += 1
+            reusable = False
+
+        if reusable and not conn.writer.is_closing():
+            idle.append(conn)
+        else:
+            try:
+                conn.writer.close()
+            except Exception:
+                pass
+
+    @property
+    def idle_connections(self) -> int:
+        return sum(len(idle) for idle in self._idle.values())
+
+    def close_all(self) -> None:
+        for idle in self._idle.values():
+            for conn in idle:
+                conn.writer.close()
+        self._idle.clear()
+
+    def __str__(self) -> str:
+        return f"HTTP connection pool: {self.idle_connections} idle, " + ", ".join(f"{k}={v:,}" for k, v in self.stats.items())
+
+
+http_pool = HttpConnectionPool()
+
+# Strings at least this long (ie. base64 image data urls) are written to the socket on their own instead of going through json.dumps
+STREAMED_JSON_STRING_MIN_LEN = 64 * 1024
+_JSON_ESCAPED_CHARS = re.compile(r'["\\\x00-\x1f\x7f-\U0010ffff]')
+
+
+def json_body_parts(json_data) -> list[memoryview]:
+    """
+    Serializes json_data into a list of byte chunks which concatenate to the same bytes as json.dumps(json_data).encode().
+
+    Long strings that need no escaping are encoded exactly once and passed through as their own chunk, so a page's
+    image payload is never copied into an intermediate json string, a header+body string, and then a bytes object.
+    """
+    large_strings = []
+    marker = f"__olmocr_streamed_{os.urandom(8).hex()}_"
+
+    def replace_large_strings(value):
+        if isinstance(value, str):
+            if len(value) >= STREAMED_JSON_STRING_MIN_LEN and not _JSON_ESCAPED_CHARS.search(value):
+                large_strings.append(value)
+                return f"{marker}{len(large_strings) - 1}_"
+            return value
+        if isinstance(value, dict):
+            return {k: replace_large_strings(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [replace_large_strings(v) for v in value]
+        return value
+
+    skeleton = json.dumps(replace_large_strings(json_data))
+
+    parts = []
+    for index, large_string in enumerate(large_strings):
+        before, _, skeleton = skeleton.partition(f"{marker}{index}_")
+        parts.append(memoryview(before.encode()))
+        parts.append(memoryview(large_string.encode("ascii")))
+    parts.append(memoryview(skeleton.encode()))
+    return parts
+
+
+class StreamedCompletion:
+    """
+    Accumulates a server-sent event stream of chat completion chunks into the shape of a regular completion response,
+    feeding the generated text to a RepeatDetector every check_every_chars characters so repetition loops are caught early.
+    """
+
+    def __init__(self, repeat_abort_chars: int, max_ngram_size: int = 128, check_every_chars: int = 256):
+        self.repeat_abort_chars = repeat_abort_chars
+        self.check_every_chars = check_every_chars
+        self.repeat_detector = RepeatDetector(max_ngram_size=max_ngram_size)
+
+        self.content_parts: list[str] = []
+        self.finish_reason = None
+        self.usage = None
+        self.streamed_tokens = 0
+        self.repeat_detected = False
+
+        self._partial_line = b""
+        self._unchecked: list[str] = []
+        self._unchecked_chars = 0
+
+    def feed(self, data: bytes) -> bool:
+        """Feeds raw bytes of the stream, returns False once a repetition loop is detected and the request should be abandoned."""
+        *lines, self._partial_line = (self._partial_line + data).split(b"\n")
+        for line in lines:
+            line = line.strip()
+            if not line.startswith(b"data:"):
+                continue
+            payload = line[len(b"data:") :].strip()
+            if payload == b"[DONE]":
+                continue
+
+            chunk = json.loads(payload)
+            if chunk.get("usage"):
+                self.usage = chunk["usage"]
+            for choice in chunk.get("choices") or []:
+                content = (choice.get("delta") or {}).get("content")
+                if content:
+                    # Each chunk carries the text of one decoding step, which is normally a single token
+                    self.streamed_tokens += 1
+                    self.content_parts.append(content)
+                    self._unchecked.append(content)
+                    self._unchecked_chars += len(content)
+                if choice.get("finish_reason"):
+                    self.finish_reason = choice["finish_reason"]
+
+        if self._unchecked_chars >= self.check_every_chars:
+            self.repeat_detector.add_letters("".join(self._unchecked))
+            self._unchecked, self._unchecked_chars = [], 0
+            if self.repeat_detector.repeated_span() >= self.repeat_abort_chars:
+                self.repeat_detected = True
+                return False
+
+        return True
+
+    def response_data(self) -> dict:
+        """The accumulated completion, with usage estimated from the streamed chunks if the server didn't report it."""
+        usage = self.usage or {"prompt_tokens": 0, "completion_tokens": self.streamed_tokens, "total_tokens": self.streamed_tokens}
+        return {"choices": [{"message": {"content": "".join(self.content_parts)}, "finish_reason": self.finish_reason}], "usage": usage}
 
 
 # Manual simple implementation of HTTP Post
 # It feels strange perhaps, but httpx and aiohttp are very complex beasts
 # Ex. the sessionpool in httpcore has 4 different locks in it, and I've noticed
 # that at the scale of 100M+ requests, that they deadlock in different strange ways
-async def apost(url, json_data, api_key=None):
+async def apost(url, json_data, api_key=None, on_chunk=None):
+    """
+    POSTs json_data and returns the status code and response body. With on_chunk, every chunk of a chunked response is
+    passed to it as it arrives, and if it returns False the rest of the response is abandoned by closing the connection.
+    """
     parsed_url = urlparse(url)
     host = parsed_url.hostname
     # Default to 443 for HTTPS, 80 for HTTP
@@ -391,89 +981,99 @@ async def apost(url, json_data, api_key=None):
         use_ssl = False
     path = parsed_url.path or "/"
 
-    writer = None
-    try:
-        if use_ssl:
-            ssl_context = ssl.create_default_context()
-            reader, writer = await asyncio.open_connection(host, port, ssl=ssl_context)
-        else:
-            reader, writer = await asyncio.open_connection(host, port)
-
-        json_payload = json.dumps(json_data)
-
-        headers = [
-            f"POST {path} HTTP/1.1",
-            f"Host: {host}",
-            f"Content-Type: application/json",
-            f"Content-Length: {len(json_payload)}",
-        ]
+    body_parts = json_body_parts(json_data)
 
-        if api_key:
-            headers.append(f"Authorization: Bearer {api_key}")
-
-        headers.append("Connection: close")
+    headers = [
+        f"POST {path} HTTP/1.1",
+        f"Host: {host}",
+        f"Content-Type: application/json",
+        f"Content-Length: {sum(part.nbytes for part in body_parts)}",
+    ]
 
-        request = "\r\n".join(headers) + "\r\n\r\n" + json_payload
-        writer.write(request.encode())
-        await writer.drain()
+    if api_key:
+        headers.append(f"Authorization: Bearer {api_key}")
 
-        status_line = await reader.readline()
-        if not status_line:
-            raise ConnectionError("No response from server")
-        status_parts = status_line.decode().strip().split(" ", 2)
-        if len(status_parts) < 2:
-            raise ValueError(f"Malformed status line: {status_line.decode().strip()}")
-        status_code = int(status_parts[1])
+    request_head = ("\r\n".join(headers) + "\r\n\r\n").encode()
 
-        # Read headers
-        headers = {}
-        while True:
-            line = await reader.readline()
-            if line in (b"\r\n", b"\n", b""):
-                break
-            key, _, value = line.decode().partition(":")
-            headers[key.strip().lower()] = value.strip()
-
-        # Read response body
-        if "content-length" in headers:
-            body_length = int(headers["content-length"])
-            response_body = await reader.readexactly(body_length)
-        elif headers.get("transfer-encoding", "") == "chunked":
-            chunks = []
+    # At most one retry, for when a kept-alive connection turns out to have been closed by the server while it was idle
+    for attempt in range(2):
+        conn = await http_pool.acquire(host, port, use_ssl)
+        reader, writer = conn.reader, conn.writer
+        reusable = False
+        got_status_line = False
+        try:
+            writer.write(request_head)
+            for part in body_parts:
+                writer.write(part)
+            await writer.drain()
+
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionError("No response from server")
+            got_status_line = True
+            status_parts = status_line.decode().strip().split(" ", 2)
+            if len(status_parts) < 2:
+                raise ValueError(f"Malformed status line: {status_line.decode().strip()}")
+            status_code = int(status_parts[1])
+
+            # Read headers
+            response_headers = {}
             while True:
-                # Read chunk size line
-                size_line = await reader.readline()
-                chunk_size = int(size_line.strip(), 16)  # Hex format
-
-                if chunk_size == 0:
-                    await reader.readline()  # Read final CRLF
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
                     break
+                key, _, value = line.decode().partition(":")
+                response_headers[key.strip().lower()] = value.strip()
+
+            # Read response body
+            if "content-length" in response_headers:
+                body_length = int(response_headers["content-length"])
+                response_body = await reader.readexactly(body_length)
+                reusable = True
+            elif response_headers.get("transfer-encoding", "") == "chunked":
+                chunks = []
+                abandoned = False
+                while True:
+                    # Read chunk size line
+                    size_line = await reader.readline()
+                    chunk_size = int(size_line.strip(), 16)  # Hex format
+
+                    if chunk_size == 0:
+                        await reader.readline()  # Read final CRLF
+                        break
+
+                    chunk_data = await reader.readexactly(chunk_size)
+                    chunks.append(chunk_data)
+
+                    # Read trailing CRLF after chunk data
+                    await reader.readline()
+
+                    if on_chunk is not None and not on_chunk(chunk_data):
+                        abandoned = True
+                        break
+
+                response_body = b"".join(chunks)
+                reusable = not abandoned
+            elif response_headers.get("connection", "") == "close":
+                # Read until connection closes
+                response_body = await reader.read()
+            else:
+                raise ConnectionError("Cannot determine response body length")
 
-                chunk_data = await reader.readexactly(chunk_size)
-                chunks.append(chunk_data)
-
-                # Read trailing CRLF after chunk data
-                await reader.readline()
+            if response_headers.get("connection", "").lower() == "close":
+                reusable = False
 
-            response_body = b"".join(chunks)
-        elif headers.get("connection", "") == "close":
-            # Read until connection closes
-            response_body = await reader.read()
-        else:
-            raise ConnectionError("Cannot determine response body length")
+            return status_code, response_body
+        except (ConnectionError, OSError):
+            if attempt == 0 and conn.requests_served > 0 and not got_status_line:
+                http_pool.stats["stale_retries"] += 1
+                continue
+            raise
+        finally:
+            # Connections whose response wasn't read cleanly to the end (errors, cancellations) are closed, never pooled
+            http_pool.release(conn, reusable)
 
-        return status_code, response_body
-    except Exception as e:
-        # Pass through errors
-        raise e
-    finally:
-        # But just make sure to close the socket on your way out
-        if writer is not None:
-            try:
-                writer.close()
-                await writer.wait_closed()
-            except:
-                pass
+    raise ConnectionError("Could not send request on a fresh connection")
 
 
 def is_tarball_path(path: str) -> bool:
@@ -483,39 +1083,172 @@ def is_tarball_path(path: str) -> bool:
 
 
 async def process_tarball(args, worker_id: int, tarball_path: str) -> list:
-    """Process all PDFs inside a tarball concurrently and return list of Dolma documents."""
-    logger.info(f"Worker {worker_id} processing tarball {tarball_path}")
+    """
+    Process all PDFs inside a tarball concurrently and return list of Dolma documents.
 
-    tarball_bytes = await asyncio.to_thread(lambda: get_s3_bytes_with_backoff(pdf_s3, tarball_path))
+    The tarball is streamed, and each PDF is spilled to a temp directory and starts processing as soon as it's extracted.
+    Extraction waits while tarball_max_pending_pdfs of them are extracted and not finished yet, which bounds the disk they take up.
+    """
+    logger.info(f"Worker {worker_id} processing tarball {tarball_path}")
 
-    # Extract all PDFs to a temp directory
+    loop = asyncio.get_running_loop()
+    extracted: asyncio.Queue[tuple[str, str] | None] = asyncio.Queue()
+    pending_slots = threading.BoundedSemaphore(args.tarball_max_pending_pdfs)
+    stop_extracting = threading.Event()
     temp_dir = tempfile.mkdtemp()
+
+    def extract_pdfs() -> None:
+        try:
+            with contextlib.closing(open_s3_stream(pdf_s3, tarball_path)) as stream, tarfile.open(fileobj=stream, mode="r|gz") as tar:
+                for index, member in enumerate(tar):
+                    if not (member.isfile() and member.name.lower().endswith(".pdf")):
+                        continue
+                    while not pending_slots.acquire(timeout=1):
+                        if stop_extracting.is_set():
+                            return
+                    if stop_extracting.is_set():
+                        return
+
+                    src = tar.extractfile(member)
+                    if src is None:
+                        pending_slots.release()
+                        continue
+
+                    # Members are only readable until the stream moves past them, so each one is spilled before moving on
+                    local_path = os.path.join(temp_dir, f"{index}_{os.path.basename(member.name)}")
+                    with src, open(local_path, "wb") as dst:
+                        shutil.copyfileobj(src, dst)
+                    loop.call_soon_threadsafe(extracted.put_nowait, (f"{tarball_path}::{member.name}", local_path))
+        finally:
+            loop.call_soon_threadsafe(extracted.put_nowait, None)
+
+    async def process_extracted_pdf(source_path: str, local_path: str) -> dict | None:
+        try:
+            return await process_single_pdf(args, worker_id, source_path, local_path)
+        finally:
+            os.remove(local_path)
+            pending_slots.release()
+
+    # Cancelling a thread doesn't stop it, so the extraction is only ever shielded, and always waited for before temp_dir goes away
+    extraction = loop.run_in_executor(None, extract_pdfs)
+
+    async def wait_for_extraction() -> None:
+        await asyncio.shield(extraction)
+
     try:
-        pdf_files = []  # (source_path, local_path)
-        with tarfile.open(fileobj=BytesIO(tarball_bytes), mode="r:gz") as tar:
-            for member in tar.getmembers():
-                if member.isfile() and member.name.lower().endswith(".pdf"):
-                    local_path = os.path.join(temp_dir, os.path.basename(member.name))
-                    with open(local_path, "wb") as f:
-                        extracted = tar.extractfile(member)
-                        if extracted:
-                            f.write(extracted.read())
-                            pdf_files.append((f"{tarball_path}::{member.name}", local_path))
-
-        logger.info(f"Worker {worker_id} extracted {len(pdf_files)} PDFs from {tarball_path}")
-
-        # Process all PDFs concurrently
         async with asyncio.TaskGroup() as tg:
-            tasks = [tg.create_task(process_single_pdf(args, worker_id, src, local)) for src, local in pdf_files]
+            tg.create_task(wait_for_extraction())
+            tasks = []
+            try:
+                while (item := await extracted.get()) is not None:
+                    tasks.append(tg.create_task(process_extracted_pdf(*item)))
+            except BaseException:
+                stop_extracting.set()
+                raise
 
+        logger.info(f"Worker {worker_id} extracted {len(tasks)} PDFs from {tarball_path}")
         dolma_docs = [t.result() for t in tasks if t.result() is not None]
         logger.info(f"Worker {worker_id} processed {len(dolma_docs)} PDFs from tarball {tarball_path}")
         return dolma_docs
     finally:
+        stop_extracting.set()
+        # The thread stops within a second of stop_extracting, and the loop keeps running for the items it posts until then
+        await asyncio.wait([extraction])
         shutil.rmtree(temp_dir, ignore_errors=True)
 
 
-async def process_single_pdf(args, worker_id: int, pdf_orig_path: str, local_pdf_path: str):
+class FallbackBudgetExceeded(Exception):
+    """Raised inside a document's page task group once more of its pages fell back than max_page_error_rate allows."""
+
+
+async def process_pages(
+    args, worker_id: int, pdf_orig_path: str, local_pdf_path: str, page_nums: range, num_pages: int | None = None
+) -> list[PageResult] | None:
+    """Runs all of the given pages of a document concurrently, with the document opened once for rendering.
+
+    Fallback pages are counted as they finish, against the error budget of the whole document (num_pages, for page range shards).
+    Once the document can no longer meet it, the pages still running are cancelled along with their retries, and None is returned.
+    """
+    num_pages = num_pages or len(page_nums)
+    page_tasks = []
+    num_fallback_pages = 0
+    budget_exceeded = False
+    start_time = time.perf_counter()
+
+    async def run_page(page_num: int) -> PageResult:
+        nonlocal num_fallback_pages
+        page_result = await process_page(args, worker_id, pdf_orig_path, local_pdf_path, page_num)
+        if page_result.is_fallback:
+            num_fallback_pages += 1
+            if num_fallback_pages / num_pages > args.max_page_error_rate:
+                raise FallbackBudgetExceeded(f"{num_fallback_pages} fallback pages out of {num_pages}")
+        return page_result
+
+    # Open the document once for rendering, it's kept open for all of its pages and retries
+    await asyncio.to_thread(open_document_renderer, local_pdf_path, args.render_engine, args.render_cache_pages)
+    try:
+        async with asyncio.TaskGroup() as tg:
+            for page_num in page_nums:
+                task = tg.create_task(run_page(page_num))
+                page_tasks.append(task)
+    except* FallbackBudgetExceeded:
+        budget_exceeded = True
+    finally:
+        await asyncio.to_thread(close_document_renderer, local_pdf_path)
+
+    if budget_exceeded:
+        record_fallback_abort(pdf_orig_path, num_pages, page_tasks, time.perf_counter() - start_time)
+        for task, page_num in zip(page_tasks, page_nums):
+            if task.cancelled():
+                await tracker.track_work(worker_id, f"{pdf_orig_path}-{page_num}", "cancelled")
+        return None
+
+    # Collect the results from the entire task group, assuming no exceptions, if there is an exception propagated to this point in any page, it will abort the PDF itself
+    page_results = [task.result() for task in page_tasks]
+    assert all(page_result.is_valid for page_result in page_results)
+    return page_results
+
+
+def record_fallback_abort(pdf_orig_path: str, num_pages: int, page_tasks: list[asyncio.Task], elapsed: float):
+    """Records a document abandoned for exceeding its fallback budget, with estimates of the server tokens and worker time that saved."""
+    num_cancelled = sum(task.cancelled() for task in page_tasks)
+    num_finished = len(page_tasks) - num_cancelled
+
+    # Tokens are estimated from the average page so far across the run, time from how quickly this document's own pages were finishing
+    totals = metrics.total_metrics
+    tokens_per_page = (totals["server_input_tokens"] + totals["server_output_tokens"]) / max(1, totals["completed_pages"] + totals["failed_pages"])
+    saved_tokens = round(num_cancelled * tokens_per_page)
+    saved_secs = num_cancelled * elapsed / max(1, num_finished)
+
+    logger.error(
+        f"Document {pdf_orig_path} exceeded max_page_error_rate with {num_cancelled} of its {num_pages} pages still running, "
+        f"discarding document early, saving ~{saved_tokens} tokens and ~{saved_secs:.1f}s"
+    )
+    metrics.add_metrics(
+        fallback_aborted_documents=1,
+        fallback_aborted_pages=num_cancelled,
+        fallback_abort_saved_tokens_est=saved_tokens,
+        fallback_abort_saved_secs_est=saved_secs,
+    )
+
+
+def build_checked_dolma_document(args, pdf_orig_path: str, page_results: list[PageResult]):
+    """Builds the Dolma document, unless too many of its pages had to fall back to pdftotext."""
+    num_pages = len(page_results)
+    num_fallback_pages = sum(page_result.is_fallback for page_result in page_results)
+
+    if num_fallback_pages / num_pages > args.max_page_error_rate:
+        logger.error(
+            f"Document {pdf_orig_path} has {num_fallback_pages} fallback pages out of {num_pages} exceeding max_page_error_rate of {args.max_page_error_rate}, discarding document."
+        )
+        return None
+    elif num_fallback_pages > 0:
+        logger.warning(f"Document {pdf_orig_path} processed with {num_fallback_pages} fallback pages out of {num_pages}, proceeding to build Dolma document.")
+
+    return build_dolma_document(pdf_orig_path, page_results)
+
+
+async def process_single_pdf(args, worker_id: int, pdf_orig_path: str, local_pdf_path: str, page_range: tuple[int, int | None] | None = None):
     """Process a single PDF that's already on disk.
 
     Args:
@@ -523,80 +1256,159 @@ async def process_single_pdf(args, worker_id: int, pdf_orig_path: str, local_pdf
         worker_id: Worker ID for logging
         pdf_orig_path: Original path (for metadata, can be tarball::internal format)
         local_pdf_path: Local path to the PDF file
+        page_range: Only process these pages (first, last inclusive, or None for the end), as one shard of a document split across work items
 
     Returns:
-        Dolma document or None
+        Dolma document or None, for a page range the merged Dolma document once every shard of the document is done
     """
+    document_text_layers[local_pdf_path] = PdfTextLayer(local_pdf_path)
     try:
         try:
-            reader = PdfReader(local_pdf_path)
-            num_pages = reader.get_num_pages()
+            num_pages = await run_cpu_bound(count_local_pdf_pages, local_pdf_path)
         except:
             logger.exception(f"Could not count number of pages for {pdf_orig_path}, aborting document")
             return None
 
         logger.debug(f"Got {num_pages} pages to do for {pdf_orig_path} in worker {worker_id}")
 
-        if args.apply_filter and get_pdf_filter().filter_out_pdf(local_pdf_path):
-            logger.info(f"Filtering out pdf {pdf_orig_path}")
-            return None
+        if args.apply_filter:
+            # The filter runs in another process, so extract the pages it reads here, where fallback pages can reuse them
+            text_layer = document_text_layers[local_pdf_path]
+            try:
+                await asyncio.to_thread(text_layer.get_pages, 1, 5, False)
+            except subprocess.CalledProcessError:
+                pass  # The filter tries again, logs the error and filters the document out
 
-        # List to hold the tasks for processing each page
-        page_tasks = []
-        page_results = []
+            if await run_cpu_bound(pdf_is_filtered_out, local_pdf_path, text_layer):
+                logger.info(f"Filtering out pdf {pdf_orig_path}")
+                return None
 
-        async with asyncio.TaskGroup() as tg:
-            for page_num in range(1, num_pages + 1):
-                task = tg.create_task(process_page(args, worker_id, pdf_orig_path, local_pdf_path, page_num))
-                page_tasks.append(task)
+        if page_range is None:
+            page_results = await process_pages(args, worker_id, pdf_orig_path, local_pdf_path, range(1, num_pages + 1))
+            return None if page_results is None else build_checked_dolma_document(args, pdf_orig_path, page_results)
 
-        # Collect the results from the entire task group, assuming no exceptions, if there is an exception propagated to this point in any page, it will abort the PDF itself
-        page_results = [task.result() for task in page_tasks]
-        assert all(page_result.is_valid for page_result in page_results)
+        first_page, last_page = page_range[0], num_pages if page_range[1] is None else min(page_range[1], num_pages)
+        # None when this shard alone exceeded the document's budget, it's then saved as failed so the merge can report it
+        page_results = await process_pages(args, worker_id, pdf_orig_path, local_pdf_path, range(first_page, last_page + 1), num_pages)
+    except Exception as e:
+        logger.exception(f"Exception in process_single_pdf for {pdf_orig_path}: {e}")
+        if page_range is not None:
+            # A shard that's never saved would keep its document from ever merging, so its work item fails to be retried
+            raise
+        return None
+    finally:
+        document_text_layers.pop(local_pdf_path, None)
 
-        num_fallback_pages = sum(page_result.is_fallback for page_result in page_results)
+    # Failing to save a shard fails its work item, so that it's retried rather than leaving the document incomplete for good.
+    # The error rate is only checked once the shards are merged, against the whole document
+    merged_doc = await asyncio.to_thread(save_page_shard_and_merge, args, pdf_orig_path, num_pages, page_range, page_results)
+    if merged_doc is not None:
+        await write_dolma_docs(args, f"merged_{hashlib.sha1(pdf_orig_path.encode()).hexdigest()}", [merged_doc])
+        await asyncio.to_thread(delete_page_shards, args.workspace, pdf_orig_path)
+    return None
 
-        if num_fallback_pages / num_pages > args.max_page_error_rate:
-            logger.error(
-                f"Document {pdf_orig_path} has {num_fallback_pages} fallback pages out of {num_pages} exceeding max_page_error_rate of {args.max_page_error_rate}, discarding document."
-            )
-            return None
-        elif num_fallback_pages > 0:
-            logger.warning(
-                f"Document {pdf_orig_path} processed with {num_fallback_pages} fallback pages out of {num_pages}, proceeding to build Dolma document."
-            )
 
-        return build_dolma_document(pdf_orig_path, page_results)
-    except Exception as e:
-        logger.exception(f"Exception in process_single_pdf for {pdf_orig_path}: {e}")
+def get_page_shards_dir(workspace: str, pdf_orig_path: str) -> str:
+    return os.path.join(workspace, "page_shards", hashlib.sha1(pdf_orig_path.encode()).hexdigest())
+
+
+def delete_page_shards(workspace: str, pdf_orig_path: str) -> None:
+    """Deletes the saved page range shards of a document, once it's merged or discarded."""
+    shards_dir = get_page_shards_dir(workspace, pdf_orig_path)
+    if shards_dir.startswith("s3://"):
+        for path in expand_s3_glob(workspace_s3, os.path.join(shards_dir, "*.json")):
+            bucket, key = parse_s3_path(path)
+            workspace_s3.delete_object(Bucket=bucket, Key=key)
+    else:
+        shutil.rmtree(shards_dir, ignore_errors=True)
+
+
+def save_page_shard_and_merge(
+    args, pdf_orig_path: str, num_pages: int, page_range: tuple[int, int | None], page_results: list[PageResult] | None
+) -> dict | None:
+    """
+    Saves the page results of one page range shard to the workspace, and if the shards saved so far cover the whole document,
+    merges them into its Dolma document and returns it. A shard without page_results exceeded the document's error budget on
+    its own, it's saved as failed, and once every shard is in the document is discarded.
+
+    Every shard lists the others after writing its own, so at least one of them sees the complete set. Should two shards
+    finishing at once both merge, they build the same document, which is why it is written to a path derived from the
+    document rather than returned as part of either work item's output.
+    """
+    shards_dir = get_page_shards_dir(args.workspace, pdf_orig_path)
+    shard_path = os.path.join(shards_dir, f"pages_{page_range[0]:06d}-{page_range[1] or 'end'}.json")
+    shard = {
+        "Source-File": pdf_orig_path,
+        "pdf-total-pages": num_pages,
+        "page_range": [page_range[0], min(page_range[1] or num_pages, num_pages)],
+        "failed": page_results is None,
+        "page_results": [asdict(page_result) for page_result in page_results or []],
+    }
+
+    if shards_dir.startswith("s3://"):
+        put_s3_bytes(workspace_s3, shard_path, json.dumps(shard).encode())
+        shard_paths = list(expand_s3_glob(workspace_s3, os.path.join(shards_dir, "*.json")))
+    else:
+        os.makedirs(shards_dir, exist_ok=True)
+        with open(shard_path, "w") as f:
+            json.dump(shard, f)
+        shard_paths = [os.path.join(shards_dir, name) for name in os.listdir(shards_dir) if name.endswith(".json")]
+
+    page_results_by_num = {}
+    failed_pages: set[int] = set()
+    failed_ranges = []
+    for path in shard_paths:
+        saved_shard = shard if path == shard_path else json.loads(get_s3_bytes(workspace_s3, path))
+        if saved_shard.get("failed"):
+            first_page, last_page = saved_shard["page_range"]
+            failed_pages.update(range(first_page, last_page + 1))
+            failed_ranges.append(f"{first_page}-{last_page}")
+        for result in saved_shard["page_results"]:
+            page_results_by_num[result["page_num"]] = PageResult(**{**result, "response": PageResponse(**result["response"])})
+
+    num_done = len(page_results_by_num.keys() | failed_pages)
+    if num_done < num_pages:
+        logger.info(f"Saved pages {page_range[0]}-{page_range[1] or num_pages} of {pdf_orig_path}, {num_done} of {num_pages} pages done")
         return None
 
+    if failed_ranges:
+        logger.error(f"Discarding document {pdf_orig_path}, its pages {', '.join(sorted(failed_ranges))} exceeded max_page_error_rate")
+        metrics.add_metrics(failed_shard_documents=1)
+        delete_page_shards(args.workspace, pdf_orig_path)
+        return None
+
+    logger.info(f"All {num_pages} pages of {pdf_orig_path} are done, merging {len(shard_paths)} page range shards")
+    return build_checked_dolma_document(args, pdf_orig_path, [page_results_by_num[page_num] for page_num in range(1, num_pages + 1)])
 
-async def process_pdf(args, worker_id: int, pdf_orig_path: str):
+
+async def process_pdf(args, worker_id: int, pdf_orig_path: str, page_range: tuple[int, int | None] | None = None):
     """Process a single PDF from S3/local path and return a Dolma document."""
-    with tempfile.NamedTemporaryFile("wb+", suffix=".pdf", delete=False) as tf:
+    # Downloads stream to a spool file, so a large scan is never held in memory whole
+    fd, local_path = tempfile.mkstemp(suffix=".pdf", dir=args.download_spool_dir)
+    os.close(fd)
+
+    try:
         try:
-            data = await asyncio.to_thread(lambda: get_s3_bytes_with_backoff(pdf_s3, pdf_orig_path))
-            tf.write(data)
-            tf.flush()
+            await asyncio.to_thread(
+                download_s3_file, pdf_s3, pdf_orig_path, local_path, args.download_multipart_threshold_mb * 1024 * 1024, args.download_max_concurrency
+            )
         except ClientError as ex:
-            if ex.response["Error"]["Code"] == "NoSuchKey":
+            if ex.response["Error"]["Code"] in ("NoSuchKey", "404"):
                 logger.info(f"S3 File Not found, skipping it completely {pdf_orig_path}")
                 return None
             else:
                 raise
 
-        if is_png(tf.name) or is_jpeg(tf.name):
+        if is_png(local_path) or is_jpeg(local_path):
             logger.info(f"Converting {pdf_orig_path} from image to PDF format...")
-            tf.seek(0)
-            tf.write(convert_image_to_pdf_bytes(tf.name))
-            tf.flush()
+            pdf_bytes = convert_image_to_pdf_bytes(local_path)
+            with open(local_path, "wb") as f:
+                f.write(pdf_bytes)
 
-    try:
-        return await process_single_pdf(args, worker_id, pdf_orig_path, tf.name)
+        return await process_single_pdf(args, worker_id, pdf_orig_path, local_path, page_range=page_range)
     finally:
-        if os.path.exists(tf.name):
-            os.unlink(tf.name)
+        if os.path.exists(local_path):
+            os.unlink(local_path)
 
 
 def build_dolma_document(pdf_orig_path, page_results):
@@ -628,6 +1440,7 @@ def build_dolma_document(pdf_orig_path, page_results):
         "total-input-tokens": sum(page.input_tokens for page in page_results),
         "total-output-tokens": sum(page.output_tokens for page in page_results),
         "total-fallback-pages": sum(page.is_fallback for page in page_results),
+        "total-blank-pages": sum(page.is_blank for page in page_results),
     }
 
     id_ = hashlib.sha1(document_text.encode()).hexdigest()
@@ -695,6 +1508,155 @@ def get_markdown_path(workspace: str, source_file: str) -> str:
     return markdown_path
 
 
+def build_duplicate_dolma_documents(dolma_doc: dict, duplicate_paths: list[str] | None = None) -> list[dict]:
+    """
+    Dolma documents for the duplicates of a document, which share its text and point back at it with duplicate-of.
+    Defaults to all of its recorded duplicates.
+    """
+    canonical_path = dolma_doc["metadata"]["Source-File"]
+    if duplicate_paths is None:
+        duplicate_paths = document_duplicates.get(canonical_path, [])
+    return [
+        {
+            **dolma_doc,
+            "metadata": {**dolma_doc["metadata"], "Source-File": path, "duplicate-of": canonical_path, "total-input-tokens": 0, "total-output-tokens": 0},
+        }
+        for path in duplicate_paths
+    ]
+
+
+# File extension of results/output_*.jsonl files for each --output_compression
+OUTPUT_COMPRESSION_EXTENSIONS = {"none": "", "zstd": ".zst", "gzip": ".gz"}
+
+
+def encode_dolma_docs(dolma_docs: list, compression: str = "none") -> bytes:
+    data = "".join(json.dumps(doc) + "\n" for doc in dolma_docs).encode("utf-8")
+    if compression == "zstd":
+        return zstandard.ZstdCompressor().compress(data)
+    if compression == "gzip":
+        return gzip.compress(data)
+    return data
+
+
+def write_output_file(path: str, data: bytes) -> None:
+    """Writes a file to the workspace, S3 or local."""
+    if path.startswith("s3://"):
+        bucket, key = parse_s3_path(path)
+        workspace_s3.upload_fileobj(BytesIO(data), bucket, key)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+
+async def write_dolma_docs(args, output_name: str, dolma_docs: list) -> None:
+    """
+    Writes Dolma documents to results/output_{output_name}.jsonl in the workspace, plus their markdown files if requested.
+    Encoding and uploads run in the output pool, the results file and all of the markdown files concurrently.
+    """
+    loop = asyncio.get_running_loop()
+    dolma_docs = dolma_docs + [duplicate for doc in dolma_docs for duplicate in build_duplicate_dolma_documents(doc)]
+
+    output_path = os.path.join(args.workspace, "results", f"output_{output_name}.jsonl{OUTPUT_COMPRESSION_EXTENSIONS[args.output_compression]}")
+    output_data = await loop.run_in_executor(output_pool, encode_dolma_docs, dolma_docs, args.output_compression)
+    uploads = [loop.run_in_executor(output_pool, write_output_file, output_path, output_data)]
+
+    # If --markdown flag is set, also write the natural text to markdown files
+    if args.markdown:
+        logger.info(f"Writing {len(dolma_docs)} markdown files for {output_name}")
+        for doc in dolma_docs:
+            markdown_path = get_markdown_path(args.workspace, doc["metadata"]["Source-File"])
+            uploads.append(loop.run_in_executor(output_pool, write_output_file, markdown_path, doc["text"].encode("utf-8")))
+
+    await asyncio.gather(*uploads)
+
+
+async def write_late_duplicate_docs(args, work_queue: WorkQueue, late_duplicates: dict[str, list[str]]) -> int:
+    """
+    Writes Dolma documents for new duplicates of documents that were already processed, whose work items won't run again
+    to emit them. They are copied from the canonical document in the results, into results/output_duplicates_*.jsonl.
+    Returns how many were written.
+    """
+    completed_paths = await work_queue.get_completed_paths(set(late_duplicates))
+    if not completed_paths:
+        return 0
+
+    output_files = {re.sub(r"\.jsonl.*$", "", os.path.basename(path)): path for path in list_output_files(args.workspace)}
+    duplicate_docs = []
+    for canonical_path, work_hashes in sorted(completed_paths.items()):
+        # Documents split into page range shards were merged into their own output file
+        output_names = [f"output_{work_hash}" for work_hash in work_hashes] + [f"output_merged_{hashlib.sha1(canonical_path.encode()).hexdigest()}"]
+        canonical_doc = None
+        for path in [output_files[name] for name in output_names if name in output_files]:
+            lines = decode_output_lines(path, await asyncio.to_thread(get_s3_bytes, workspace_s3, path))
+            canonical_doc = next((doc for doc in map(json.loads, lines) if doc["metadata"]["Source-File"] == canonical_path), None)
+            if canonical_doc is not None:
+                break
+
+        if canonical_doc is None:
+            logger.info(f"No output for {canonical_path}, which was skipped, so its {len(late_duplicates[canonical_path])} new duplicates are too")
+            continue
+        duplicate_docs.extend(build_duplicate_dolma_documents(canonical_doc, late_duplicates[canonical_path]))
+
+    if duplicate_docs:
+        output_name = f"duplicates_{hashlib.sha1(''.join(sorted(doc['metadata']['Source-File'] for doc in duplicate_docs)).encode()).hexdigest()}"
+        await write_dolma_docs(args, output_name, duplicate_docs)
+        logger.info(f"Wrote {len(duplicate_docs):,} documents for new duplicates of already processed documents")
+    return len(duplicate_docs)
+
+
+async def dedupe_pdf_paths(args, work_queue: WorkQueue, pdf_work_paths: set[str], content_hashes: dict[str, str]) -> set[str]:
+    """
+    Dedupes the pdfs being added by content hash, and returns the paths to queue. Paths that couldn't be hashed are always queued,
+    and new duplicates of documents that are already done get their documents written right away.
+    """
+    canonical_paths, late_duplicates = await work_queue.dedupe_by_content(content_hashes)
+    if late_duplicates:
+        await write_late_duplicate_docs(args, work_queue, late_duplicates)
+    return (pdf_work_paths - content_hashes.keys()) | canonical_paths
+
+
+async def worker_lock_heartbeat(args, work_queue: WorkQueue, work_item: WorkItem):
+    """Renews the lock of a work item every worker_lock_heartbeat_secs while it's being processed, so other replicas don't take it over."""
+    claimed_at = time.monotonic()
+    counted_duplicate_avoided = False
+
+    while True:
+        await asyncio.sleep(args.worker_lock_heartbeat_secs)
+        try:
+            renewed = await work_queue.renew_lock(work_item)
+        except Exception as e:
+            logger.warning(f"Failed to renew lock for {work_item.hash}: {e}")
+            continue
+
+        if not renewed:
+            metrics.add_metrics(worker_locks_lost=1)
+            logger.warning(f"Work item {work_item.hash} was taken over by another replica after missed heartbeats, no longer renewing its lock")
+            return
+
+        metrics.add_metrics(worker_lock_heartbeats=1)
+
+        # Past the lock timeout, another replica would have taken the item over and processed it again without heartbeats
+        if not counted_duplicate_avoided and time.monotonic() - claimed_at > WORKER_LOCK_TIMEOUT_SECS:
+            counted_duplicate_avoided = True
+            metrics.add_metrics(duplicate_work_avoided=1)
+            logger.info(f"Work item {work_item.hash} has been processing longer than the {WORKER_LOCK_TIMEOUT_SECS}s lock timeout, kept its lock")
+
+
+async def open_page_journal(args, work_item: WorkItem) -> PageJournal:
+    """Opens the page journal of a work item, with the pages checkpointed by any worker that had the item before."""
+    journal = PageJournal(args.workspace, work_item.hash, workspace_s3)
+    try:
+        records = await asyncio.to_thread(journal.load)
+    except Exception as e:
+        logger.warning(f"Could not load page journal of {work_item.hash}, starting it over: {type(e).__name__}: {e}")
+        records = {}
+
+    if records:
+        logger.info(f"Resuming work item {work_item.hash} with {len(records):,} pages from its checkpoint")
+    return journal
+
+
 async def worker(args, work_queue: WorkQueue, worker_id):
     while True:
 
@@ -706,6 +1668,11 @@ async def worker(args, work_queue: WorkQueue, worker_id):
 
         logger.info(f"Worker {worker_id} processing work item {work_item.hash}")
         await tracker.clear_work(worker_id)
+        heartbeat_task = asyncio.create_task(worker_lock_heartbeat(args, work_queue, work_item))
+
+        journal = await open_page_journal(args, work_item) if args.checkpoint_pages else None
+        journal_token = current_page_journal.set(journal)
+        flusher_task = asyncio.create_task(journal.run_flusher(args.checkpoint_interval_secs)) if journal is not None else None
 
         try:
             async with asyncio.TaskGroup() as tg:
@@ -715,7 +1682,8 @@ async def worker(args, work_queue: WorkQueue, worker_id):
                         # Tarball returns a list of docs, so we handle it specially
                         dolma_tasks.append(tg.create_task(process_tarball(args, worker_id, path)))
                     else:
-                        dolma_tasks.append(tg.create_task(process_pdf(args, worker_id, path)))
+                        pdf_path, page_range = parse_page_range_path(path)
+                        dolma_tasks.append(tg.create_task(process_pdf(args, worker_id, pdf_path, page_range=page_range)))
                 logger.info(f"Created all tasks for {work_item.hash}")
 
             logger.info(f"Finished TaskGroup for worker on {work_item.hash}")
@@ -738,60 +1706,7 @@ async def worker(args, work_queue: WorkQueue, worker_id):
 
             logger.info(f"Got {len(dolma_docs)} docs for {work_item.hash}")
 
-            # Write the Dolma documents to a local temporary file in JSONL format
-            with tempfile.NamedTemporaryFile(mode="w+", delete=False) as tf:
-                for doc in dolma_docs:
-                    tf.write(json.dumps(doc))
-                    tf.write("\n")
-                tf.flush()
-                temp_path = tf.name
-
-            try:
-                # Define the output S3 path using the work_hash
-                output_final_path = os.path.join(args.workspace, "results", f"output_{work_item.hash}.jsonl")
-
-                if output_final_path.startswith("s3://"):
-                    bucket, key = parse_s3_path(output_final_path)
-                    workspace_s3.upload_file(temp_path, bucket, key)
-                else:
-                    # Ensure the results directory exists for local workspace
-                    os.makedirs(os.path.dirname(output_final_path), exist_ok=True)
-                    shutil.copyfile(temp_path, output_final_path)
-            finally:
-                # Clean up the temporary file
-                if os.path.exists(temp_path):
-                    os.unlink(temp_path)
-
-            # If --markdown flag is set, also write the natural text to markdown files
-            if args.markdown:
-                logger.info(f"Writing {len(dolma_docs)} markdown files for {work_item.hash}")
-                for doc in dolma_docs:
-                    source_file = doc["metadata"]["Source-File"]
-                    natural_text = doc["text"]
-
-                    markdown_path = get_markdown_path(args.workspace, source_file)
-                    markdown_dir = os.path.dirname(markdown_path)
-
-                    # Create the directory structure if it doesn't exist
-                    if markdown_path.startswith("s3://"):
-                        # For S3 paths, we'll create a temporary file and upload it
-                        with tempfile.NamedTemporaryFile(mode="w+", delete=False) as md_tf:
-                            md_tf.write(natural_text)
-                            md_tf.flush()
-                            md_temp_path = md_tf.name
-
-                        try:
-                            md_bucket, md_key = parse_s3_path(markdown_path)
-                            workspace_s3.upload_file(md_temp_path, md_bucket, md_key)
-                        finally:
-                            # Make sure to clean up the temporary file even if upload fails
-                            if os.path.exists(md_temp_path):
-                                os.unlink(md_temp_path)
-                    else:
-                        # For local paths, create the directory structure and write the file
-                        os.makedirs(markdown_dir, exist_ok=True)
-                        with open(markdown_path, "w") as md_f:
-                            md_f.write(natural_text)
+            await write_dolma_docs(args, work_item.hash, dolma_docs)
 
             # Update finished token counts from successful documents
             metrics.add_metrics(
@@ -799,9 +1714,27 @@ async def worker(args, work_queue: WorkQueue, worker_id):
                 finished_output_tokens=sum(doc["metadata"]["total-output-tokens"] for doc in dolma_docs),
             )
 
+            # Stop renewing before the lock is deleted, so a late heartbeat can't recreate it
+            heartbeat_task.cancel()
             await work_queue.mark_done(work_item)
+
+            if journal is not None:
+                flusher_task.cancel()
+                await asyncio.to_thread(journal.delete)
+                journal = None
         except Exception as e:
             logger.exception(f"Exception occurred while processing work_hash {work_item.hash}: {e}")
+        finally:
+            heartbeat_task.cancel()
+            current_page_journal.reset(journal_token)
+
+            # Checkpoint whatever finished, for the next worker to claim the item
+            if journal is not None:
+                flusher_task.cancel()
+                try:
+                    await asyncio.to_thread(journal.close)
+                except Exception as e:
+                    logger.warning(f"Failed to checkpoint page journal of {work_item.hash}: {e}")
 
 
 async def vllm_server_task(model_name_or_path, args, unknown_args=None):
@@ -850,12 +1783,10 @@ async def vllm_server_task(model_name_or_path, args, unknown_args=None):
 
     atexit.register(_kill_proc)
 
-    # Shared variables between tasks
-    last_running_req, peak_running_req, last_queue_req = 0, 0, 0
     server_printed_ready_message = False
 
     async def process_line(line):
-        nonlocal last_running_req, last_queue_req, peak_running_req, server_printed_ready_message
+        nonlocal server_printed_ready_message
         server_logger.info(line)
 
         if "Detected errors during sampling" in line:
@@ -865,20 +1796,6 @@ async def vllm_server_task(model_name_or_path, args, unknown_args=None):
         if not server_printed_ready_message and ("The server is fired up and ready to roll!" in line or "Starting vLLM API server" in line):
             server_printed_ready_message = True
 
-        if match := re.search(r"Running: (\d+)", line):
-            current_running = int(match.group(1))
-            # Track peak running requests
-            if current_running > peak_running_req:
-                peak_running_req = current_running
-                logger.info(f"New peak running requests: {peak_running_req}")
-            last_running_req = current_running
-
-        if match := re.search(r"(?:Waiting|Pending):\s*(\d+)", line):
-            global vllm_queued_requests
-            last_queue_req = int(match.group(1))
-            vllm_queued_requests = last_queue_req
-            logger.info(f"vllm running req: {last_running_req} queue req: {last_queue_req}")
-
     async def read_stream(stream):
         while True:
             line = await stream.readline()
@@ -926,33 +1843,152 @@ async def vllm_server_host(model_name_or_path, args, unknown_args=None):
         sys.exit(1)
 
 
+@cache
+def make_endpoint_router(server: str, api_key: str | None) -> EndpointRouter:
+    return EndpointRouter(parse_server_endpoints(server, api_key))
+
+
+def get_endpoint_router(args) -> EndpointRouter:
+    """The router for the endpoints of args.server, created on first use, so the same endpoints always share their stats."""
+    global endpoint_router
+    endpoint_router = make_endpoint_router(args.server, args.api_key if args.server and hasattr(args, "api_key") else None)
+    return endpoint_router
+
+
+async def endpoint_models_ready(endpoint: InferenceEndpoint, attempt: int = 1) -> bool:
+    """Checks that an endpoint answers its /models route, which is also how ejected endpoints get health probed."""
+    try:
+        headers = {}
+        if endpoint.api_key:
+            headers["Authorization"] = f"Bearer {endpoint.api_key}"
+
+        async with httpx.AsyncClient() as session:
+            response = await session.get(f"{endpoint.url}/models", headers=headers)
+
+            if response.status_code == 200:
+                return True
+            else:
+                logger.info(f"Attempt {attempt}: Unexpected status code {response.status_code} from {endpoint.url}")
+    except Exception:
+        logger.warning(f"Attempt {attempt}: Please wait for vllm server at {endpoint.url} to become ready...")
+    return False
+
+
 async def vllm_server_ready(args):
+    """Waits for at least one endpoint to be ready, the ones that aren't yet are ejected until their health probes pass."""
     max_attempts = args.max_server_ready_timeout
     delay_sec = 1
-    url = f"{args.server.rstrip('/')}/models"
+    router = get_endpoint_router(args)
 
     for attempt in range(1, max_attempts + 1):
-        try:
-            headers = {}
-            if args.server and hasattr(args, "api_key") and args.api_key:
-                headers["Authorization"] = f"Bearer {args.api_key}"
+        ready = await asyncio.gather(*[endpoint_models_ready(endpoint, attempt) for endpoint in router.endpoints])
 
-            async with httpx.AsyncClient() as session:
-                response = await session.get(url, headers=headers)
-
-                if response.status_code == 200:
-                    logger.info("vllm server is ready.")
-                    return
-                else:
-                    logger.info(f"Attempt {attempt}: Unexpected status code {response.status_code}")
-        except Exception:
-            logger.warning(f"Attempt {attempt}: Please wait for vllm server to become ready...")
+        if any(ready):
+            for endpoint, endpoint_ready in zip(router.endpoints, ready):
+                if not endpoint_ready:
+                    router.eject(endpoint)
+            logger.info("vllm server is ready.")
+            return
 
         await asyncio.sleep(delay_sec)
 
     raise Exception("vllm server did not become ready after waiting.")
 
 
+def server_metrics_url(server: str) -> str:
+    """The prometheus endpoint lives at the root of an OpenAI compatible server, ex. http://localhost:30024/v1 -> http://localhost:30024/metrics"""
+    parsed = urlparse(server)
+    path = parsed.path.rstrip("/")
+    if path.endswith("/v1"):
+        path = path[: -len("/v1")]
+    return urlunparse(parsed._replace(path=f"{path}/metrics", query="", fragment=""))
+
+
+async def vllm_metrics_poller(args, interval: float = 1.0):
+    """
+    Polls the /metrics endpoint of every server, publishing the deepest queue of any one server as backpressure, since
+    max_server_queue_depth is per server, and their summed stats and token counters to the MetricsKeeper. Servers whose
+    metrics can't be read are left out.
+    """
+    global vllm_queued_requests
+    endpoints = get_endpoint_router(args).endpoints
+
+    async def fetch_samples(session: httpx.AsyncClient, endpoint: InferenceEndpoint) -> dict[str, list[float]]:
+        headers = {"Authorization": f"Bearer {endpoint.api_key}"} if endpoint.api_key else {}
+        response = await session.get(server_metrics_url(endpoint.url), headers=headers)
+        response.raise_for_status()
+        samples = parse_prometheus_metrics(response.text)
+        if "vllm:num_requests_waiting" not in samples:
+            raise ValueError("no vllm:num_requests_waiting gauge")
+        return samples
+
+    last_counters: dict[tuple[str, str], float] = {}
+    latest_samples: dict[str, dict[str, list[float]]] = {}
+    failures = {endpoint.url: 0 for endpoint in endpoints}
+    next_poll = {endpoint.url: 0.0 for endpoint in endpoints}
+    peak_running_req = 0
+
+    async with httpx.AsyncClient(timeout=5.0) as session:
+        while True:
+            now = time.monotonic()
+            due = [endpoint for endpoint in endpoints if next_poll[endpoint.url] <= now]
+            results = await asyncio.gather(*[fetch_samples(session, endpoint) for endpoint in due], return_exceptions=True)
+
+            for endpoint, result in zip(due, results):
+                url = server_metrics_url(endpoint.url)
+                if isinstance(result, asyncio.CancelledError):
+                    raise result
+                if isinstance(result, BaseException):
+                    failures[endpoint.url] += 1
+                    if failures[endpoint.url] == 1:
+                        logger.warning(
+                            f"Could not read server metrics from {url} ({type(result).__name__}: {result}), leaving it out of the server queue depth"
+                        )
+                    latest_samples.pop(endpoint.url, None)
+                    # Servers without a metrics endpoint are only re-checked every minute or so
+                    next_poll[endpoint.url] = now + min(60.0, interval * 2 ** min(failures[endpoint.url], 6))
+                    continue
+
+                if failures[endpoint.url]:
+                    logger.info(f"Reading server metrics from {url}")
+                failures[endpoint.url] = 0
+                latest_samples[endpoint.url] = result
+
+                for counter, metric_name in (("vllm:prompt_tokens_total", "vllm_prompt_tokens"), ("vllm:generation_tokens_total", "vllm_generation_tokens")):
+                    if counter not in result:
+                        continue
+                    value = sum(result[counter])
+                    # Counters restart from zero if the server does
+                    if (endpoint.url, counter) in last_counters and value >= last_counters[endpoint.url, counter]:
+                        metrics.add_metrics(**{metric_name: int(value - last_counters[endpoint.url, counter])})
+                    last_counters[endpoint.url, counter] = value
+
+            if latest_samples:
+                running = int(sum(sum(samples.get("vllm:num_requests_running", [0])) for samples in latest_samples.values()))
+                waiting_per_server = [int(sum(samples["vllm:num_requests_waiting"])) for samples in latest_samples.values()]
+                waiting = sum(waiting_per_server)
+                # Renamed in vllm's v1 engine, both are fractions of the kv cache blocks in use
+                kv_cache_usage = [
+                    usage
+                    for samples in latest_samples.values()
+                    for usage in (samples.get("vllm:kv_cache_usage_perc") or samples.get("vllm:gpu_cache_usage_perc") or [0.0])
+                ]
+
+                vllm_queued_requests = waiting
+                max_concurrent_requests_limit.observe_queue_depth(max(waiting_per_server))
+                vllm_server_stats.update(running=running, waiting=waiting, kv_cache_usage=sum(kv_cache_usage) / len(kv_cache_usage))
+
+                if running > peak_running_req:
+                    peak_running_req = running
+                    logger.info(f"New peak running requests: {peak_running_req}")
+            else:
+                vllm_queued_requests = None
+                max_concurrent_requests_limit.observe_queue_depth(None)
+                vllm_server_stats.clear()
+
+            await asyncio.sleep(interval)
+
+
 async def download_model(model_name_or_path: str, max_retries: int = 5):
     for retry in range(max_retries):
         try:
@@ -986,6 +2022,21 @@ async def metrics_reporter(work_queue):
         logger.info(f"Queue remaining: {work_queue.size}")
         logger.info("\n" + str(metrics))
         logger.info("\n" + str(await tracker.get_status_table()))
+        logger.info(str(http_pool))
+        logger.info(str(max_concurrent_requests_limit))
+        logger.info(str(event_loop_monitor))
+        if cpu_pool is not None:
+            logger.info(str(cpu_pool))
+        if render_pool is not None:
+            logger.info(str(render_pool))
+        if page_result_cache is not None:
+            logger.info(str(page_result_cache))
+        if endpoint_router is not None and len(endpoint_router.endpoints) > 1:
+            logger.info("\n" + str(endpoint_router))
+        if vllm_server_stats:
+            logger.info(
+                f"vllm server: {vllm_server_stats['running']:,.0f} running, {vllm_server_stats['waiting']:,.0f} waiting, kv cache {vllm_server_stats['kv_cache_usage']:.1%} used"
+            )
         await asyncio.sleep(10)
 
 
@@ -1102,71 +2153,155 @@ def submit_beaker_job(args):
     print(f"Experiment URL: https://beaker.org/ex/{workload.experiment.id}")
 
 
-def print_stats(args, root_work_queue):
-    LONG_CONTEXT_THRESHOLD = 32768
-    assert args.workspace.startswith("s3://"), "Printing stats functionality only works with s3 workspaces for now."
+def get_content_hash(pdf_path: str) -> str | None:
+    """A hash of a document's bytes, its ETag for S3 paths, so that byte-identical documents can be found. None if it can't be read."""
+    try:
+        if pdf_path.startswith("s3://"):
+            bucket, key = parse_s3_path(pdf_path)
+            return "etag:" + pdf_s3.head_object(Bucket=bucket, Key=key)["ETag"].strip('"')
+
+        sha1 = hashlib.sha1()
+        with open(pdf_path, "rb") as f:
+            while chunk := f.read(1 << 20):
+                sha1.update(chunk)
+        return "sha1:" + sha1.hexdigest()
+    except Exception as e:
+        logger.warning(f"Failed to hash {pdf_path}: {e}")
+        return None
 
-    done_work_items = expand_s3_glob(workspace_s3, os.path.join(args.workspace, "results", "*.jsonl"))
-    work_queue_lines = download_zstd_csv(workspace_s3, os.path.join(args.workspace, "work_index_list.csv.zstd"))
-    work_queue = {parts[0]: parts[1:] for line in work_queue_lines if line.strip() and (parts := root_work_queue._decode_csv_row(line.strip()))}
 
-    total_items, completed_items = len(work_queue), len(done_work_items)
+def get_pdf_page_count(pdf_path: str) -> int | None:
+    """
+    Counts the pages of a pdf or image document, None if it can't be read. Only the blocks holding the header, trailer,
+    xref and page tree root are fetched, with ranged reads, rather than the whole file.
+    """
+    try:
+        with S3RangeReader(pdf_s3, pdf_path) as stream:
+            header = stream.read(8)
+            if header.startswith(b"\x89PNG") or header.startswith(b"\xff\xd8\xff"):
+                return 1
+            try:
+                # Strict mode trusts the xref, the lenient mode seeks to every object listed in it to double check
+                return int(PdfReader(stream, strict=True).trailer["/Root"]["/Pages"]["/Count"])
+            except Exception:
+                stream.seek(0)
+                return len(PdfReader(stream).pages)
+    except Exception as e:
+        logger.warning(f"Failed to read {pdf_path}: {e}")
+        return None
 
-    def process_output_file(s3_path):
+
+LONG_CONTEXT_THRESHOLD = 32768
+OUTPUT_STATS_KEYS = ["docs", "input_tokens", "output_tokens", "pages", "fallback_pages", "blank_pages", "long_docs", "long_tokens", "en_docs", "en_tokens"]
+
+
+def summarize_output_file(path: str, data: bytes) -> dict:
+    """Document, page and token counts of one results file, and the source files of its documents."""
+    stats = {k: 0 for k in OUTPUT_STATS_KEYS}
+    paths = set()
+    for line in decode_output_lines(path, data):
+        if not line.strip():
+            continue
+        doc = json.loads(line)
+        meta, attrs = doc["metadata"], doc.get("attributes", {})
+        out_tokens = meta.get("total-output-tokens", 0)
+        stats["docs"] += 1
+        stats["input_tokens"] += meta.get("total-input-tokens", 0)
+        stats["output_tokens"] += out_tokens
+        stats["pages"] += meta.get("pdf-total-pages", 0)
+        stats["fallback_pages"] += meta.get("total-fallback-pages", 0)
+        stats["blank_pages"] += meta.get("total-blank-pages", 0)
+        paths.add(meta["Source-File"])
+        if out_tokens > LONG_CONTEXT_THRESHOLD:
+            stats["long_docs"] += 1
+            stats["long_tokens"] += out_tokens
+        langs = attrs.get("primary_language", [])
+        if langs and sum(1 for ln in langs if ln == "en") > len(langs) / 2:
+            stats["en_docs"] += 1
+            stats["en_tokens"] += out_tokens
+    return {"stats": stats, "paths": sorted(paths)}
+
+
+def list_output_files(workspace: str) -> dict[str, str]:
+    """Every results file of a workspace, with a version that changes along with the file: its ETag on S3, its size and mtime locally."""
+    results_glob = os.path.join(workspace, "results", "*.jsonl*")
+    if workspace.startswith("s3://"):
+        return expand_s3_glob(workspace_s3, results_glob)
+    return {path: f"{stat.st_size}-{stat.st_mtime_ns}" for path in glob.glob(results_glob) if (stat := os.stat(path))}
+
+
+def get_stats_cache_path(args) -> str:
+    return os.path.join(args.stats_cache_dir, f"{hashlib.sha1(args.workspace.rstrip('/').encode()).hexdigest()}.json.zstd")
+
+
+def load_stats_cache(cache_path: str) -> dict[str, dict]:
+    """Summaries of results files from earlier --stats runs, by path, each with the version of the file it was made from."""
+    try:
+        with open(cache_path, "rb") as f:
+            return json.loads(zstandard.ZstdDecompressor().decompress(f.read()))
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning(f"Could not read stats cache {cache_path}, rebuilding it: {e}")
+        return {}
+
+
+def save_stats_cache(cache_path: str, cache: dict[str, dict]) -> None:
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    temp_path = f"{cache_path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(zstandard.ZstdCompressor().compress(json.dumps(cache).encode()))
+    os.replace(temp_path, cache_path)
+
+
+def print_stats(args, work_items):
+    """
+    Reports statistics about the workspace from a summary of each results file. Summaries are cached locally in stats_cache_dir
+    by the version of their file, so that each run only downloads the results files that are new or changed since the last one.
+    """
+    output_files = list_output_files(args.workspace)
+    work_queue = {work_hash: item.work_paths for work_hash, item in work_items.items()}
+
+    # Documents merged from page range shards and late duplicates get their own output files, which don't correspond to work items
+    total_items = len(work_queue)
+    completed_items = sum(1 for item in output_files if not os.path.basename(item).startswith(("output_merged_", "output_duplicates_")))
+
+    cache_path = get_stats_cache_path(args)
+    cache = load_stats_cache(cache_path)
+    stale_files = [path for path, version in output_files.items() if cache.get(path, {}).get("version") != version]
+
+    def fetch_summary(path):
         try:
-            stats = {
-                "docs": 0,
-                "input_tokens": 0,
-                "output_tokens": 0,
-                "pages": 0,
-                "fallback_pages": 0,
-                "long_docs": 0,
-                "long_tokens": 0,
-                "en_docs": 0,
-                "en_tokens": 0,
-            }
-            paths = set()
-            for line in get_s3_bytes(workspace_s3, s3_path).decode("utf-8").splitlines():
-                if not line.strip():
-                    continue
-                doc = json.loads(line)
-                meta, attrs = doc["metadata"], doc.get("attributes", {})
-                out_tokens = meta.get("total-output-tokens", 0)
-                stats["docs"] += 1
-                stats["input_tokens"] += meta.get("total-input-tokens", 0)
-                stats["output_tokens"] += out_tokens
-                stats["pages"] += meta.get("pdf-total-pages", 0)
-                stats["fallback_pages"] += meta.get("total-fallback-pages", 0)
-                paths.add(meta["Source-File"])
-                if out_tokens > LONG_CONTEXT_THRESHOLD:
-                    stats["long_docs"] += 1
-                    stats["long_tokens"] += out_tokens
-                langs = attrs.get("primary_language", [])
-                if langs and sum(1 for ln in langs if ln == "en") > len(langs) / 2:
-                    stats["en_docs"] += 1
-                    stats["en_tokens"] += out_tokens
-            return stats, paths
+            return path, {"version": output_files[path], **summarize_output_file(path, get_s3_bytes(workspace_s3, path))}
         except Exception as e:
-            logger.warning(f"Error processing {s3_path}: {e}")
-            return {
-                k: 0 for k in ["docs", "input_tokens", "output_tokens", "pages", "fallback_pages", "long_docs", "long_tokens", "en_docs", "en_tokens"]
-            }, set()
+            logger.warning(f"Error processing {path}: {e}")
+            return path, None
+
+    print(f"\nCompleted work items {completed_items:,} out of {total_items:,}: {completed_items/max(1, total_items)*100:.2f}%")
+    print(f"\nProcessing output files, {len(output_files) - len(stale_files):,} summaries cached, {len(stale_files):,} to fetch...")
+
+    with ThreadPoolExecutor() as executor:
+        for path, summary in tqdm(executor.map(fetch_summary, stale_files), total=len(stale_files)):
+            if summary is not None:
+                cache[path] = summary
 
-    print(f"\nCompleted work items {completed_items:,} out of {total_items:,}: {completed_items/total_items*100:.2f}%")
-    print("\nProcessing output files...")
+    # Results files that are gone from the workspace drop out of the cache
+    num_cached = len(cache)
+    cache = {path: cache[path] for path in output_files if path in cache}
+    if stale_files or len(cache) != num_cached:
+        save_stats_cache(cache_path, cache)
 
-    totals = {"docs": 0, "input_tokens": 0, "output_tokens": 0, "pages": 0, "fallback_pages": 0, "long_docs": 0, "long_tokens": 0, "en_docs": 0, "en_tokens": 0}
+    totals = {k: 0 for k in OUTPUT_STATS_KEYS}
     all_processed, original_paths = set(), set()
 
-    for item in done_work_items:
+    for item in output_files:
         if (match := re.search(r"output_(\w+).jsonl", item)) and match.group(1) in work_queue:
-            original_paths.update(work_queue[match.group(1)])
+            original_paths.update(parse_page_range_path(path)[0] for path in work_queue[match.group(1)])
 
-    with ThreadPoolExecutor() as executor:
-        for stats, paths in tqdm(executor.map(process_output_file, done_work_items), total=len(done_work_items)):
-            for k in totals:
-                totals[k] += stats[k]
-            all_processed.update(paths)
+    for summary in cache.values():
+        for k in totals:
+            totals[k] += summary["stats"][k]
+        all_processed.update(summary["paths"])
 
     d, p, o, c = totals["docs"], totals["pages"], totals["output_tokens"], max(1, completed_items)
     print(f"""
@@ -1179,6 +2314,7 @@ Results:
 Total documents processed: {d:,}
 Total documents skipped: {len(original_paths - all_processed):,}
 Total pages on fallback: {totals['fallback_pages']:,}
+Total blank pages skipped: {totals['blank_pages']:,}
 Total pages processed: {p:,}
 
 Total output tokens: {o:,}
@@ -1218,17 +2354,141 @@ async def main():
     parser.add_argument("--workspace_profile", help="S3 configuration profile for accessing the workspace", default=None)
     parser.add_argument("--pdf_profile", help="S3 configuration profile for accessing the raw pdf documents", default=None)
     parser.add_argument("--pages_per_group", type=int, default=argparse.SUPPRESS, help="Aiming for this many pdf pages per work item group")
+    parser.add_argument(
+        "--max_pages_per_work_item",
+        type=int,
+        default=None,
+        help="Split documents with more pages than this into page range work items, merged back into one document once all are done. Implies --exact_page_counts.",
+    )
+    parser.add_argument(
+        "--exact_page_counts",
+        action="store_true",
+        help="When adding pdfs, count the pages of each one with ranged reads of its trailer and xref, and pack work items to --pages_per_group pages",
+    )
+    parser.add_argument(
+        "--dedupe_pdfs",
+        action="store_true",
+        help="Only queue one of each set of byte-identical pdfs added with --pdfs, by S3 ETag or sha1, the others get copies of its output",
+    )
+    parser.add_argument("--page_count_workers", type=int, default=64, help="Number of pdfs whose pages are counted in parallel when adding them")
     parser.add_argument("--max_page_retries", type=int, default=8, help="Max number of times we will retry rendering a page")
     parser.add_argument("--max_page_error_rate", type=float, default=0.004, help="Rate of allowable failed pages in a document, 1/250 by default")
     parser.add_argument("--workers", type=int, default=20, help="Number of workers to run at a time")
+    parser.add_argument("--upload_workers", type=int, default=16, help="Number of threads that upload results and markdown files, shared by all workers")
+    parser.add_argument(
+        "--output_compression",
+        choices=list(OUTPUT_COMPRESSION_EXTENSIONS),
+        default="none",
+        help="Compression of results/output_*.jsonl files, written as .jsonl.zst or .jsonl.gz",
+    )
+    parser.add_argument(
+        "--download_spool_dir", type=str, default=None, help="Directory that pdfs are downloaded to while they are processed, the system temp dir by default"
+    )
+    parser.add_argument(
+        "--download_multipart_threshold_mb", type=int, default=64, help="Download pdfs larger than this with parallel ranged GETs instead of one stream"
+    )
+    parser.add_argument("--download_max_concurrency", type=int, default=8, help="Max parallel ranged GETs per pdf download")
+    parser.add_argument(
+        "--tarball_max_pending_pdfs",
+        type=int,
+        default=32,
+        help="Max number of PDFs per tarball that are extracted to local disk and not processed yet, extraction pauses until some finish",
+    )
+    parser.add_argument(
+        "--checkpoint_pages",
+        action="store_true",
+        help="Journal finished pages to checkpoints/ in the workspace, so a work item picked up after a crash or preemption resumes where it stopped",
+    )
+    parser.add_argument("--checkpoint_interval_secs", type=float, default=60, help="With --checkpoint_pages, how often page journals are checkpointed")
+    parser.add_argument(
+        "--worker_lock_heartbeat_secs",
+        type=float,
+        default=60,
+        help=f"How often workers renew the locks of the work items they are processing, locks are stale after {WORKER_LOCK_TIMEOUT_SECS}s without renewal",
+    )
+    parser.add_argument(
+        "--cpu_workers",
+        type=int,
+        default=max(1, min(8, multiprocessing.cpu_count() // 4)),
+        help="Number of processes for page counting, filtering and pdftotext fallbacks, each one filtering loads its own language models",
+    )
     parser.add_argument("--max_concurrent_requests", type=int, default=1600, help="Max number of concurrent VLLM server requests at a time.")
+    parser.add_argument(
+        "--min_concurrent_requests",
+        type=int,
+        default=64,
+        help="Lowest the adaptive concurrency limit will back off to under errors, rising latency or a long server queue. Set equal to --max_concurrent_requests for a fixed limit.",
+    )
+    parser.add_argument(
+        "--max_server_queue_depth", type=int, default=256, help="Back off the concurrency limit while the server reports more waiting requests than this"
+    )
     parser.add_argument("--max_server_ready_timeout", type=int, default=600, help="Number of seconds to wait for vllm to become ready before exiting.")
     parser.add_argument("--apply_filter", action="store_true", help="Apply basic filtering to English pdfs which are not forms, and not likely seo spam")
     parser.add_argument("--stats", action="store_true", help="Instead of running any job, reports some statistics about the current workspace")
+    parser.add_argument(
+        "--stats_cache_dir",
+        type=str,
+        default=os.path.join(os.path.expanduser("~"), ".cache", "olmocr", "stats"),
+        help="With --stats, where summaries of results files are cached between runs, so that only new results files are downloaded",
+    )
     parser.add_argument("--markdown", action="store_true", help="Also write natural text to markdown files preserving the folder structure of the input pdfs")
     parser.add_argument("--target_longest_image_dim", type=int, help="Dimension on longest side to use for rendering the pdf pages", default=1288)
+    parser.add_argument(
+        "--render_engine",
+        choices=["pdfium", "pdftoppm"],
+        default="pdfium",
+        help="Engine used to render pdf pages to images, pdfium renders in a pool of --render_workers processes, pdftoppm spawns a poppler process per page",
+    )
+    parser.add_argument(
+        "--render_workers",
+        type=int,
+        default=int(float(os.environ.get("BEAKER_ASSIGNED_CPU_COUNT", max(1, multiprocessing.cpu_count() - 2)))),
+        help="Number of processes rendering pages with pdfium, each keeping the documents it renders open, 0 to render in threads of the main process",
+    )
+    parser.add_argument("--render_cache_pages", type=int, default=16, help="Max number of retrying pages per document to keep rendered in memory, 0 to disable")
     parser.add_argument("--target_anchor_text_len", type=int, help="Maximum amount of anchor text to use (characters), not used for new models", default=-1)
     parser.add_argument("--guided_decoding", action="store_true", help="Enable guided decoding for model YAML type outputs")
+    parser.add_argument(
+        "--stream_requests",
+        action="store_true",
+        help="Stream page completions from the server, and abort attempts as soon as their output falls into a repetition loop instead of at max_tokens",
+    )
+    parser.add_argument(
+        "--repeat_abort_chars",
+        type=int,
+        default=1500,
+        help="With --stream_requests, abort an attempt once its output ends in this many characters of one n-gram repeating",
+    )
+    parser.add_argument(
+        "--hedge_requests",
+        action="store_true",
+        help="Send a duplicate of a page request that is running slower than --hedge_percentile of recent ones, to another endpoint if there is one",
+    )
+    parser.add_argument("--hedge_percentile", type=float, default=95.0, help="With --hedge_requests, latency percentile after which a request is hedged")
+    parser.add_argument(
+        "--hedge_max_fraction", type=float, default=0.05, help="With --hedge_requests, max fraction of page requests that can be hedge duplicates"
+    )
+    parser.add_argument(
+        "--skip_blank_pages", action="store_true", help="Don't send pages that are confidently blank to the server, they get empty text instead"
+    )
+    parser.add_argument(
+        "--blank_max_ink_coverage",
+        type=float,
+        default=0.0005,
+        help="With --skip_blank_pages, max fraction of a page's pixels that can differ from its background",
+    )
+    parser.add_argument("--blank_max_stddev", type=float, default=6.0, help="With --skip_blank_pages, max standard deviation of a page's grayscale levels")
+    parser.add_argument("--blank_max_text_chars", type=int, default=0, help="With --skip_blank_pages, max non-whitespace characters in a page's text layer")
+    parser.add_argument(
+        "--page_result_cache",
+        type=str,
+        default=None,
+        help="Reuse page results across runs and workspaces, from a local SQLite database at this path or an s3:// prefix, keyed by page render, prompt and model",
+    )
+    parser.add_argument("--page_result_cache_ttl_days", type=float, default=None, help="Ignore and evict page result cache entries older than this")
+    parser.add_argument(
+        "--page_result_cache_max_entries", type=int, default=None, help="Evict the least recently used entries of a SQLite page result cache beyond this"
+    )
     parser.add_argument(
         "--disk_logging",
         type=str,
@@ -1242,7 +2502,8 @@ async def main():
     server_group.add_argument(
         "--server",
         type=str,
-        help="URL of external vLLM (or other compatible provider) server (e.g., http://hostname:port/v1). If provided, skips spawning local vLLM instance",
+        help="URL of external vLLM (or other compatible provider) server (e.g., http://hostname:port/v1). If provided, skips spawning local vLLM instance. "
+        "Several servers can be given separated by commas, each optionally followed by ;weight=N and ;api_key=KEY, requests go to the least busy one",
     )
     server_group.add_argument("--api_key", type=str, default=None, help="API key for authenticated remote servers (e.g., DeepInfra)")
 
@@ -1284,9 +2545,20 @@ async def main():
     )
 
     use_internal_server = not args.server
-    global workspace_s3, pdf_s3, max_concurrent_requests_limit
+    global workspace_s3, pdf_s3, max_concurrent_requests_limit, cpu_pool, render_pool, output_pool, page_result_cache
 
-    max_concurrent_requests_limit = asyncio.BoundedSemaphore(args.max_concurrent_requests)
+    max_concurrent_requests_limit = AdaptiveConcurrencyLimiter(
+        args.max_concurrent_requests, min_limit=args.min_concurrent_requests, max_queue_depth=args.max_server_queue_depth
+    )
+
+    # Every worker can be downloading a pdf with download_max_concurrency ranged GETs at once, and they all share one client,
+    # whose connection pool would otherwise hold 10 connections and make the rest wait for one
+    s3_config = Config(max_pool_connections=max(10, args.workers * args.download_max_concurrency))
+    workspace_s3 = boto3.client("s3", config=s3_config)
+    pdf_s3 = boto3.client("s3", config=s3_config)
+
+    if args.download_spool_dir:
+        os.makedirs(args.download_spool_dir, exist_ok=True)
 
     # setup the job to work in beaker environment, load secrets, adjust logging, etc.
     if "BEAKER_JOB_NAME" in os.environ:
@@ -1299,8 +2571,8 @@ async def main():
         with open(cred_path, "w") as f:
             f.write(os.environ.get("GOOGLE_APPLICATION_CREDENTIALS_FILE"))
         os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = cred_path
-        workspace_s3 = boto3.client("s3")
-        pdf_s3 = boto3.client("s3")
+        workspace_s3 = boto3.client("s3", config=s3_config)
+        pdf_s3 = boto3.client("s3", config=s3_config)
 
         # Wait a little bit so that not all beaker jobs in a task start at the same time and download the model at the same time
         replica_count = int(os.environ.get("BEAKER_REPLICA_COUNT", "1"))
@@ -1316,11 +2588,11 @@ async def main():
 
     if args.workspace_profile:
         workspace_session = boto3.Session(profile_name=args.workspace_profile)
-        workspace_s3 = workspace_session.client("s3")
+        workspace_s3 = workspace_session.client("s3", config=s3_config)
 
     if args.pdf_profile:
         pdf_session = boto3.Session(profile_name=args.pdf_profile)
-        pdf_s3 = pdf_session.client("s3")
+        pdf_s3 = pdf_session.client("s3", config=s3_config)
 
     # We need poppler to load the initial pdfs, even if we are not processing them here
     check_poppler_version()
@@ -1335,14 +2607,17 @@ async def main():
         logger.info("Got --pdfs argument, going to add to the work queue")
         pdf_work_paths = set()
         tarball_paths = set()
+        content_hashes = {}
 
         for pdf_path in args.pdfs:
             # Expand s3 glob paths first, then categorize results
             if pdf_path.startswith("s3://"):
                 logger.info(f"Expanding s3 glob at {pdf_path}")
-                expanded_paths = set(expand_s3_glob(pdf_s3, pdf_path))
+                expanded_etags = expand_s3_glob(pdf_s3, pdf_path)
+                expanded_paths = set(expanded_etags)
                 tarball_paths.update(p for p in expanded_paths if is_tarball_path(p))
                 pdf_work_paths.update(p for p in expanded_paths if not is_tarball_path(p))
+                content_hashes.update((p, f"etag:{etag}") for p, etag in expanded_etags.items() if not is_tarball_path(p))
             elif os.path.exists(pdf_path):
                 # Check if this is a tar.gz file (local)
                 if is_tarball_path(pdf_path):
@@ -1374,29 +2649,35 @@ async def main():
 
         logger.info(f"Found {len(pdf_work_paths):,} regular pdf paths and {len(tarball_paths):,} tarballs to add")
 
+        if args.dedupe_pdfs and pdf_work_paths:
+            # ETags came with the glob listings, everything else gets hashed (local files) or headed (s3 paths from lists)
+            hash_paths = [p for p in pdf_work_paths if p not in content_hashes]
+            with ThreadPoolExecutor(max_workers=args.page_count_workers) as executor:
+                for pdf, content_hash in tqdm(zip(hash_paths, executor.map(get_content_hash, hash_paths)), total=len(hash_paths), desc="Hashing pdfs"):
+                    if content_hash is not None:
+                        content_hashes[pdf] = content_hash
+
+            # Tarball members aren't deduplicated, and paths that couldn't be hashed are always queued
+            content_hashes = {p: h for p, h in content_hashes.items() if p in pdf_work_paths}
+            pdf_work_paths = await dedupe_pdf_paths(args, work_queue, pdf_work_paths, content_hashes)
+
         # Process regular PDFs with calculated items_per_group
         if pdf_work_paths:
-            # Estimate average pages per pdf
-            sample_size = min(100, len(pdf_work_paths))
-            sampled_pdfs = random.sample(list(pdf_work_paths), sample_size)
-            page_counts = []
+            if args.exact_page_counts or args.max_pages_per_work_item:
+                # Every document gets counted, to know which ones to split and to pack groups by page count
+                count_paths = list(pdf_work_paths)
+            else:
+                # Estimate average pages per pdf
+                count_paths = random.sample(list(pdf_work_paths), min(100, len(pdf_work_paths)))
 
-            for pdf in tqdm(sampled_pdfs, desc="Sampling PDFs to calculate optimal length"):
-                try:
-                    # Download the PDF to a temp file
-                    with tempfile.NamedTemporaryFile(suffix=".pdf") as tmp_file:
-                        tmp_file.write(get_s3_bytes(pdf_s3, pdf))
-                        tmp_file.flush()
-                        if is_png(tmp_file.name) or is_jpeg(tmp_file.name):
-                            page_counts.append(1)
-                        else:
-                            reader = PdfReader(tmp_file.name)
-                            page_counts.append(len(reader.pages))
-                except Exception as e:
-                    logger.warning(f"Failed to read {pdf}: {e}")
+            page_counts = {}
+            with ThreadPoolExecutor(max_workers=args.page_count_workers) as executor:
+                for pdf, num_pages in tqdm(zip(count_paths, executor.map(get_pdf_page_count, count_paths)), total=len(count_paths), desc="Counting pages"):
+                    if num_pages is not None:
+                        page_counts[pdf] = num_pages
 
             if page_counts:
-                avg_pages_per_pdf = sum(page_counts) / len(page_counts)
+                avg_pages_per_pdf = sum(page_counts.values()) / len(page_counts)
             else:
                 logger.warning("Could not read any PDFs to estimate average page count.")
                 avg_pages_per_pdf = 10  # Default to 10 pages per PDF if sampling fails
@@ -1405,14 +2686,20 @@ async def main():
             logger.info(f"Calculated items_per_group: {items_per_group} based on average pages per PDF: {avg_pages_per_pdf:.2f}")
 
             # Now call populate_queue for regular PDFs
-            await work_queue.populate_queue(list(pdf_work_paths), items_per_group)
+            await work_queue.populate_queue(
+                list(pdf_work_paths),
+                items_per_group,
+                page_counts=page_counts,
+                max_pages_per_item=args.max_pages_per_work_item,
+                pages_per_group=args.pages_per_group if args.exact_page_counts or args.max_pages_per_work_item else None,
+            )
 
         # Add tarballs to the queue - each tarball is one work item
         if tarball_paths:
             await work_queue.populate_queue(tarball_paths, 1)
 
     if args.stats:
-        print_stats(args, work_queue)
+        print_stats(args, await work_queue.load_all_items())
         return
 
     if args.beaker:
@@ -1426,6 +2713,16 @@ async def main():
 
     logger.info(f"Starting pipeline with PID {os.getpid()}")
 
+    # Keyed by the model that was asked for, before the internal server renames it
+    if args.page_result_cache:
+        page_result_cache = open_page_result_cache(
+            args.page_result_cache,
+            args.model,
+            s3_client=workspace_s3,
+            ttl_secs=args.page_result_cache_ttl_days * 24 * 60 * 60 if args.page_result_cache_ttl_days else None,
+            max_entries=args.page_result_cache_max_entries,
+        )
+
     # Download the model before you do anything else
     if use_internal_server:
         model_name_or_path = await download_model(args.model)
@@ -1443,6 +2740,8 @@ async def main():
         logger.info("No work to do, exiting")
         return
 
+    document_duplicates.update(await work_queue.load_duplicates())
+
     # Start local vLLM instance if not using external one
     vllm_server = None
     if use_internal_server:
@@ -1450,7 +2749,16 @@ async def main():
 
     await vllm_server_ready(args)
 
+    cpu_pool = BoundedProcessPool(args.cpu_workers)
+    if args.render_engine == "pdfium" and args.render_workers > 0:
+        render_pool = BoundedProcessPool(args.render_workers, name="Render")
+    output_pool = ThreadPoolExecutor(max_workers=args.upload_workers, thread_name_prefix="output")
+
     metrics_task = asyncio.create_task(metrics_reporter(work_queue))
+    server_metrics_task = asyncio.create_task(vllm_metrics_poller(args))
+    prefetch_task = asyncio.create_task(work_queue.run_prefetcher())
+    event_loop_monitor_task = asyncio.create_task(event_loop_monitor.run())
+    health_probe_task = asyncio.create_task(get_endpoint_router(args).run_health_probes(endpoint_models_ready))
 
     # Create worker tasks to process the queue concurrently.
     worker_tasks = []
@@ -1460,14 +2768,26 @@ async def main():
 
     # Wait for all worker tasks to finish
     await asyncio.gather(*worker_tasks)
+    http_pool.close_all()
+    cpu_pool.shutdown()
+    if render_pool is not None:
+        render_pool.shutdown()
+    output_pool.shutdown()
+    if page_result_cache is not None:
+        logger.info(str(page_result_cache))
+        page_result_cache.close()
 
     # Cancel vLLM server if it was started
     if vllm_server is not None:
         vllm_server.cancel()
     metrics_task.cancel()
+    server_metrics_task.cancel()
+    prefetch_task.cancel()
+    event_loop_monitor_task.cancel()
+    health_probe_task.cancel()
 
     # Wait for cancelled tasks to complete
-    tasks_to_wait = [metrics_task]
+    tasks_to_wait = [metrics_task, server_metrics_task, prefetch_task, event_loop_monitor_task, health_probe_task]
     if vllm_server is not None:
         tasks_to_wait.append(vllm_server)
     await asyncio.gather(*tasks_to_wait, return_exceptions=True)
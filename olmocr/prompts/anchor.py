@@ -4,9 +4,10 @@
 import random
 import re
 import subprocess
+import threading
 from dataclasses import dataclass
 from os import PathLike
-from typing import List, Literal
+from typing import Dict, List, Literal, Optional
 
 import ftfy
 import pypdfium2 as pdfium
@@ -49,6 +50,79 @@ def get_anchor_text(
         raise NotImplementedError("Unknown engine")
 
 
+class PdfTextLayer:
+    """
+    Lazily extracted pdftotext output of one document, split into pages on the form feed that ends each page, which is
+    kept so pages match what `pdftotext -f N -l N` outputs. A request for pages that aren't cached yet extracts the whole
+    document with one subprocess, or with whole_document=False just the requested range. Thread safe, and picklable
+    along with the pages extracted so far.
+    """
+
+    WHOLE_DOCUMENT_TIMEOUT = 600
+    PAGE_RANGE_TIMEOUT = 60
+
+    def __init__(self, local_pdf_path: str | PathLike):
+        self.local_pdf_path = str(local_pdf_path)
+        self.pages: Dict[int, str] = {}
+        self.num_pages: Optional[int] = None
+        self.subprocess_runs = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get_page(self, page: int) -> str:
+        assert page > 0, "Pages are 1-indexed in pdf-land"
+        pages = self.get_pages(page, page)
+        return pages[0] if pages else ""
+
+    def get_pages(self, first_page: int, last_page: int, whole_document: bool = True) -> List[str]:
+        """Text of pages first_page through last_page, inclusive and clamped to the end of the document."""
+        with self._lock:
+            if any(page not in self.pages for page in self._page_range(first_page, last_page)):
+                if whole_document:
+                    self._extract()
+                else:
+                    self._extract(first_page, last_page)
+            return [self.pages[page] for page in self._page_range(first_page, last_page) if page in self.pages]
+
+    def _page_range(self, first_page: int, last_page: int) -> range:
+        if self.num_pages is not None:
+            last_page = min(last_page, self.num_pages)
+        return range(first_page, last_page + 1)
+
+    def _extract(self, first_page: Optional[int] = None, last_page: Optional[int] = None) -> None:
+        command = ["pdftotext"]
+        if first_page is not None and last_page is not None:
+            command += ["-f", str(first_page), "-l", str(last_page)]
+        command += [self.local_pdf_path, "-"]
+
+        self.subprocess_runs += 1
+        result = subprocess.run(
+            command,
+            timeout=self.WHOLE_DOCUMENT_TIMEOUT if first_page is None else self.PAGE_RANGE_TIMEOUT,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        if result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, command, result.stdout, result.stderr)
+
+        # Every page ends in a form feed, so the last piece is what follows the final page
+        page_texts = result.stdout.decode("utf-8").split("\f")[:-1]
+        start = first_page if first_page is not None else 1
+        for index, text in enumerate(page_texts):
+            self.pages[start + index] = text + "\f"
+
+        if first_page is None or last_page is None or len(page_texts) < last_page - first_page + 1:
+            self.num_pages = start + len(page_texts) - 1
+
+
 def _get_pdftotext(local_pdf_path: str, page: int) -> str:
     pdftotext_result = subprocess.run(
         ["pdftotext", "-f", str(page), "-l", str(page), local_pdf_path, "-"],
@@ -6,45 +6,70 @@ import unittest
 
 
 class RepeatDetector:
+    """
+    Counts how many times each n-gram at the end of the text repeats back to back, with whitespace runs collapsed to a
+    single space. Text is normalized and counted as it is added, so checking after every chunk of a stream stays cheap.
+    """
+
     def __init__(self, max_ngram_size: int = 10):
         self.max_ngram_size = max_ngram_size
         self.data = ""
 
+        # Length of the normalized text, and just enough of its end to compare new letters against
+        self._length = 0
+        self._tail = ""
+
+        # For each n-gram size n, how many letters at the end of the normalized text equal the letter n before them
+        self._trailing_matches = [0] * max_ngram_size
+
     def add_letters(self, new_str: str):
         self.data += new_str
 
-    def ngram_repeats(self) -> list[int]:
-        result = [0] * self.max_ngram_size
-
-        if not self.data:
-            return result
+        text = re.sub(r"\s+", " ", new_str)
+        if text.startswith(" ") and self._tail.endswith(" "):
+            text = text[1:]
+        if not text:
+            return
 
-        # Normalize all whitespace to single spaces
-        text = re.sub(r"\s+", " ", self.data)
+        buffer = self._tail + text
+        start = len(self._tail)
+        end = len(buffer)
 
-        # For each n-gram size
         for size in range(1, self.max_ngram_size + 1):
-            if len(text) < size:
-                continue
-
-            # Get the last n-gram
-            target = text[-size:]
-
-            # Count backwards from the end to find repeats
-            count = 0
-            pos = len(text) - size  # Start position for previous n-gram
+            # Only letters with another letter size positions before them can match
+            comparable = min(end - start, end - size)
+            if comparable <= 0:
+                self._trailing_matches[size - 1] = 0
+            elif comparable == end - start and buffer[start:] == buffer[start - size : end - size]:
+                self._trailing_matches[size - 1] += comparable
+            else:
+                # The matching suffix only grows as it gets shorter, so binary search for the longest one
+                lo, hi = 0, comparable
+                while lo < hi:
+                    mid = (lo + hi + 1) // 2
+                    if buffer[end - mid :] == buffer[end - mid - size : end - size]:
+                        lo = mid
+                    else:
+                        hi = mid - 1
+                self._trailing_matches[size - 1] = lo
+
+        self._length += len(text)
+        self._tail = buffer[-self.max_ngram_size :]
 
-            while pos >= 0:
-                if text[pos : pos + size] == target:
-                    count += 1
-                    pos -= size  # Move back by the size of the n-gram
-                else:
-                    break
+    def ngram_repeats(self) -> list[int]:
+        result = [0] * self.max_ngram_size
 
-            result[size - 1] = count
+        # The last n-gram repeats once, plus once more for every size letters that match the ones size before them
+        for size in range(1, self.max_ngram_size + 1):
+            if self._length >= size:
+                result[size - 1] = self._trailing_matches[size - 1] // size + 1
 
         return result
 
+    def repeated_span(self, min_repeats: int = 2) -> int:
+        """Length of the longest normalized text at the end made of at least min_repeats copies of one n-gram, 0 if there is none."""
+        return max((count * size for size, count in enumerate(self.ngram_repeats(), start=1) if count >= min_repeats), default=0)
+
 
 class RepeatDetectorTest(unittest.TestCase):
     def test_basicTest1(self):
@@ -151,6 +176,51 @@ class RepeatDetectorTest(unittest.TestCase):
         d.add_letters("ababababab")
         self.assertEqual(d.ngram_repeats(), [1, 5, 1, 2])
 
+    def test_whitespace_is_normalized_across_additions(self):
+        d = RepeatDetector(max_ngram_size=4)
+        for chunk in ["ab ", " \n", "ab\t", "\t ab", " "]:
+            d.add_letters(chunk)
+        self.assertEqual(d.ngram_repeats(), [1, 1, 3, 1])
+
+    def test_streamed_chunks_match_single_addition(self):
+        random.seed(7)
+        for _ in range(200):
+            data = "".join(random.choices("ab \n", k=random.randint(0, 60)))
+            whole = RepeatDetector(max_ngram_size=6)
+            whole.add_letters(data)
+
+            streamed = RepeatDetector(max_ngram_size=6)
+            pos = 0
+            while pos < len(data):
+                step = random.randint(1, 8)
+                streamed.add_letters(data[pos : pos + step])
+                pos += step
+                self.assertEqual(streamed.ngram_repeats(), self._reference_repeats(data[:pos], 6))
+
+            self.assertEqual(whole.ngram_repeats(), self._reference_repeats(data, 6))
+
+    def test_repeated_span(self):
+        d = RepeatDetector(max_ngram_size=8)
+        d.add_letters("Intro text. ")
+        self.assertEqual(d.repeated_span(min_repeats=3), 0)
+        d.add_letters("| 0 | " * 30)
+        self.assertEqual(d.repeated_span(min_repeats=3), len("| 0 | ") * 30)
+
+    @staticmethod
+    def _reference_repeats(data: str, max_ngram_size: int) -> list[int]:
+        """Counts repeats the slow way, by walking back from the end of the fully normalized text"""
+        text = re.sub(r"\s+", " ", data)
+        result = [0] * max_ngram_size
+        for size in range(1, max_ngram_size + 1):
+            if len(text) < size:
+                continue
+            target = text[-size:]
+            pos = len(text) - size
+            while pos >= 0 and text[pos : pos + size] == target:
+                result[size - 1] += 1
+                pos -= size
+        return result
+
 
 class BenchmarkRepeatDetect(unittest.TestCase):
     def testLargeRandom(self):
@@ -0,0 +1,198 @@
+import abc
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, Optional
+
+from botocore.exceptions import ClientError
+
+from olmocr.s3_utils import parse_s3_path
+
+logger = logging.getLogger(__name__)
+
+
+def page_result_cache_key(image_bytes: bytes, prompt: str, model: str, target_longest_image_dim: int) -> str:
+    """
+    Content address of a page result: the exact render sent to the model, and everything else that goes into the request
+    and affects its output. The same page inside different PDFs, workspaces or runs renders to the same bytes.
+    """
+    h = hashlib.sha256()
+    for part in (hashlib.sha256(prompt.encode()).digest(), model.encode(), str(target_longest_image_dim).encode()):
+        h.update(part)
+        h.update(b"\0")
+    h.update(image_bytes)
+    return h.hexdigest()
+
+
+class PageResultCache(abc.ABC):
+    """
+    Cache of parsed page results from one model, keyed by page_result_cache_key. Values are json-serializable dicts.
+
+    Methods are blocking, the pipeline calls them from threads.
+    """
+
+    def __init__(self, model: str, ttl_secs: Optional[float] = None):
+        self.model = model
+        self.ttl_secs = ttl_secs
+        self.stats: Counter = Counter()
+        self._stats_lock = threading.Lock()
+
+    def _count(self, stat: str, value: int = 1) -> None:
+        with self._stats_lock:
+            self.stats[stat] += value
+
+    def key(self, image_bytes: bytes, prompt: str, target_longest_image_dim: int) -> str:
+        return page_result_cache_key(image_bytes, prompt, self.model, target_longest_image_dim)
+
+    def is_expired(self, created: float) -> bool:
+        return self.ttl_secs is not None and time.time() - created > self.ttl_secs
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = self._get(key)
+        self._count("hits" if value is not None else "misses")
+        return value
+
+    def put(self, key: str, value: Dict[str, Any]) -> None:
+        self._put(key, value)
+        self._count("puts")
+
+    @abc.abstractmethod
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        """The cached value, or None if the key is missing or expired."""
+        pass
+
+    @abc.abstractmethod
+    def _put(self, key: str, value: Dict[str, Any]) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"Page result cache: {self.stats['hits']:,} hits, {self.stats['misses']:,} misses ({self.hit_rate:.1%} hit rate), "
+            f"{self.stats['puts']:,} stored, {self.stats['expired']:,} expired, {self.stats['evicted']:,} evicted"
+        )
+
+
+class SqlitePageResultCache(PageResultCache):
+    """
+    Page result cache in a local SQLite database, which can be shared by runs and workspaces on the same machine.
+
+    Entries older than ttl_secs are treated as missing and deleted, and once there are more than max_entries,
+    the least recently used ones are evicted. Eviction runs every evict_every puts, so the table can briefly exceed max_entries.
+    """
+
+    def __init__(self, db_path: str, model: str, ttl_secs: Optional[float] = None, max_entries: Optional[int] = None, evict_every: int = 1000):
+        super().__init__(model, ttl_secs)
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self._puts_since_evict = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=60)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS page_results (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS page_results_last_used ON page_results (last_used)")
+        self.evict()
+
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT value, created FROM page_results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if self.is_expired(row[1]):
+                self._conn.execute("DELETE FROM page_results WHERE key = ?", (key,))
+                self._count("expired")
+                return None
+            self._conn.execute("UPDATE page_results SET last_used = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def _put(self, key: str, value: Dict[str, Any]) -> None:
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO page_results VALUES (?, ?, ?, ?)", (key, json.dumps(value), now, now))
+            self._puts_since_evict += 1
+            should_evict = self._puts_since_evict >= self.evict_every
+        if should_evict:
+            self.evict()
+
+    def evict(self) -> None:
+        """Deletes expired entries, and the least recently used entries beyond max_entries."""
+        with self._lock, self._conn:
+            self._puts_since_evict = 0
+            if self.ttl_secs is not None:
+                self._count("expired", self._conn.execute("DELETE FROM page_results WHERE created < ?", (time.time() - self.ttl_secs,)).rowcount)
+            if self.max_entries is not None:
+                excess = self._conn.execute("SELECT COUNT(*) FROM page_results").fetchone()[0] - self.max_entries
+                if excess > 0:
+                    self._conn.execute("DELETE FROM page_results WHERE key IN (SELECT key FROM page_results ORDER BY last_used LIMIT ?)", (excess,))
+                    self._count("evicted", excess)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM page_results").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class S3PageResultCache(PageResultCache):
+    """
+    Page result cache under an S3 prefix, which can be shared by every run and workspace that can read it.
+
+    Entries older than ttl_secs are treated as missing. Nothing is deleted by the cache itself, limit the size of the
+    prefix with a bucket lifecycle rule instead, which expires objects far more cheaply than listing them would.
+    """
+
+    def __init__(self, s3_client, prefix: str, model: str, ttl_secs: Optional[float] = None):
+        super().__init__(model, ttl_secs)
+        self.s3_client = s3_client
+        self.bucket, self.prefix = parse_s3_path(prefix.rstrip("/"))
+
+    def _object_key(self, key: str) -> str:
+        return f"{self.prefix}/{key[:2]}/{key}.json"
+
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            obj = self.s3_client.get_object(Bucket=self.bucket, Key=self._object_key(key))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+
+        entry = json.loads(obj["Body"].read())
+        if self.is_expired(entry["created"]):
+            self._count("expired")
+            return None
+        return entry["value"]
+
+    def _put(self, key: str, value: Dict[str, Any]) -> None:
+        entry = {"created": time.time(), "value": value}
+        self.s3_client.put_object(Bucket=self.bucket, Key=self._object_key(key), Body=json.dumps(entry).encode(), ContentType="application/json")
+
+
+def open_page_result_cache(location: str, model: str, s3_client=None, ttl_secs: Optional[float] = None, max_entries: Optional[int] = None) -> PageResultCache:
+    """An S3 prefix cache for s3:// locations, otherwise a SQLite database at that path."""
+    if location.startswith("s3://"):
+        if max_entries is not None:
+            logger.warning("max_entries is not enforced for S3 page result caches, use a lifecycle rule on the prefix instead")
+        return S3PageResultCache(s3_client, location, model, ttl_secs)
+    return SqlitePageResultCache(location, model, ttl_secs, max_entries)
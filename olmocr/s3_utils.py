@@ -1,13 +1,17 @@
 import base64
 import concurrent.futures
+import datetime
 import glob
+import gzip
 import hashlib
+import io
 import logging
 import os
+import shutil
 import time
 from io import BytesIO, TextIOWrapper
 from pathlib import Path
-from typing import List, Optional
+from typing import BinaryIO, Iterable, List, Optional
 from urllib.parse import urlparse
 
 import boto3
@@ -84,15 +88,43 @@ def expand_s3_glob(s3_client, s3_glob: str) -> dict[str, str]:
             raise
 
 
+def list_s3_objects_parallel(
+    s3_client, s3_prefix: str, shard_suffixes: Iterable[str] = "0123456789abcdef", max_workers: int = 16
+) -> dict[str, datetime.datetime]:
+    """
+    Lists every object under s3_prefix + suffix for each of the shard suffixes, paginating the shards in parallel.
+    The suffixes need to cover every key of interest, ex. the first hex digit of a hash.
+    Returns a dict of {'s3://bucket/key': last_modified}.
+    """
+    bucket, prefix = parse_s3_path(s3_prefix)
+
+    def list_shard(suffix: str) -> dict[str, datetime.datetime]:
+        paginator = s3_client.get_paginator("list_objects_v2")
+        return {
+            f"s3://{bucket}/{obj['Key']}": obj["LastModified"]
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix + suffix)
+            for obj in page.get("Contents", [])
+        }
+
+    listed: dict[str, datetime.datetime] = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for shard in executor.map(list_shard, shard_suffixes):
+            listed.update(shard)
+    return listed
+
+
 def get_s3_bytes(s3_client, s3_path: str, start_index: Optional[int] = None, end_index: Optional[int] = None) -> bytes:
     is_cloud_path = s3_path.startswith("s3://") or s3_path.startswith("gs://") or s3_path.startswith("weka://")
 
-    # Fall back for local files
+    # Fall back for local files, ranges follow the same inclusive end semantics as the http Range header
     if not is_cloud_path:
         if os.path.exists(s3_path):
-            assert start_index is None and end_index is None, "Range query not supported yet"
             with open(s3_path, "rb") as f:
-                return f.read()
+                if start_index is None and end_index is not None:
+                    f.seek(max(0, os.path.getsize(s3_path) - end_index))
+                    return f.read()
+                f.seek(start_index or 0)
+                return f.read() if end_index is None else f.read(end_index - (start_index or 0) + 1)
         else:
             logger.error(f"Could not find local file {s3_path}")
             raise Exception(f"Could not find local file {s3_path}")
@@ -122,6 +154,85 @@ def get_s3_bytes(s3_client, s3_path: str, start_index: Optional[int] = None, end
     return obj["Body"].read()
 
 
+def open_s3_stream(s3_client, s3_path: str) -> BinaryIO:
+    """Opens an object or local file for reading as a non-seekable stream, without downloading it first."""
+    if not (s3_path.startswith("s3://") or s3_path.startswith("gs://") or s3_path.startswith("weka://")):
+        return open(s3_path, "rb")
+
+    bucket, key = parse_s3_path(s3_path)
+    return s3_client.get_object(Bucket=bucket, Key=key)["Body"]
+
+
+def get_s3_object_size(s3_client, s3_path: str) -> int:
+    """Size in bytes of an object or local file."""
+    if not (s3_path.startswith("s3://") or s3_path.startswith("gs://") or s3_path.startswith("weka://")):
+        return os.path.getsize(s3_path)
+
+    bucket, key = parse_s3_path(s3_path)
+    return s3_client.head_object(Bucket=bucket, Key=key)["ContentLength"]
+
+
+class S3RangeReader(io.RawIOBase):
+    """
+    Read-only, seekable file object over an object or local file, which only fetches the blocks that are actually read,
+    each with a ranged get_s3_bytes call. Lets parsers such as pypdf look at a pdf's trailer and xref without downloading it.
+    """
+
+    def __init__(self, s3_client, s3_path: str, block_size: int = 16 * 1024):
+        super().__init__()
+        self.s3_client = s3_client
+        self.s3_path = s3_path
+        self.block_size = block_size
+        self.size = get_s3_object_size(s3_client, s3_path)
+        self.position = 0
+        self.blocks: dict[int, bytes] = {}
+        self.requests = 0
+        self.bytes_fetched = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        self.position = max(0, self.position)
+        return self.position
+
+    def _get_block(self, block_index: int) -> bytes:
+        if block_index not in self.blocks:
+            start = block_index * self.block_size
+            end = min(start + self.block_size, self.size) - 1
+            self.blocks[block_index] = get_s3_bytes(self.s3_client, self.s3_path, start, end)
+            self.requests += 1
+            self.bytes_fetched += len(self.blocks[block_index])
+        return self.blocks[block_index]
+
+    def readinto(self, buffer) -> int:
+        length = min(len(buffer), max(0, self.size - self.position))
+        written = 0
+        while written < length:
+            block_index, block_offset = divmod(self.position, self.block_size)
+            chunk = self._get_block(block_index)[block_offset : block_offset + length - written]
+            if not chunk:
+                break
+            buffer[written : written + len(chunk)] = chunk
+            written += len(chunk)
+            self.position += len(chunk)
+        return written
+
+
 def get_s3_bytes_with_backoff(s3_client, pdf_s3_path, max_retries: int = 8, backoff_factor: int = 2):
     attempt = 0
 
@@ -148,6 +259,50 @@ def get_s3_bytes_with_backoff(s3_client, pdf_s3_path, max_retries: int = 8, back
     raise Exception("Failed to get_s3_bytes after retries")
 
 
+def download_s3_file(
+    s3_client,
+    s3_path: str,
+    local_path: str,
+    multipart_threshold: int = 64 * 1024 * 1024,
+    max_concurrency: int = 8,
+    max_retries: int = 8,
+    backoff_factor: int = 2,
+) -> None:
+    """
+    Downloads an object or local file to local_path, streaming it to disk instead of holding it in memory.
+    Objects above multipart_threshold are fetched with up to max_concurrency parallel ranged GETs, which share the client's connection pool.
+    """
+    if not (s3_path.startswith("s3://") or s3_path.startswith("gs://") or s3_path.startswith("weka://")):
+        shutil.copyfile(s3_path, local_path)
+        return
+
+    bucket, key = parse_s3_path(s3_path)
+    transfer_config = TransferConfig(
+        multipart_threshold=multipart_threshold, multipart_chunksize=16 * 1024 * 1024, max_concurrency=max_concurrency, use_threads=True
+    )
+
+    for attempt in range(max_retries):
+        try:
+            with open(local_path, "wb") as f:
+                s3_client.download_fileobj(bucket, key, f, Config=transfer_config)
+            return
+        except ClientError as e:
+            # Missing objects show up as a 404 from the HeadObject call that sizes the download
+            if e.response["Error"]["Code"] in ("AccessDenied", "NoSuchKey", "403", "404"):
+                logger.error(f"{e.response['Error']['Code']} error when trying to download {s3_path}: {e}")
+                raise
+            wait_time = backoff_factor**attempt
+            logger.warning(f"Attempt {attempt+1} failed to download {s3_path}: {e}. Retrying in {wait_time} seconds...")
+            time.sleep(wait_time)
+        except Exception as e:
+            wait_time = backoff_factor**attempt
+            logger.warning(f"Attempt {attempt+1} failed to download {s3_path}: {e}. Retrying in {wait_time} seconds...")
+            time.sleep(wait_time)
+
+    logger.error(f"Failed to download {s3_path} after {max_retries} retries.")
+    raise Exception("Failed to download_s3_file after retries")
+
+
 def put_s3_bytes(s3_client, s3_path: str, data: bytes):
     bucket, key = parse_s3_path(s3_path)
 
@@ -160,6 +315,19 @@ def parse_custom_id(custom_id: str) -> tuple[str, int]:
     return s3_path, page_num
 
 
+# Extensions of the results/output_*.jsonl files of a workspace, plain or compressed by --output_compression
+RESULTS_FILE_EXTENSIONS = (".jsonl", ".jsonl.zst", ".jsonl.gz")
+
+
+def decode_output_lines(path: str, data: bytes) -> list[str]:
+    """Lines of a results/output_*.jsonl file, with any compression removed according to its extension."""
+    if path.endswith(".zst"):
+        data = zstd.ZstdDecompressor().stream_reader(data, read_across_frames=True).read()
+    elif path.endswith(".gz"):
+        data = gzip.decompress(data)
+    return data.decode("utf-8").splitlines()
+
+
 def download_zstd_csv(s3_client, s3_path):
     """Download and decompress a .zstd CSV file from S3."""
     try:
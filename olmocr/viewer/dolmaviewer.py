@@ -14,7 +14,12 @@ from jinja2 import Template
 from tqdm import tqdm
 
 from olmocr.data.renderpdf import render_pdf_to_base64webp
-from olmocr.s3_utils import get_s3_bytes, parse_s3_path
+from olmocr.s3_utils import (
+    RESULTS_FILE_EXTENSIONS,
+    decode_output_lines,
+    get_s3_bytes,
+    parse_s3_path,
+)
 
 
 def get_pdf_bytes_from_source(s3_client, source_file):
@@ -55,12 +60,12 @@ def get_pdf_bytes_from_source(s3_client, source_file):
 def read_jsonl(paths):
     """
     Generator that yields lines from multiple JSONL files.
-    Supports both local and S3 paths.
+    Supports both local and S3 paths, and the compressed results files of the pipeline.
     """
     for path in paths:
         try:
-            with smart_open.smart_open(path, "r", encoding="utf-8") as f:
-                for line in f:
+            with smart_open.open(path, "rb", compression="disable") as f:
+                for line in decode_output_lines(path, f.read()):
                     yield line.strip()
         except Exception as e:
             print(f"Error reading {path}: {e}")
@@ -305,8 +310,9 @@ def main(jsonl_paths, output_dir, template_path, s3_profile_name, merge=False):
 
                     # Create output filename based on JSONL filename
                     jsonl_basename = os.path.basename(jsonl_path)
-                    if jsonl_basename.endswith(".jsonl"):
-                        output_filename = jsonl_basename[:-6] + "_merged.html"
+                    extension = next((ext for ext in RESULTS_FILE_EXTENSIONS if jsonl_basename.endswith(ext)), None)
+                    if extension:
+                        output_filename = jsonl_basename[: -len(extension)] + "_merged.html"
                     else:
                         output_filename = jsonl_basename + "_merged.html"
 
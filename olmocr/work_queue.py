@@ -1,21 +1,27 @@
 import abc
 import asyncio
+import contextlib
 import csv
 import datetime
+import fcntl
 import hashlib
+import heapq
 import io
+import json
 import logging
+import math
 import os
 import random
+import socket
 from asyncio import Queue, QueueEmpty
 from dataclasses import dataclass
-from typing import Any, Dict, List, Optional, Set
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 import zstandard
 
 from olmocr.s3_utils import (
     download_zstd_csv,
-    expand_s3_glob,
+    list_s3_objects_parallel,
     parse_s3_path,
     upload_zstd_csv,
 )
@@ -26,6 +32,66 @@ logger = logging.getLogger(__name__)
 WORKER_LOCKS_DIR = "worker_locks"
 DONE_FLAGS_DIR = "done_flags"
 
+# A worker lock is stale once it goes this long without being written. Workers rewrite the locks they hold every heartbeat,
+# so the last modified time of a lock is its last heartbeat rather than when its item was claimed
+WORKER_LOCK_TIMEOUT_SECS = 1800
+
+# Large documents can be split into page range shards that are queued as separate work items,
+# ex. s3://bucket/big.pdf::pages=1-500, with the range inclusive and 1-indexed like page numbers everywhere else.
+# The last shard is open ended, ex. s3://bucket/big.pdf::pages=501-, so it picks up any pages a page count missed
+PAGE_RANGE_SEPARATOR = "::pages="
+
+# Index rows are the group hash followed by its paths, optionally followed by an empty column and the page count of each path
+INDEX_PAGE_COUNTS_SEPARATOR = ""
+
+# The index is split into shard files by the first hex digit of the group hash. Each populate_queue call appends new
+# shard files and lists them in the manifest, whose rows are the shard file name and its number of items, existing
+# shards are never rewritten. Workspaces from before sharding have a single index file, which is read as one shard.
+INDEX_DIR = "work_index"
+INDEX_MANIFEST = f"{INDEX_DIR}/manifest.csv.zstd"
+LEGACY_INDEX = "work_index_list.csv.zstd"
+
+# With content deduplication, each row is a content hash, the canonical path that gets queued for it, then the paths of its
+# byte-identical duplicates, which are never queued and get their output from the canonical path's result instead
+DUPLICATES_INDEX = f"{INDEX_DIR}/duplicates.csv.zstd"
+
+
+def make_page_range_path(path: str, first_page: int, last_page: Optional[int]) -> str:
+    """Work path for pages first_page through last_page of path, or through the end of the document if last_page is None."""
+    return f"{path}{PAGE_RANGE_SEPARATOR}{first_page}-{last_page if last_page is not None else ''}"
+
+
+def parse_page_range_path(work_path: str) -> Tuple[str, Optional[Tuple[int, Optional[int]]]]:
+    """Splits a work path into the document path and its page range, which is None for whole documents."""
+    path, sep, page_range = work_path.rpartition(PAGE_RANGE_SEPARATOR)
+    if not sep:
+        return work_path, None
+    first_page, _, last_page = page_range.partition("-")
+    if not first_page.isdigit() or not (last_page.isdigit() or last_page == ""):
+        return work_path, None
+    return path, (int(first_page), int(last_page) if last_page else None)
+
+
+def pack_paths_by_pages(paths: List[str], page_counts: Dict[str, int], pages_per_group: int) -> List[List[str]]:
+    """
+    Bin-packs paths into groups of about pages_per_group pages each, placing the longest documents first, each into
+    the group with the fewest pages so far. Paths without a known page count are assumed to be of average length.
+    """
+    known_counts = [page_counts[p] for p in paths if p in page_counts]
+    default_count = round(sum(known_counts) / len(known_counts)) if known_counts else 1
+    sizes = {p: max(1, page_counts.get(p, default_count)) for p in paths}
+
+    num_groups = max(1, math.ceil(sum(sizes.values()) / pages_per_group))
+    heap = [(0, index) for index in range(num_groups)]
+    groups: List[List[str]] = [[] for _ in range(num_groups)]
+
+    for path in sorted(paths, key=lambda p: (-sizes[p], p)):
+        pages, index = heapq.heappop(heap)
+        groups[index].append(path)
+        heapq.heappush(heap, (pages + sizes[path], index))
+
+    return [group for group in groups if group]
+
 
 @dataclass
 class WorkItem:
@@ -33,19 +99,20 @@ class WorkItem:
 
     hash: str
     work_paths: List[str]
+    page_counts: Optional[List[int]] = None
 
 
 class Backend(abc.ABC):
     """Abstract backend for storage operations."""
 
     @abc.abstractmethod
-    async def load_index_lines(self) -> List[str]:
-        """Load raw index lines from storage."""
+    async def load_index_lines(self, name: str = LEGACY_INDEX) -> List[str]:
+        """Load raw lines of an index file, relative to the workspace, from storage."""
         pass
 
     @abc.abstractmethod
-    async def save_index_lines(self, lines: List[str]) -> None:
-        """Save raw index lines to storage."""
+    async def save_index_lines(self, lines: List[str], name: str = LEGACY_INDEX) -> None:
+        """Save raw lines of an index file, relative to the workspace, to storage."""
         pass
 
     @abc.abstractmethod
@@ -53,19 +120,37 @@ class Backend(abc.ABC):
         """Get set of completed work hashes."""
         pass
 
+    @abc.abstractmethod
+    async def get_worker_locks(self) -> Dict[str, datetime.datetime]:
+        """Get the last modified time of every worker lock, by work hash."""
+        pass
+
     @abc.abstractmethod
     async def is_completed(self, work_hash: str) -> bool:
         """Check if a work item has been completed."""
         pass
 
     @abc.abstractmethod
-    async def is_worker_lock_taken(self, work_hash: str, worker_lock_timeout_secs: int = 1800) -> bool:
+    async def is_worker_lock_taken(self, work_hash: str, worker_lock_timeout_secs: int = WORKER_LOCK_TIMEOUT_SECS) -> bool:
         """Check if a worker lock is taken and not stale."""
         pass
 
     @abc.abstractmethod
-    async def create_worker_lock(self, work_hash: str) -> None:
-        """Create a worker lock for a work hash."""
+    async def read_worker_lock(self, work_hash: str) -> Optional[Tuple[bytes, str]]:
+        """Read the body of the worker lock for a work hash and its version for replace_worker_lock, None if there is no lock."""
+        pass
+
+    @abc.abstractmethod
+    async def replace_worker_lock(self, work_hash: str, body: bytes, version: Optional[str]) -> bool:
+        """
+        Overwrite the worker lock for a work hash only if it is still at the version that was read, or still doesn't exist
+        for a version of None. Returns whether it was written.
+        """
+        pass
+
+    @abc.abstractmethod
+    async def create_worker_lock(self, work_hash: str, body: bytes = b"") -> None:
+        """Create or overwrite the worker lock for a work hash."""
         pass
 
     @abc.abstractmethod
@@ -84,11 +169,22 @@ class WorkQueue:
     Manages a work queue with pluggable storage backends (e.g., local or S3).
     """
 
-    def __init__(self, backend: Backend):
+    def __init__(self, backend: Backend, replica_id: Optional[str] = None):
         self.backend = backend
+        self.replica_id = replica_id or f"{socket.gethostname()}-{os.getpid()}"
         self._queue: Queue[WorkItem] = Queue()
         self._completed_hash_cache = set()
 
+        # Snapshot of all worker locks, listed in bulk by refresh_snapshot() along with the completed hashes, so that
+        # get_work can skip done and locked items without any requests, and only confirm the item it is about to claim
+        self._lock_snapshot: Dict[str, datetime.datetime] = {}
+        self._has_snapshot = False
+
+        # Index shards not loaded into the queue yet, with their item counts, get_work loads them one at a time
+        self._pending_shards: List[Tuple[str, int]] = []
+        self._pending_items = 0
+        self._shard_load_lock = asyncio.Lock()
+
     @staticmethod
     def _encode_csv_row(row: List[str]) -> str:
         """Encodes a row of data for CSV storage with proper escaping."""
@@ -110,78 +206,247 @@ class WorkQueue:
             sha1.update(path.encode("utf-8"))
         return sha1.hexdigest()
 
-    def _parse_index_lines(self, lines: List[str]) -> Dict[str, List[str]]:
-        """Parse index lines into a dict of hash to paths."""
+    @staticmethod
+    def _decode_index_row(line: str) -> Optional[WorkItem]:
+        """Decodes an index row into its work item, None for blank rows."""
+        parts = WorkQueue._decode_csv_row(line)
+        if not parts:
+            return None
+        if INDEX_PAGE_COUNTS_SEPARATOR in parts[1:]:
+            separator_index = parts.index(INDEX_PAGE_COUNTS_SEPARATOR, 1)
+            return WorkItem(hash=parts[0], work_paths=parts[1:separator_index], page_counts=[int(c) for c in parts[separator_index + 1 :]])
+        return WorkItem(hash=parts[0], work_paths=parts[1:])
+
+    @staticmethod
+    def _encode_index_row(work_item: WorkItem) -> str:
+        """Encodes a work item as an index row, with its page counts if it has them."""
+        row = [work_item.hash] + work_item.work_paths
+        if work_item.page_counts is not None:
+            row += [INDEX_PAGE_COUNTS_SEPARATOR] + [str(c) for c in work_item.page_counts]
+        return WorkQueue._encode_csv_row(row)
+
+    def _parse_index_lines(self, lines: List[str]) -> Dict[str, WorkItem]:
+        """Parse index lines into a dict of hash to work item."""
         result = {}
         for line in lines:
             if line.strip():
-                parts = self._decode_csv_row(line)
-                if parts:
-                    result[parts[0]] = parts[1:]
+                work_item = self._decode_index_row(line)
+                if work_item:
+                    result[work_item.hash] = work_item
         return result
 
-    def _make_index_lines(self, groups: Dict[str, List[str]]) -> List[str]:
+    def _make_index_lines(self, groups: Dict[str, WorkItem]) -> List[str]:
         """Create encoded lines from groups dict."""
-        return [self._encode_csv_row([group_hash] + group_paths) for group_hash, group_paths in groups.items()]
-
-    async def populate_queue(self, work_paths: List[str], items_per_group: int) -> None:
+        return [self._encode_index_row(work_item) for work_item in groups.values()]
+
+    def _make_work_item(self, group: List[str], page_counts: Optional[Dict[str, int]]) -> WorkItem:
+        counts = None
+        if page_counts is not None and all(p in page_counts for p in group):
+            counts = [page_counts[p] for p in group]
+        return WorkItem(hash=self._compute_workgroup_hash(group), work_paths=group, page_counts=counts)
+
+    async def populate_queue(
+        self,
+        work_paths: List[str],
+        items_per_group: int,
+        page_counts: Optional[Dict[str, int]] = None,
+        max_pages_per_item: Optional[int] = None,
+        pages_per_group: Optional[int] = None,
+    ) -> None:
         """
         Add new items to the work queue.
+
+        With page_counts and pages_per_group, paths are bin-packed into groups of about pages_per_group pages, otherwise
+        they are chunked into groups of items_per_group. Documents known to have more than max_pages_per_item pages are
+        split into page range shards, each of which becomes its own work item. Known page counts are kept in the index.
         """
-        all_paths = set(work_paths)
+        new_path_set = set(work_paths)
 
-        lines = await self.backend.load_index_lines()
-        existing_groups = self._parse_index_lines(lines)
+        # Stream through the existing shards one at a time, so only the new paths are ever held in memory
+        manifest = await self._load_manifest()
+        for name, _ in manifest:
+            for work_item in self._parse_index_lines(await self.backend.load_index_lines(name)).values():
+                new_path_set.difference_update(parse_page_range_path(p)[0] for p in work_item.work_paths)
+            if not new_path_set:
+                return
 
-        existing_path_set = {p for paths in existing_groups.values() for p in paths}
-        new_paths = sorted(all_paths - existing_path_set)
+        new_paths = sorted(new_path_set)
 
         if not new_paths:
             return
 
-        new_groups = []
-        for i in range(0, len(new_paths), items_per_group):
-            group = new_paths[i : i + items_per_group]
-            group_hash = self._compute_workgroup_hash(group)
-            new_groups.append((group_hash, group))
-
-        combined_groups = {**existing_groups, **dict(new_groups)}
-        combined_lines = self._make_index_lines(combined_groups)
-
-        await self.backend.save_index_lines(combined_lines)
+        new_items = []
+        if page_counts and max_pages_per_item:
+            sharded_paths = [p for p in new_paths if page_counts.get(p, 0) > max_pages_per_item]
+            for path in sharded_paths:
+                for first_page in range(1, page_counts[path] + 1, max_pages_per_item):
+                    last_page = first_page + max_pages_per_item - 1
+                    shard = make_page_range_path(path, first_page, last_page if last_page < page_counts[path] else None)
+                    shard_pages = min(last_page, page_counts[path]) - first_page + 1
+                    new_items.append(self._make_work_item([shard], {shard: shard_pages}))
+
+            if sharded_paths:
+                logger.info(f"Split {len(sharded_paths):,} documents longer than {max_pages_per_item:,} pages into {len(new_items):,} page range work items")
+                sharded_set = set(sharded_paths)
+                new_paths = [p for p in new_paths if p not in sharded_set]
+
+        if page_counts and pages_per_group and new_paths:
+            groups = pack_paths_by_pages(new_paths, page_counts, pages_per_group)
+        else:
+            groups = [new_paths[i : i + items_per_group] for i in range(0, len(new_paths), items_per_group)]
+
+        new_items.extend(self._make_work_item(group, page_counts) for group in groups)
+
+        # Write the new shards before the manifest, so the manifest never lists a shard that doesn't exist
+        shards_by_prefix: Dict[str, Dict[str, WorkItem]] = {}
+        for work_item in new_items:
+            shards_by_prefix.setdefault(work_item.hash[0], {})[work_item.hash] = work_item
+
+        batch_id = f"{datetime.datetime.now(datetime.timezone.utc):%Y%m%dT%H%M%S}_{os.urandom(4).hex()}"
+        new_shards = []
+        for prefix, shard_items in sorted(shards_by_prefix.items()):
+            name = f"{INDEX_DIR}/{prefix}/{batch_id}.csv.zstd"
+            await self.backend.save_index_lines(self._make_index_lines(shard_items), name)
+            new_shards.append((name, len(shard_items)))
+
+        manifest += new_shards
+        await self.backend.save_index_lines([self._encode_csv_row([name, str(count)]) for name, count in manifest], INDEX_MANIFEST)
+        logger.info(f"Appended {len(new_items):,} work items to the index in {len(new_shards):,} shards")
+
+    async def dedupe_by_content(self, content_hashes: Dict[str, str]) -> Tuple[Set[str], Dict[str, List[str]]]:
+        """
+        Picks one canonical path per content hash, and records the others as its duplicates in the workspace.
+        Hashes seen by earlier calls keep their canonical path. Returns the canonical paths, which are the ones to queue, and
+        the new duplicates of canonical paths recorded by earlier calls, by canonical path, since those may already be done.
+        """
+        rows = {row[0]: row[1:] for row in map(self._decode_csv_row, await self.backend.load_index_lines(DUPLICATES_INDEX)) if row}
+
+        paths_by_hash: Dict[str, Set[str]] = {}
+        for path, content_hash in content_hashes.items():
+            paths_by_hash.setdefault(content_hash, set()).add(path)
+
+        canonical_paths = set()
+        late_duplicates: Dict[str, List[str]] = {}
+        num_new_duplicates = 0
+        for content_hash, paths in paths_by_hash.items():
+            canonical, *duplicates = rows.get(content_hash) or [min(paths)]
+            new_duplicates = paths - {canonical} - set(duplicates)
+            if content_hash in rows and new_duplicates:
+                late_duplicates[canonical] = sorted(new_duplicates)
+            rows[content_hash] = [canonical, *duplicates, *sorted(new_duplicates)]
+            canonical_paths.add(canonical)
+            num_new_duplicates += len(new_duplicates)
+
+        await self.backend.save_index_lines([self._encode_csv_row([content_hash, *paths]) for content_hash, paths in rows.items()], DUPLICATES_INDEX)
+        logger.info(f"Found {num_new_duplicates:,} new duplicates of {len(canonical_paths):,} distinct documents")
+        return canonical_paths, late_duplicates
+
+    async def load_duplicates(self) -> Dict[str, List[str]]:
+        """Loads the duplicates recorded by dedupe_by_content, as a dict of canonical path to the paths of its duplicates."""
+        duplicates = {}
+        for row in map(self._decode_csv_row, await self.backend.load_index_lines(DUPLICATES_INDEX)):
+            if len(row) > 2:
+                duplicates[row[1]] = row[2:]
+        return duplicates
+
+    async def _load_manifest(self) -> List[Tuple[str, int]]:
+        """Lists the index shards and their item counts, a legacy single file index counts as one shard."""
+        lines = await self.backend.load_index_lines(INDEX_MANIFEST)
+        if lines:
+            return [(row[0], int(row[1])) for row in map(self._decode_csv_row, lines) if row]
+
+        legacy_lines = await self.backend.load_index_lines(LEGACY_INDEX)
+        if legacy_lines:
+            return [(LEGACY_INDEX, len(self._parse_index_lines(legacy_lines)))]
+        return []
+
+    async def load_all_items(self) -> Dict[str, WorkItem]:
+        """Loads every shard of the index into a dict of hash to work item."""
+        work_items = {}
+        for name, _ in await self._load_manifest():
+            work_items.update(self._parse_index_lines(await self.backend.load_index_lines(name)))
+        return work_items
+
+    async def get_completed_paths(self, paths: Set[str]) -> Dict[str, List[str]]:
+        """Finds which of the given paths have been processed, as a dict of path to the hashes of the done work items covering it."""
+        completed_hashes = await self.backend.get_completed_hashes()
+        hashes_by_path: Dict[str, List[str]] = {}
+        for work_item in (await self.load_all_items()).values():
+            for work_path in work_item.work_paths:
+                path = parse_page_range_path(work_path)[0]
+                if path in paths:
+                    hashes_by_path.setdefault(path, []).append(work_item.hash)
+        return {path: hashes for path, hashes in hashes_by_path.items() if all(h in completed_hashes for h in hashes)}
 
     async def initialize_queue(self) -> int:
         """
         Load the work queue and initialize it for processing.
-        Removes already completed work items and randomizes the order.
+        Index shards are loaded lazily in random order, each with its completed items removed and its order randomized.
+        Returns the number of remaining work items, counting every item of the shards that aren't loaded yet.
         """
-        lines = await self.backend.load_index_lines()
-        work_queue = self._parse_index_lines(lines)
-
-        done_hashes = await self.backend.get_completed_hashes()
+        manifest = await self._load_manifest()
+        num_shards = len(manifest)
+        random.shuffle(manifest)
 
-        remaining_hashes = set(work_queue) - done_hashes
-        remaining_items = [WorkItem(hash=h, work_paths=work_queue[h]) for h in remaining_hashes]
-        random.shuffle(remaining_items)
+        await self.refresh_snapshot()
 
         self._queue = Queue()
-        for item in remaining_items:
-            await self._queue.put(item)
+        self._pending_shards = manifest
+        self._pending_items = sum(count for _, count in manifest)
+        await self._load_pending_shards()
 
-        logger.info(f"Initialized queue with {self.size:,} work items")
+        logger.info(f"Initialized queue with {self.size:,} work items, {len(self._pending_shards):,} of {num_shards:,} index shards not loaded yet")
         return self.size
 
-    async def get_work(self, worker_lock_timeout_secs: int = 1800) -> Optional[WorkItem]:
+    async def _load_pending_shards(self) -> bool:
+        """Loads shards until the queue has work or none are left, returns whether there is work."""
+        async with self._shard_load_lock:
+            while self._queue.empty() and self._pending_shards:
+                name, count = self._pending_shards.pop()
+                work_items = self._parse_index_lines(await self.backend.load_index_lines(name))
+                self._pending_items -= count
+
+                remaining_items = [item for work_hash, item in work_items.items() if work_hash not in self._completed_hash_cache]
+                random.shuffle(remaining_items)
+                for item in remaining_items:
+                    self._queue.put_nowait(item)
+                logger.debug(f"Loaded index shard {name} with {len(remaining_items):,} of {len(work_items):,} items remaining")
+
+            return not self._queue.empty()
+
+    async def refresh_snapshot(self) -> None:
+        """Lists all done flags and worker locks in bulk."""
+        completed_hashes, worker_locks = await asyncio.gather(self.backend.get_completed_hashes(), self.backend.get_worker_locks())
+        self._completed_hash_cache = completed_hashes
+        self._lock_snapshot = worker_locks
+        self._has_snapshot = True
+        logger.debug(f"Work queue snapshot has {len(completed_hashes):,} completed items and {len(worker_locks):,} worker locks")
+
+    async def run_prefetcher(self, interval_secs: float = 300) -> None:
+        """Refreshes the snapshot every interval_secs, jittered so replicas don't list at the same time. Run as a background task."""
+        while True:
+            await asyncio.sleep(interval_secs * random.uniform(0.75, 1.25))
+            try:
+                await self.refresh_snapshot()
+            except Exception as e:
+                logger.warning(f"Failed to refresh work queue snapshot: {e}")
+
+    def _locked_in_snapshot(self, work_hash: str, worker_lock_timeout_secs: int) -> bool:
+        lock_mtime = self._lock_snapshot.get(work_hash)
+        if lock_mtime is None:
+            return False
+        return (datetime.datetime.now(datetime.timezone.utc) - lock_mtime).total_seconds() <= worker_lock_timeout_secs
+
+    async def get_work(self, worker_lock_timeout_secs: int = WORKER_LOCK_TIMEOUT_SECS) -> Optional[WorkItem]:
         """
         Get the next available work item that isn't completed or locked.
         """
-        REFRESH_COMPLETED_HASH_CACHE_MAX_ATTEMPTS = 3
-        refresh_completed_hash_attempt = 0
-
         while True:
             try:
                 work_item = self._queue.get_nowait()
             except QueueEmpty:
+                if await self._load_pending_shards():
+                    continue
                 return None
 
             if work_item.hash in self._completed_hash_cache:
@@ -189,17 +454,15 @@ class WorkQueue:
                 self._queue.task_done()
                 continue
 
+            if self._has_snapshot and self._locked_in_snapshot(work_item.hash, worker_lock_timeout_secs):
+                logger.debug(f"Work item {work_item.hash} is locked by another worker (snapshot hit), skipping")
+                self._queue.task_done()
+                continue
+
+            # Confirm the item is still free, it may have been claimed or finished since the last snapshot
             if await self.backend.is_completed(work_item.hash):
                 logger.debug(f"Work item {work_item.hash} already completed, skipping")
                 self._queue.task_done()
-
-                refresh_completed_hash_attempt += 1
-
-                if refresh_completed_hash_attempt >= REFRESH_COMPLETED_HASH_CACHE_MAX_ATTEMPTS:
-                    logger.info(f"More than {REFRESH_COMPLETED_HASH_CACHE_MAX_ATTEMPTS} queue items already done, refreshing local completed cache fully")
-                    self._completed_hash_cache = await self.backend.get_completed_hashes()
-                    refresh_completed_hash_attempt = 0
-
                 continue
 
             if await self.backend.is_worker_lock_taken(work_item.hash, worker_lock_timeout_secs):
@@ -209,21 +472,55 @@ class WorkQueue:
 
             # Create lock (overwrites if stale)
             try:
-                await self.backend.create_worker_lock(work_item.hash)
+                await self._write_lock(work_item)
             except Exception as e:
                 logger.warning(f"Failed to create lock for {work_item.hash}: {e}")
                 self._queue.task_done()
                 continue
 
-            refresh_completed_hash_attempt = 0
             return work_item
 
+    def _make_lock_body(self) -> bytes:
+        # Staleness is judged by the lock's modification time, the body records who holds it
+        lock = {"replica_id": self.replica_id, "heartbeat": datetime.datetime.now(datetime.timezone.utc).isoformat()}
+        return json.dumps(lock).encode()
+
+    @staticmethod
+    def _decode_lock_owner(body: bytes) -> Optional[str]:
+        try:
+            return json.loads(body).get("replica_id") if body else None
+        except (ValueError, AttributeError):
+            return None
+
+    async def _write_lock(self, work_item: WorkItem) -> None:
+        await self.backend.create_worker_lock(work_item.hash, self._make_lock_body())
+
+    async def get_lock_owner(self, work_hash: str) -> Optional[str]:
+        """The replica_id recorded in the worker lock of a work hash, None if it has no lock or one without an owner."""
+        lock = await self.backend.read_worker_lock(work_hash)
+        return None if lock is None else self._decode_lock_owner(lock[0])
+
+    async def renew_lock(self, work_item: WorkItem) -> bool:
+        """
+        Rewrites the worker lock of an item claimed by this replica, which marks it as taken for another lock timeout.
+        Workers call this as a heartbeat for as long as they are processing the item. Returns False without renewing
+        if another replica has taken the item over since.
+
+        The rewrite is conditional on the lock being unchanged since it was read, so a replica that takes the item over
+        in between is never overwritten.
+        """
+        lock = await self.backend.read_worker_lock(work_item.hash)
+        if lock is not None and self._decode_lock_owner(lock[0]) not in (None, self.replica_id):
+            return False
+        return await self.backend.replace_worker_lock(work_item.hash, self._make_lock_body(), None if lock is None else lock[1])
+
     async def mark_done(self, work_item: WorkItem) -> None:
         """
         Mark a work item as done by removing its lock file and creating a done flag.
         """
         # Create done flag in done_flags_dir
         await self.backend.create_done_flag(work_item.hash)
+        self._completed_hash_cache.add(work_item.hash)
 
         # Remove the worker lock
         await self.backend.delete_worker_lock(work_item.hash)
@@ -231,8 +528,8 @@ class WorkQueue:
 
     @property
     def size(self) -> int:
-        """Get current size of work queue."""
-        return self._queue.qsize()
+        """Get current size of work queue, including the items of index shards that aren't loaded yet."""
+        return self._queue.qsize() + self._pending_items
 
 
 class LocalBackend(Backend):
@@ -243,7 +540,7 @@ class LocalBackend(Backend):
 
     def __init__(self, workspace_path: str):
         self.workspace_path = os.path.abspath(workspace_path)
-        self._index_path = os.path.join(self.workspace_path, "work_index_list.csv.zstd")
+        self._index_path = os.path.join(self.workspace_path, LEGACY_INDEX)
         self._done_flags_dir = os.path.join(self.workspace_path, DONE_FLAGS_DIR)
         self._locks_dir = os.path.join(self.workspace_path, WORKER_LOCKS_DIR)
 
@@ -288,11 +585,11 @@ class LocalBackend(Backend):
         with open(local_path, "wb") as f:
             f.write(compressed_data)
 
-    async def load_index_lines(self) -> List[str]:
-        return await asyncio.to_thread(self._download_zstd_csv_local, self._index_path)
+    async def load_index_lines(self, name: str = LEGACY_INDEX) -> List[str]:
+        return await asyncio.to_thread(self._download_zstd_csv_local, os.path.join(self.workspace_path, name))
 
-    async def save_index_lines(self, lines: List[str]) -> None:
-        await asyncio.to_thread(self._upload_zstd_csv_local, self._index_path, lines)
+    async def save_index_lines(self, lines: List[str], name: str = LEGACY_INDEX) -> None:
+        await asyncio.to_thread(self._upload_zstd_csv_local, os.path.join(self.workspace_path, name), lines)
 
     async def get_completed_hashes(self) -> Set[str]:
         def _list_completed() -> Set[str]:
@@ -302,6 +599,22 @@ class LocalBackend(Backend):
 
         return await asyncio.to_thread(_list_completed)
 
+    async def get_worker_locks(self) -> Dict[str, datetime.datetime]:
+        def _list_locks() -> Dict[str, datetime.datetime]:
+            if not os.path.isdir(self._locks_dir):
+                return {}
+            locks = {}
+            for f in os.listdir(self._locks_dir):
+                if f.startswith("worker_") and f.endswith(".lock"):
+                    try:
+                        mtime = os.path.getmtime(os.path.join(self._locks_dir, f))
+                    except FileNotFoundError:
+                        continue
+                    locks[f[len("worker_") : -len(".lock")]] = datetime.datetime.fromtimestamp(mtime, datetime.timezone.utc)
+            return locks
+
+        return await asyncio.to_thread(_list_locks)
+
     def _get_worker_lock_path(self, work_hash: str) -> str:
         """Internal method to get worker lock path."""
         return os.path.join(self._locks_dir, f"worker_{work_hash}.lock")
@@ -320,7 +633,7 @@ class LocalBackend(Backend):
 
         return await self._run_with_timeout(_get_mtime, operation_name=f"get_mtime({path})")
 
-    async def is_worker_lock_taken(self, work_hash: str, worker_lock_timeout_secs: int = 1800) -> bool:
+    async def is_worker_lock_taken(self, work_hash: str, worker_lock_timeout_secs: int = WORKER_LOCK_TIMEOUT_SECS) -> bool:
         """Check if a worker lock is taken and not stale."""
         lock_path = self._get_worker_lock_path(work_hash)
         try:
@@ -336,13 +649,58 @@ class LocalBackend(Backend):
         now = datetime.datetime.now(datetime.timezone.utc)
         return (now - lock_mtime).total_seconds() <= worker_lock_timeout_secs
 
-    async def create_worker_lock(self, work_hash: str) -> None:
-        """Create a worker lock for a work hash. Best-effort, does not fail on timeout."""
+    @contextlib.contextmanager
+    def _locks_guard(self):
+        """Exclusive flock on the locks directory, so that checking and rewriting a lock is one step for every process."""
+        fd = os.open(self._locks_dir, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _read_lock_file(lock_path: str) -> Optional[Tuple[bytes, str]]:
+        if not os.path.exists(lock_path):
+            return None
+        with open(lock_path, "rb") as f:
+            body = f.read()
+        return body, hashlib.md5(body).hexdigest()
+
+    @staticmethod
+    def _write_lock_file(lock_path: str, body: bytes) -> None:
+        # Replaced whole, so readers never see a partly written lock
+        temp_path = f"{lock_path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(body)
+        os.replace(temp_path, lock_path)
+
+    async def read_worker_lock(self, work_hash: str) -> Optional[Tuple[bytes, str]]:
+        """Read the body of the worker lock for a work hash and its version for replace_worker_lock, None if there is no lock."""
+        lock_path = self._get_worker_lock_path(work_hash)
+        return await self._run_with_timeout(self._read_lock_file, lock_path, operation_name=f"read_worker_lock({work_hash})")
+
+    async def replace_worker_lock(self, work_hash: str, body: bytes, version: Optional[str]) -> bool:
+        """Overwrite the worker lock for a work hash only if it is still at the version that was read. Returns whether it was written."""
+        lock_path = self._get_worker_lock_path(work_hash)
+
+        def _replace() -> bool:
+            with self._locks_guard():
+                current = self._read_lock_file(lock_path)
+                if (None if current is None else current[1]) != version:
+                    return False
+                self._write_lock_file(lock_path, body)
+                return True
+
+        return await self._run_with_timeout(_replace, operation_name=f"replace_worker_lock({work_hash})")
+
+    async def create_worker_lock(self, work_hash: str, body: bytes = b"") -> None:
+        """Create or overwrite the worker lock for a work hash. Best-effort, does not fail on timeout."""
         lock_path = self._get_worker_lock_path(work_hash)
 
         def _create() -> None:
-            with open(lock_path, "wb"):
-                pass
+            with self._locks_guard():
+                self._write_lock_file(lock_path, body)
 
         try:
             await self._run_with_timeout(_create, operation_name=f"create_worker_lock({work_hash})")
@@ -395,25 +753,25 @@ class S3Backend(Backend):
     def __init__(self, s3_client: Any, workspace_path: str):
         self.s3_client = s3_client
         self.workspace_path = workspace_path.rstrip("/")
-        self._index_path = os.path.join(self.workspace_path, "work_index_list.csv.zstd")
+        self._index_path = os.path.join(self.workspace_path, LEGACY_INDEX)
         self._output_glob = os.path.join(self.workspace_path, DONE_FLAGS_DIR, "*.flag")
 
-    async def load_index_lines(self) -> List[str]:
-        return await asyncio.to_thread(download_zstd_csv, self.s3_client, self._index_path)
+    async def load_index_lines(self, name: str = LEGACY_INDEX) -> List[str]:
+        return await asyncio.to_thread(download_zstd_csv, self.s3_client, os.path.join(self.workspace_path, name))
 
-    async def save_index_lines(self, lines: List[str]) -> None:
-        await asyncio.to_thread(upload_zstd_csv, self.s3_client, self._index_path, lines)
+    async def save_index_lines(self, lines: List[str], name: str = LEGACY_INDEX) -> None:
+        await asyncio.to_thread(upload_zstd_csv, self.s3_client, os.path.join(self.workspace_path, name), lines)
 
     async def get_completed_hashes(self) -> Set[str]:
-        def _list_completed() -> Set[str]:
-            done_work_items = expand_s3_glob(self.s3_client, self._output_glob)
-            return {
-                os.path.basename(item)[len("done_") : -len(".flag")]
-                for item in done_work_items
-                if os.path.basename(item).startswith("done_") and os.path.basename(item).endswith(".flag")
-            }
+        # Work hashes are sha1 hex digests, so listing one prefix per first digit covers them all, 16 listings at a time
+        done_prefix = os.path.join(self.workspace_path, DONE_FLAGS_DIR, "done_")
+        done_work_items = await asyncio.to_thread(list_s3_objects_parallel, self.s3_client, done_prefix)
+        return {os.path.basename(item)[len("done_") : -len(".flag")] for item in done_work_items if item.endswith(".flag")}
 
-        return await asyncio.to_thread(_list_completed)
+    async def get_worker_locks(self) -> Dict[str, datetime.datetime]:
+        lock_prefix = os.path.join(self.workspace_path, WORKER_LOCKS_DIR, "worker_")
+        locks = await asyncio.to_thread(list_s3_objects_parallel, self.s3_client, lock_prefix)
+        return {os.path.basename(item)[len("worker_") : -len(".lock")]: mtime for item, mtime in locks.items() if item.endswith(".lock")}
 
     def _get_worker_lock_path(self, work_hash: str) -> str:
         """Internal method to get worker lock path."""
@@ -438,7 +796,7 @@ class S3Backend(Backend):
 
         return await asyncio.to_thread(_head_object)
 
-    async def is_worker_lock_taken(self, work_hash: str, worker_lock_timeout_secs: int = 1800) -> bool:
+    async def is_worker_lock_taken(self, work_hash: str, worker_lock_timeout_secs: int = WORKER_LOCK_TIMEOUT_SECS) -> bool:
         """Check if a worker lock is taken and not stale."""
         lock_path = self._get_worker_lock_path(work_hash)
         lock_mtime = await self._get_object_mtime(lock_path)
@@ -449,11 +807,39 @@ class S3Backend(Backend):
         now = datetime.datetime.now(datetime.timezone.utc)
         return (now - lock_mtime).total_seconds() <= worker_lock_timeout_secs
 
-    async def create_worker_lock(self, work_hash: str) -> None:
-        """Create a worker lock for a work hash."""
+    async def read_worker_lock(self, work_hash: str) -> Optional[Tuple[bytes, str]]:
+        """Read the body of the worker lock for a work hash and its ETag for replace_worker_lock, None if there is no lock."""
+        bucket, key = parse_s3_path(self._get_worker_lock_path(work_hash))
+
+        def _get_object() -> Optional[Tuple[bytes, str]]:
+            try:
+                response = self.s3_client.get_object(Bucket=bucket, Key=key)
+            except self.s3_client.exceptions.ClientError as e:
+                if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                    return None
+                raise
+            return response["Body"].read(), response["ETag"]
+
+        return await asyncio.to_thread(_get_object)
+
+    async def replace_worker_lock(self, work_hash: str, body: bytes, version: Optional[str]) -> bool:
+        """Overwrite the worker lock for a work hash with a conditional put on the ETag that was read. Returns whether it was written."""
+        bucket, key = parse_s3_path(self._get_worker_lock_path(work_hash))
+        condition = {"IfMatch": version} if version is not None else {"IfNoneMatch": "*"}
+        try:
+            await asyncio.to_thread(self.s3_client.put_object, Bucket=bucket, Key=key, Body=body, **condition)
+        except self.s3_client.exceptions.ClientError as e:
+            # Another writer got there first, or is writing at the same time
+            if e.response["Error"]["Code"] in ("PreconditionFailed", "412", "ConditionalRequestConflict", "409"):
+                return False
+            raise
+        return True
+
+    async def create_worker_lock(self, work_hash: str, body: bytes = b"") -> None:
+        """Create or overwrite the worker lock for a work hash."""
         lock_path = self._get_worker_lock_path(work_hash)
         bucket, key = parse_s3_path(lock_path)
-        await asyncio.to_thread(self.s3_client.put_object, Bucket=bucket, Key=key, Body=b"")
+        await asyncio.to_thread(self.s3_client.put_object, Bucket=bucket, Key=key, Body=body)
 
     async def delete_worker_lock(self, work_hash: str) -> None:
         """Delete the worker lock for a work hash if it exists."""
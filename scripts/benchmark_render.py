@@ -0,0 +1,98 @@
+"""
+Compare page rendering engines used by the pipeline, reporting pages/sec and CPU-seconds per page.
+
+CPU time includes child processes, so the pdfinfo/pdftoppm subprocesses spawned by the poppler engine and the processes of
+pdfium-pool are counted. pdfium renders one page at a time per process, so with several workers the in-process pdfium engine
+shows its ceiling, and pdfium-pool renders the way the pipeline does, in a pool of --render_workers processes.
+
+    python scripts/benchmark_render.py tests/gnarly_pdfs/*.pdf --workers 8
+"""
+
+import argparse
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from pypdf import PdfReader
+
+from olmocr.data.renderpdf import open_pdf_renderer, render_pdfium_page_png
+
+
+def _cpu_seconds() -> float:
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage_self.ru_utime + usage_self.ru_stime + usage_children.ru_utime + usage_children.ru_stime
+
+
+def _render_in_process(job) -> int:
+    path, page, target_longest_image_dim = job
+    return len(render_pdfium_page_png(path, page, target_longest_image_dim))
+
+
+def benchmark_engine(engine: str, pdf_pages: list[tuple[str, int]], target_longest_image_dim: int, workers: int, retries: int) -> dict:
+    # Each page is rendered retries times, the way the pipeline re-renders a page on every attempt
+    jobs = [(path, page) for path, page in pdf_pages for _ in range(retries)]
+
+    if engine == "pdfium-pool":
+        # Spawned like the pipeline's pool, and started before the clock so process startup isn't counted
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            list(executor.map(abs, range(workers)))
+            start_wall, start_cpu = time.perf_counter(), _cpu_seconds()
+            total_bytes = sum(executor.map(_render_in_process, [(path, page, target_longest_image_dim) for path, page in jobs]))
+            wall = time.perf_counter() - start_wall
+        # Child CPU time is only accounted once the processes have exited
+        cpu = _cpu_seconds() - start_cpu
+    else:
+        renderers = {path: open_pdf_renderer(path, engine) for path in {path for path, _ in pdf_pages}}
+
+        def render(job):
+            path, page = job
+            return len(renderers[path].render_page_to_png(page, target_longest_image_dim))
+
+        start_wall, start_cpu = time.perf_counter(), _cpu_seconds()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            total_bytes = sum(executor.map(render, jobs))
+        wall, cpu = time.perf_counter() - start_wall, _cpu_seconds() - start_cpu
+
+        for renderer in renderers.values():
+            renderer.close()
+
+    return {
+        "engine": engine,
+        "pages": len(jobs),
+        "pages_per_sec": len(jobs) / wall,
+        "cpu_sec_per_page": cpu / len(jobs),
+        "avg_png_kb": total_bytes / len(jobs) / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pdf page rendering engines")
+    parser.add_argument("pdfs", nargs="+", help="Local pdf files to render")
+    parser.add_argument("--engines", nargs="+", default=["pdfium", "pdfium-pool", "pdftoppm"], help="Engines to compare")
+    parser.add_argument("--target_longest_image_dim", type=int, default=1288)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=max(1, multiprocessing.cpu_count() - 2),
+        help="Number of threads, or processes for pdfium-pool, rendering concurrently, like pdf_render_max_workers_limit and --render_workers",
+    )
+    parser.add_argument("--retries", type=int, default=1, help="Render every page this many times")
+    parser.add_argument("--max_pages_per_pdf", type=int, default=10)
+    args = parser.parse_args()
+
+    pdf_pages = []
+    for path in args.pdfs:
+        num_pages = len(PdfReader(path).pages)
+        pdf_pages.extend((path, page) for page in range(1, min(num_pages, args.max_pages_per_pdf) + 1))
+
+    print(f"Rendering {len(pdf_pages)} pages from {len(args.pdfs)} pdfs, {args.retries} time(s) each, with {args.workers} worker(s)")
+    print(f"{'Engine':<10} {'Pages':>8} {'Pages/sec':>12} {'CPU sec/page':>14} {'Avg PNG KB':>12}")
+    for engine in args.engines:
+        result = benchmark_engine(engine, pdf_pages, args.target_longest_image_dim, args.workers, args.retries)
+        print(f"{result['engine']:<10} {result['pages']:>8} {result['pages_per_sec']:>12.2f} {result['cpu_sec_per_page']:>14.4f} {result['avg_png_kb']:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
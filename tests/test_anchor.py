@@ -3,18 +3,30 @@ import glob
 import io
 import json
 import os
+import pickle
 import re
+import subprocess
 import tempfile
 import unittest
+from unittest.mock import patch
 
+from PIL import Image
 from pypdf import PdfReader
 
+from olmocr.data import renderpdf
 from olmocr.data.renderpdf import (
     get_pdf_media_box_width_height,
+    open_pdf_renderer,
     render_pdf_to_base64png,
+    render_pdfium_page_png,
 )
 from olmocr.image_utils import convert_image_to_pdf_bytes
-from olmocr.prompts.anchor import _linearize_pdf_report, _pdf_report, get_anchor_text
+from olmocr.prompts.anchor import (
+    PdfTextLayer,
+    _linearize_pdf_report,
+    _pdf_report,
+    get_anchor_text,
+)
 
 
 class AnchorTest(unittest.TestCase):
@@ -244,6 +256,38 @@ class AnchorTest(unittest.TestCase):
         self.assertLessEqual(len(anchor_text), 6000)
 
 
+class PdfTextLayerTest(unittest.TestCase):
+    def testWholeDocumentMatchesPerPageExtraction(self):
+        local_pdf_path = os.path.join(os.path.dirname(__file__), "gnarly_pdfs", "badlines.pdf")
+        per_page = [get_anchor_text(local_pdf_path, page, pdf_engine="pdftotext") for page in range(1, 11)]
+
+        text_layer = PdfTextLayer(local_pdf_path)
+        with patch("olmocr.prompts.anchor.subprocess.run", wraps=subprocess.run) as mock_run:
+            for page in [7, 1, 10, 3]:
+                self.assertEqual(text_layer.get_page(page), per_page[page - 1])
+            self.assertEqual(text_layer.get_pages(1, 20), per_page)
+
+        self.assertEqual(mock_run.call_count, 1)
+        self.assertEqual(text_layer.num_pages, 10)
+
+    def testPageRangeIsKeptForLaterPages(self):
+        local_pdf_path = os.path.join(os.path.dirname(__file__), "gnarly_pdfs", "badlines.pdf")
+        text_layer = PdfTextLayer(local_pdf_path)
+
+        first_pages = text_layer.get_pages(1, 5, whole_document=False)
+        self.assertEqual(len(first_pages), 5)
+        self.assertIsNone(text_layer.num_pages)
+
+        # Pickled into another process and back, like for the filter, the extracted pages come along
+        text_layer = pickle.loads(pickle.dumps(text_layer))
+        self.assertEqual(text_layer.get_page(2), first_pages[1])
+        self.assertEqual(text_layer.subprocess_runs, 1)
+
+        text_layer.get_page(6)
+        self.assertEqual(text_layer.subprocess_runs, 2)
+        self.assertEqual(text_layer.get_pages(1, 5), first_pages)
+
+
 class BuildSilverTest(unittest.TestCase):
     def testSmallPage(self):
         local_pdf_path = os.path.join(os.path.dirname(__file__), "gnarly_pdfs", "small_page_size.pdf")
@@ -279,6 +323,33 @@ class TestRenderPdf(unittest.TestCase):
                 self.assertAlmostEqual(w1, pypdfpage.mediabox.width, places=3)
                 self.assertAlmostEqual(h1, pypdfpage.mediabox.height, places=3)
 
+    def testPdfiumRendererLongestDim(self):
+        for file in ["edgar.pdf", "edgar-rotated90.pdf", "small_page_size.pdf", "skinnypage.pdf"]:
+            renderer = open_pdf_renderer(os.path.join(os.path.dirname(__file__), "gnarly_pdfs", file), "pdfium")
+            try:
+                # Render the same page twice from the one open document, like a retry would
+                for target_dim in [1288, 1024]:
+                    with Image.open(io.BytesIO(renderer.render_page_to_png(1, target_dim))) as img:
+                        self.assertEqual(img.format, "PNG")
+                        self.assertEqual(max(img.size), target_dim)
+            finally:
+                renderer.close()
+
+    def testRenderPoolProcessMatchesRenderer(self):
+        files = [os.path.join(os.path.dirname(__file__), "gnarly_pdfs", file) for file in ["edgar.pdf", "edgar-rotated90.pdf", "small_page_size.pdf"]]
+        for file in files:
+            renderer = open_pdf_renderer(file, "pdfium")
+            try:
+                self.assertEqual(render_pdfium_page_png(file, 1, 1024), renderer.render_page_to_png(1, 1024))
+            finally:
+                renderer.close()
+
+        # Only the most recently rendered documents are kept open in a render process
+        with patch("olmocr.data.renderpdf.MAX_PROCESS_OPEN_DOCUMENTS", 2):
+            for file in files:
+                render_pdfium_page_png(file, 1, 512)
+            self.assertEqual([key[0] for key in renderpdf._process_documents], files[1:])
+
 
 class TestOutputSamplePage(unittest.TestCase):
     def testTobaccoPaper(self):
@@ -0,0 +1,203 @@
+import asyncio
+import os
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from olmocr.concurrency import (
+    AdaptiveConcurrencyLimiter,
+    BoundedProcessPool,
+    EndpointRouter,
+    InferenceEndpoint,
+    parse_server_endpoints,
+)
+
+
+class TestAdaptiveConcurrencyLimiter:
+    @pytest.mark.asyncio
+    async def test_bounds_in_flight_requests(self):
+        limiter = AdaptiveConcurrencyLimiter(3, min_limit=3)
+        peak = 0
+
+        async def request():
+            nonlocal peak
+            async with limiter.request():
+                peak = max(peak, limiter.in_flight)
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(*[request() for _ in range(20)])
+
+        assert peak == 3
+        assert limiter.in_flight == 0
+        assert limiter.current_limit == 3
+
+    @pytest.mark.asyncio
+    async def test_overload_decreases_multiplicatively_once_per_cooldown(self):
+        limiter = AdaptiveConcurrencyLimiter(100, min_limit=10, cooldown_secs=60)
+
+        for _ in range(5):
+            async with limiter.request() as slot:
+                slot.overloaded = True
+
+        assert limiter.current_limit == 90
+        assert limiter.stats["overloaded"] == 5
+        assert limiter.stats["decreases"] == 1
+
+    @pytest.mark.asyncio
+    async def test_connection_errors_decrease_down_to_min_limit(self):
+        limiter = AdaptiveConcurrencyLimiter(20, min_limit=5, cooldown_secs=0)
+
+        for _ in range(50):
+            with pytest.raises(ConnectionError):
+                async with limiter.request():
+                    raise ConnectionError("refused")
+
+        assert limiter.current_limit == 5
+        assert limiter.stats["errors"] == 50
+
+    @pytest.mark.asyncio
+    async def test_success_increases_additively_up_to_max(self):
+        limiter = AdaptiveConcurrencyLimiter(4, min_limit=1, max_limit=6)
+
+        for _ in range(10):
+            batch = limiter.current_limit
+            for _ in range(batch):
+                await limiter.acquire()
+            for _ in range(batch):
+                limiter.release(latency=1.0)
+
+        assert limiter.current_limit == 6
+        assert limiter.stats["increases"] == 2
+        assert limiter.stats["decreases"] == 0
+
+    @pytest.mark.asyncio
+    async def test_queue_depth_and_latency_signal_congestion(self):
+        limiter = AdaptiveConcurrencyLimiter(100, max_queue_depth=50, cooldown_secs=0)
+        limiter.observe_queue_depth(500)
+        async with limiter.request():
+            pass
+        assert limiter.current_limit == 90
+
+        limiter.observe_queue_depth(0)
+        for _ in range(20):
+            await limiter.acquire()
+            limiter.release(latency=1.0)
+        limit_before = limiter.current_limit
+        for _ in range(20):
+            await limiter.acquire()
+            limiter.release(latency=10.0)
+        assert limiter.current_limit < limit_before
+
+    @pytest.mark.asyncio
+    async def test_cancelled_waiter_does_not_leak_slot(self):
+        limiter = AdaptiveConcurrencyLimiter(1)
+        await limiter.acquire()
+
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+        limiter.release()
+        assert limiter.in_flight == 0
+        await asyncio.wait_for(limiter.acquire(), timeout=1)
+        assert limiter.in_flight == 1
+
+
+class TestBoundedProcessPool:
+    @pytest.mark.asyncio
+    async def test_runs_jobs_in_other_processes_with_bounded_queue(self):
+        pool = BoundedProcessPool(2, max_pending=2)
+        try:
+            pids = await asyncio.gather(*[pool.run(os.getpid) for _ in range(8)])
+            assert os.getpid() not in pids
+            assert pool.stats["jobs"] == 8
+            assert pool.running == 0 and pool.pending == 0
+
+            # Jobs beyond max_pending wait in run() rather than in the executor
+            jobs = [asyncio.create_task(pool.run(time.sleep, 0.2)) for _ in range(5)]
+            await asyncio.sleep(0.05)
+            assert pool.running == 2
+            assert pool.pending == 3
+            await asyncio.gather(*jobs)
+        finally:
+            pool.shutdown()
+
+    @pytest.mark.asyncio
+    async def test_restarts_after_a_worker_dies(self):
+        pool = BoundedProcessPool(1)
+        try:
+            with pytest.raises(BrokenProcessPool):
+                await pool.run(os._exit, 1)
+            assert pool.stats["restarts"] >= 1
+            assert pool.stats["failed"] == 1
+
+            assert await pool.run(abs, -3) == 3
+        finally:
+            pool.shutdown()
+
+
+class TestEndpointRouter:
+    def test_parse_server_endpoints(self):
+        endpoints = parse_server_endpoints("http://node1:30024/v1/;weight=2, https://api.example.com/v1;api_key=secret", default_api_key="default")
+        assert [(e.url, e.weight, e.api_key) for e in endpoints] == [
+            ("http://node1:30024/v1", 2.0, "default"),
+            ("https://api.example.com/v1", 1.0, "secret"),
+        ]
+        assert endpoints[0].name == "node1:30024"
+
+        with pytest.raises(ValueError):
+            parse_server_endpoints("http://node1:30024/v1;wieght=2")
+
+    @pytest.mark.asyncio
+    async def test_routes_to_least_outstanding_by_weight(self):
+        heavy, light = InferenceEndpoint("http://heavy/v1", weight=3), InferenceEndpoint("http://light/v1")
+        router = EndpointRouter([heavy, light])
+
+        requests = [router.request() for _ in range(8)]
+        slots = [await request.__aenter__() for request in requests]
+        assert heavy.outstanding == 6 and light.outstanding == 2
+
+        for request in requests:
+            await request.__aexit__(None, None, None)
+        assert heavy.outstanding == 0 and light.outstanding == 0
+        assert heavy.latency is not None and slots[0].endpoint.stats["requests"] >= 1
+
+    @pytest.mark.asyncio
+    async def test_ejects_failing_endpoint_and_restores_it_after_probe(self):
+        # The bad endpoint is weighted so heavily that it gets every request while it's healthy
+        good, bad = InferenceEndpoint("http://good/v1"), InferenceEndpoint("http://bad/v1", weight=100)
+        router = EndpointRouter([good, bad], failure_threshold=3)
+
+        for _ in range(3):
+            with pytest.raises(ConnectionError):
+                async with router.request() as slot:
+                    assert slot.endpoint is bad
+                    raise ConnectionError("refused")
+        assert not bad.healthy and bad.stats["ejections"] == 1
+
+        for _ in range(5):
+            async with router.request() as slot:
+                assert slot.endpoint is good
+
+        probed = []
+
+        async def probe(endpoint):
+            probed.append(endpoint)
+            return True
+
+        task = asyncio.create_task(router.run_health_probes(probe, interval=0.01))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        assert probed[0] is bad and bad.healthy and bad.consecutive_failures == 0
+
+    @pytest.mark.asyncio
+    async def test_last_healthy_endpoint_is_never_ejected(self):
+        only = InferenceEndpoint("http://only/v1")
+        router = EndpointRouter([only], failure_threshold=1)
+        for _ in range(3):
+            async with router.request() as slot:
+                slot.failed = True
+        assert only.healthy and only.stats["failures"] == 3
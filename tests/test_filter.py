@@ -3,7 +3,7 @@ import unittest
 
 from pypdf import PdfReader
 
-from olmocr.filter import PdfFilter
+from olmocr.filter import BlankPageDetector, PdfFilter
 
 
 class PdfFilterTest(unittest.TestCase):
@@ -15,3 +15,48 @@ class PdfFilterTest(unittest.TestCase):
         self.filter = PdfFilter(apply_form_check=False)
 
         self.assertFalse(self.filter.filter_out_pdf(os.path.join(os.path.dirname(__file__), "gnarly_pdfs", "form_on_later_pages.pdf")))
+
+    def testSharesTextLayer(self):
+        from olmocr.prompts.anchor import PdfTextLayer
+
+        local_pdf_path = os.path.join(os.path.dirname(__file__), "gnarly_pdfs", "form_on_later_pages.pdf")
+        text_layer = PdfTextLayer(local_pdf_path)
+        self.filter = PdfFilter(apply_form_check=False)
+
+        self.assertFalse(self.filter.filter_out_pdf(local_pdf_path, text_layer))
+        self.assertEqual(text_layer.subprocess_runs, 1)
+        self.assertIn(1, text_layer.pages)
+
+
+class BlankPageDetectorTest(unittest.TestCase):
+    FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "blank_pages")
+
+    def load_fixtures(self):
+        """The fixture pages are labelled by their file names, blank_* or content_*"""
+        for name in sorted(os.listdir(self.FIXTURES_DIR)):
+            with open(os.path.join(self.FIXTURES_DIR, name), "rb") as f:
+                yield name, name.startswith("blank_"), f.read()
+
+    def testFixturePrecision(self):
+        detector = BlankPageDetector()
+        fixtures = list(self.load_fixtures())
+        predicted_blank = {name for name, _, png in fixtures if detector.is_blank_image(png)}
+        labelled_blank = {name for name, is_blank, _ in fixtures if is_blank}
+
+        self.assertGreaterEqual(len(fixtures) - len(labelled_blank), 5)
+        # A content page taken for blank loses its text, while a missed blank page only costs a request
+        self.assertEqual(predicted_blank - labelled_blank, set())
+        self.assertEqual(predicted_blank, labelled_blank)
+
+    def testThresholdsAreConfigurable(self):
+        with open(os.path.join(self.FIXTURES_DIR, "content_heading_only.png"), "rb") as f:
+            png = f.read()
+
+        self.assertFalse(BlankPageDetector().is_blank_image(png))
+        self.assertTrue(BlankPageDetector(max_ink_coverage=0.01, max_stddev=20).is_blank_image(png))
+
+    def testTextLayer(self):
+        detector = BlankPageDetector()
+        self.assertTrue(detector.is_blank_text(" \n\f"))
+        self.assertFalse(detector.is_blank_text("17\f"))
+        self.assertTrue(BlankPageDetector(max_text_chars=2).is_blank_text("17\f"))
@@ -0,0 +1,90 @@
+import io
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock
+
+from botocore.exceptions import ClientError
+
+from olmocr.page_journal import PageJournal
+
+
+class TestLocalPageJournal(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.workspace = self.temp_dir.name
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_flushed_records_are_loaded_by_next_worker(self):
+        journal = PageJournal(self.workspace, "abc")
+        self.assertEqual(journal.load(), {})
+        journal.record("a.pdf-1", {"n": 1})
+        journal.record("a.pdf-2", {"n": 2})
+        self.assertEqual(journal.flush(), 2)
+        journal.record("a.pdf-3", {"n": 3})
+        self.assertEqual(journal.flush(), 1)
+        self.assertEqual(journal.flush(), 0)
+        self.assertTrue(os.path.exists(os.path.join(self.workspace, "checkpoints", "abc.jsonl.zstd")))
+
+        resumed = PageJournal(self.workspace, "abc")
+        self.assertEqual(resumed.load(), {"a.pdf-1": {"n": 1}, "a.pdf-2": {"n": 2}, "a.pdf-3": {"n": 3}})
+        self.assertEqual(resumed.get("a.pdf-2"), {"n": 2})
+        self.assertIsNone(resumed.get("a.pdf-4"))
+
+        resumed.delete()
+        self.assertEqual(PageJournal(self.workspace, "abc").load(), {})
+
+    def test_truncated_frame_keeps_earlier_records(self):
+        journal = PageJournal(self.workspace, "abc")
+        journal.record("a.pdf-1", {"n": 1})
+        journal.flush()
+        journal.record("a.pdf-2", {"n": 2, "text": "x" * 10000})
+        journal.flush()
+
+        # A crash partway through writing the last frame
+        with open(journal.path, "rb+") as f:
+            f.truncate(os.path.getsize(journal.path) - 10)
+
+        resumed = PageJournal(self.workspace, "abc")
+        self.assertEqual(resumed.load(), {"a.pdf-1": {"n": 1}})
+
+        # Records appended after the replay don't get lost behind the truncated frame
+        resumed.record("a.pdf-2", {"n": 2})
+        resumed.flush()
+        self.assertEqual(PageJournal(self.workspace, "abc").load(), {"a.pdf-1": {"n": 1}, "a.pdf-2": {"n": 2}})
+
+
+class TestS3PageJournal(unittest.TestCase):
+    def setUp(self):
+        self.objects = {}
+        self.s3_client = Mock()
+        self.s3_client.exceptions.NoSuchKey = ClientError
+
+        def upload_file(local_path, bucket, key):
+            with open(local_path, "rb") as f:
+                self.objects[(bucket, key)] = f.read()
+
+        def get_object(Bucket, Key):
+            if (Bucket, Key) not in self.objects:
+                raise ClientError({"Error": {"Code": "NoSuchKey", "Message": "Not Found"}}, "GetObject")
+            return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+        self.s3_client.upload_file.side_effect = upload_file
+        self.s3_client.get_object.side_effect = get_object
+        self.s3_client.delete_object.side_effect = lambda Bucket, Key: self.objects.pop((Bucket, Key))
+
+    def test_checkpoint_is_uploaded_and_deleted(self):
+        journal = PageJournal("s3://bucket/workspace", "abc", self.s3_client)
+        self.assertEqual(journal.load(), {})
+        journal.record("a.pdf-1", {"n": 1})
+        journal.close()
+        self.assertEqual(list(self.objects), [("bucket", "workspace/checkpoints/abc.jsonl.zstd")])
+        self.assertFalse(os.path.exists(journal.local_path))
+
+        resumed = PageJournal("s3://bucket/workspace", "abc", self.s3_client)
+        self.assertEqual(resumed.load(), {"a.pdf-1": {"n": 1}})
+        resumed.delete()
+        self.assertEqual(self.objects, {})
+        self.assertFalse(os.path.exists(resumed.local_path))
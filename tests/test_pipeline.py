@@ -1,19 +1,60 @@
+import asyncio
 import base64
+import glob
 import json
 import os
+import shutil
+import tarfile
+import threading
+import time
+import tracemalloc
 from dataclasses import dataclass
 from io import BytesIO
 from unittest.mock import AsyncMock, patch
 
 import pytest
 from PIL import Image
+from pypdf import PdfWriter
 
+from olmocr import pipeline
+from olmocr.concurrency import AdaptiveConcurrencyLimiter, BoundedProcessPool
+from olmocr.metrics import EventLoopMonitor, MetricsKeeper, parse_prometheus_metrics
+from olmocr.page_journal import PageJournal
 from olmocr.pipeline import (
+    HttpConnectionPool,
     PageResult,
+    StreamedCompletion,
+    apost,
     build_page_query,
+    close_document_renderer,
+    count_local_pdf_pages,
+    decode_output_lines,
+    dedupe_pdf_paths,
+    document_page_caches,
+    document_renderers,
+    document_text_layers,
     get_markdown_path,
+    get_page_png,
+    get_pdf_page_count,
+    json_body_parts,
+    make_fallback_result,
+    open_document_renderer,
+    print_stats,
     process_page,
+    process_single_pdf,
+    process_tarball,
+    run_cpu_bound,
+    send_hedged_page_request,
+    server_metrics_url,
+    try_single_page,
+    vllm_metrics_poller,
+    worker_lock_heartbeat,
+    write_dolma_docs,
 )
+from olmocr.prompts import PageResponse
+from olmocr.prompts.anchor import PdfTextLayer
+from olmocr.result_cache import SqlitePageResultCache
+from olmocr.work_queue import LocalBackend, WorkItem, WorkQueue
 
 
 def create_test_image(width=100, height=150):
@@ -61,8 +102,8 @@ class TestImageRotation:
         test_img = create_test_image()
         test_base64 = image_to_base64(test_img)
 
-        with patch("olmocr.pipeline.render_pdf_to_base64png") as mock_render:
-            mock_render.return_value = test_base64
+        with patch("olmocr.pipeline.render_page_png") as mock_render:
+            mock_render.return_value = base64.b64decode(test_base64)
 
             result = await build_page_query("fake_pdf.pdf", 1, 1000, image_rotation=0)
 
@@ -85,8 +126,8 @@ class TestImageRotation:
         test_img = create_test_image(100, 150)
         test_base64 = image_to_base64(test_img)
 
-        with patch("olmocr.pipeline.render_pdf_to_base64png") as mock_render:
-            mock_render.return_value = test_base64
+        with patch("olmocr.pipeline.render_page_png") as mock_render:
+            mock_render.return_value = base64.b64decode(test_base64)
 
             result = await build_page_query("fake_pdf.pdf", 1, 1000, image_rotation=90)
 
@@ -110,8 +151,8 @@ class TestImageRotation:
         test_img = create_test_image(100, 150)
         test_base64 = image_to_base64(test_img)
 
-        with patch("olmocr.pipeline.render_pdf_to_base64png") as mock_render:
-            mock_render.return_value = test_base64
+        with patch("olmocr.pipeline.render_page_png") as mock_render:
+            mock_render.return_value = base64.b64decode(test_base64)
 
             result = await build_page_query("fake_pdf.pdf", 1, 1000, image_rotation=180)
 
@@ -135,8 +176,8 @@ class TestImageRotation:
         test_img = create_test_image(100, 150)
         test_base64 = image_to_base64(test_img)
 
-        with patch("olmocr.pipeline.render_pdf_to_base64png") as mock_render:
-            mock_render.return_value = test_base64
+        with patch("olmocr.pipeline.render_page_png") as mock_render:
+            mock_render.return_value = base64.b64decode(test_base64)
 
             result = await build_page_query("fake_pdf.pdf", 1, 1000, image_rotation=270)
 
@@ -160,8 +201,8 @@ class TestImageRotation:
         test_img = create_test_image()
         test_base64 = image_to_base64(test_img)
 
-        with patch("olmocr.pipeline.render_pdf_to_base64png") as mock_render:
-            mock_render.return_value = test_base64
+        with patch("olmocr.pipeline.render_page_png") as mock_render:
+            mock_render.return_value = base64.b64decode(test_base64)
 
             with pytest.raises(AssertionError, match="Invalid image rotation"):
                 await build_page_query("fake_pdf.pdf", 1, 1000, image_rotation=45)
@@ -173,8 +214,8 @@ class TestImageRotation:
         test_img = create_test_image(200, 300)
         test_base64 = image_to_base64(test_img)
 
-        with patch("olmocr.pipeline.render_pdf_to_base64png") as mock_render:
-            mock_render.return_value = test_base64
+        with patch("olmocr.pipeline.render_page_png") as mock_render:
+            mock_render.return_value = base64.b64decode(test_base64)
 
             # Test all valid rotation angles
             for angle in [0, 90, 180, 270]:
@@ -196,7 +237,17 @@ class TestImageRotation:
 class MockArgs:
     max_page_retries: int = 8
     target_longest_image_dim: int = 1288
+    render_engine: str = "pdfium"
     guided_decoding: bool = False
+    stream_requests: bool = False
+    repeat_abort_chars: int = 1500
+    hedge_requests: bool = False
+    hedge_percentile: float = 95.0
+    hedge_max_fraction: float = 0.05
+    skip_blank_pages: bool = False
+    blank_max_ink_coverage: float = 0.0005
+    blank_max_stddev: float = 6.0
+    blank_max_text_chars: int = 0
     server: str = "http://localhost:30000/v1"
     model: str = "olmocr"
 
@@ -513,6 +564,169 @@ Document correctly oriented at 90 degrees total rotation."""
         assert build_page_query_calls[2] == 90  # Third call with wrapped rotation (270 + 180 = 450 % 360 = 90)
 
 
+class TestRenderedPageCache:
+    @pytest.mark.asyncio
+    async def test_retries_reuse_cached_render(self):
+        """Test that a page is rendered at most twice across retries, and rotations are applied to the cached render."""
+        test_img = create_test_image(100, 150)
+        test_png = base64.b64decode(image_to_base64(test_img))
+        local_pdf_path = "tests/gnarly_pdfs/edgar.pdf"
+
+        open_document_renderer(local_pdf_path, "pdfium", max_cached_pages=4)
+        try:
+            with patch("olmocr.pipeline.render_page_png", return_value=test_png) as mock_render:
+                for rotation in [0, 0, 90, 180, 0]:
+                    result = await build_page_query(local_pdf_path, 1, 1000, image_rotation=rotation)
+
+                image_url = result["messages"][0]["content"][1]["image_url"]["url"]
+                assert base64_to_image(image_url.split(",")[1]).size == (100, 150)
+
+                # Rotated queries still came from the cached unrotated render
+                rotated = await build_page_query(local_pdf_path, 1, 1000, image_rotation=90)
+                assert base64_to_image(rotated["messages"][0]["content"][1]["image_url"]["url"].split(",")[1]).size == (150, 100)
+
+                # First render is not admitted, the second one is, everything after that is a cache hit
+                assert mock_render.call_count == 2
+                assert len(document_page_caches[local_pdf_path]) == 1
+
+                # A different target dimension is a different cache entry
+                await build_page_query(local_pdf_path, 1, 500, image_rotation=0)
+                assert mock_render.call_count == 3
+        finally:
+            close_document_renderer(local_pdf_path)
+
+        assert local_pdf_path not in document_page_caches
+
+
+class TestBlankPageSkipping:
+    @pytest.mark.asyncio
+    async def test_blank_pages_skip_the_server(self, tmp_path):
+        local_pdf_path = str(tmp_path / "with_blank_page.pdf")
+        writer = PdfWriter()
+        writer.add_blank_page(612, 792)
+        writer.append("tests/gnarly_pdfs/edgar.pdf")
+        writer.write(local_pdf_path)
+
+        requested_pages = []
+
+        async def mock_apost(url, json_data, api_key=None):
+            requested_pages.append(json_data)
+            content = "---\nprimary_language: en\nis_rotation_valid: true\nrotation_correction: 0\nis_table: false\nis_diagram: false\n---\nSome text"
+            response_body = {
+                "choices": [{"message": {"content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+            }
+            return 200, json.dumps(response_body).encode()
+
+        text_layer = PdfTextLayer(local_pdf_path)
+        text_layer.pages = {1: "\f", 2: "Some text\f"}
+        document_text_layers[local_pdf_path] = text_layer
+        open_document_renderer(local_pdf_path, "pdfium", max_cached_pages=4)
+        keeper = MetricsKeeper()
+        args = MockArgs(skip_blank_pages=True)
+        try:
+            with (
+                patch("olmocr.pipeline.apost", side_effect=mock_apost),
+                patch("olmocr.pipeline.tracker", AsyncMock()),
+                patch("olmocr.pipeline.metrics", keeper),
+            ):
+                blank_result = await process_page(args, 0, "s3://bucket/with_blank_page.pdf", local_pdf_path, 1)
+                assert requested_pages == []
+
+                content_result = await process_page(args, 0, "s3://bucket/with_blank_page.pdf", local_pdf_path, 2)
+                assert len(requested_pages) == 1
+        finally:
+            close_document_renderer(local_pdf_path)
+            document_text_layers.pop(local_pdf_path, None)
+
+        assert blank_result.is_blank and blank_result.is_valid and not blank_result.is_fallback
+        assert blank_result.response.natural_text == ""
+        assert not content_result.is_blank
+        assert content_result.response.natural_text == "Some text"
+
+        # The content page was checked and then sent from the same render
+        assert keeper.total_metrics["blank_pages_skipped"] == 1
+        assert keeper.total_metrics["render_cache_hits"] == 1
+
+
+class TestPageResultCache:
+    @pytest.mark.asyncio
+    async def test_same_page_in_another_pdf_hits_cache(self, tmp_path):
+        copy_path = str(tmp_path / "recrawled.pdf")
+        shutil.copy("tests/gnarly_pdfs/edgar.pdf", copy_path)
+        num_requests = 0
+
+        async def mock_apost(url, json_data, api_key=None):
+            nonlocal num_requests
+            num_requests += 1
+            content = "---\nprimary_language: en\nis_rotation_valid: true\nrotation_correction: 0\nis_table: true\nis_diagram: false\n---\nCached text"
+            response_body = {
+                "choices": [{"message": {"content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+            }
+            return 200, json.dumps(response_body).encode()
+
+        result_cache = SqlitePageResultCache(str(tmp_path / "pages.sqlite"), "olmocr")
+        keeper = MetricsKeeper()
+        try:
+            with (
+                patch("olmocr.pipeline.apost", side_effect=mock_apost),
+                patch("olmocr.pipeline.tracker", AsyncMock()),
+                patch("olmocr.pipeline.metrics", keeper),
+            ):
+                with patch("olmocr.pipeline.page_result_cache", result_cache):
+                    first = await process_page(MockArgs(), 0, "s3://bucket/edgar.pdf", "tests/gnarly_pdfs/edgar.pdf", 1)
+                    second = await process_page(MockArgs(), 0, "s3://other/recrawled.pdf", copy_path, 1)
+                    # A different render dimension is a different page as far as the model is concerned
+                    await process_page(MockArgs(target_longest_image_dim=1024), 0, "s3://other/recrawled.pdf", copy_path, 1)
+        finally:
+            result_cache.close()
+
+        assert num_requests == 2
+        assert second.s3_path == "s3://other/recrawled.pdf"
+        assert second.response == first.response
+        assert second.response.is_table and second.response.natural_text == "Cached text"
+        assert second.input_tokens == 0 and second.output_tokens == 0
+        assert keeper.total_metrics["page_result_cache_hits"] == 1
+        assert keeper.total_metrics["page_result_cache_misses"] == 2
+
+
+class TestPageJournalReplay:
+    @pytest.mark.asyncio
+    async def test_journaled_pages_are_not_requested_again(self, tmp_path):
+        num_requests = 0
+
+        async def mock_apost(url, json_data, api_key=None):
+            nonlocal num_requests
+            num_requests += 1
+            content = "---\nprimary_language: en\nis_rotation_valid: true\nrotation_correction: 0\nis_table: false\nis_diagram: false\n---\nJournaled text"
+            response_body = {
+                "choices": [{"message": {"content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+            }
+            return 200, json.dumps(response_body).encode()
+
+        keeper = MetricsKeeper()
+        with patch("olmocr.pipeline.apost", side_effect=mock_apost), patch("olmocr.pipeline.tracker", AsyncMock()), patch("olmocr.pipeline.metrics", keeper):
+            journal = PageJournal(str(tmp_path), "abc")
+            token = pipeline.current_page_journal.set(journal)
+            try:
+                first = await process_page(MockArgs(), 0, "s3://bucket/edgar.pdf", "tests/gnarly_pdfs/edgar.pdf", 1)
+                journal.flush()
+
+                # The next worker to claim the item picks up from the checkpoint
+                pipeline.current_page_journal.set(resumed := PageJournal(str(tmp_path), "abc"))
+                resumed.load()
+                second = await process_page(MockArgs(), 0, "s3://bucket/edgar.pdf", "tests/gnarly_pdfs/edgar.pdf", 1)
+            finally:
+                pipeline.current_page_journal.reset(token)
+
+        assert num_requests == 1
+        assert second == first
+        assert second.response.natural_text == "Journaled text" and second.output_tokens == 5
+        assert keeper.total_metrics["checkpoint_pages_replayed"] == 1
+
+
 class TestMarkdownPathHandling:
     """Tests for the get_markdown_path function to ensure files stay within workspace."""
 
@@ -568,3 +782,890 @@ class TestMarkdownPathHandling:
         assert resolved_path.startswith(resolved_workspace), (
             f"BUG: Path traversal attack! Markdown path '{resolved_path}' escapes " f"workspace '{resolved_workspace}'. Paths with ../ should be sanitized."
         )
+
+
+class LocalHttpServer:
+    """Stand-in for the inference server, speaks just enough HTTP/1.1 keep-alive to exercise apost."""
+
+    def __init__(self, connection_close: bool = False, metrics_text: str | None = None, sse_events: list | None = None):
+        self.connection_close = connection_close
+        self.metrics_text = metrics_text
+        self.sse_events = sse_events
+        self.sse_events_sent = 0
+        self.connections = 0
+        self.requests = 0
+        self.writers = []
+        self.server = None
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        self.writers.append(writer)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b""):
+                    key, _, value = line.decode().partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                if request_line.startswith(b"GET /metrics"):
+                    response = self.metrics_text.encode()
+                    writer.write(b"HTTP/1.1 200 OK\r\n" + f"Content-Length: {len(response)}\r\n\r\n".encode() + response)
+                    await writer.drain()
+                    continue
+
+                body = await reader.readexactly(int(headers["content-length"]))
+                self.requests += 1
+
+                if self.sse_events is not None:
+                    # One chunk per event, like a streaming completion, stopping early if the client hangs up
+                    writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+                    for event in self.sse_events + ["[DONE]"]:
+                        data = f"data: {event if isinstance(event, str) else json.dumps(event)}\n\n".encode()
+                        writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                        await writer.drain()
+                        await asyncio.sleep(0)
+                        if reader.at_eof():
+                            return
+                        self.sse_events_sent += 1
+                    writer.write(b"0\r\n\r\n")
+                    await writer.drain()
+                    continue
+
+                response = json.dumps({"echo": json.loads(body), "request": self.requests}).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(response)}\r\n".encode()
+                    + (b"Connection: close\r\n" if self.connection_close else b"")
+                    + b"\r\n"
+                    + response
+                )
+                await writer.drain()
+                if self.connection_close:
+                    break
+        finally:
+            writer.close()
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.url = f"http://127.0.0.1:{self.server.sockets[0].getsockname()[1]}/v1/chat/completions"
+        return self
+
+    async def __aexit__(self, *exc):
+        for writer in self.writers:
+            writer.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    def drop_idle_connections(self):
+        for writer in self.writers:
+            writer.close()
+
+
+class TestApostConnectionPool:
+    @pytest.mark.asyncio
+    async def test_connections_are_reused(self):
+        pool = HttpConnectionPool()
+        async with LocalHttpServer() as server:
+            with patch("olmocr.pipeline.http_pool", pool):
+                for i in range(5):
+                    status, body = await apost(server.url, {"i": i})
+                    assert status == 200
+                    assert json.loads(body)["echo"] == {"i": i}
+
+            assert server.connections == 1
+            assert pool.stats["opened"] == 1
+            assert pool.stats["reused"] == 4
+            pool.close_all()
+
+    @pytest.mark.asyncio
+    async def test_concurrent_requests_open_separate_connections(self):
+        pool = HttpConnectionPool(max_idle_per_host=2)
+        async with LocalHttpServer() as server:
+            with patch("olmocr.pipeline.http_pool", pool):
+                results = await asyncio.gather(*[apost(server.url, {"i": i}) for i in range(4)])
+                assert all(status == 200 for status, _ in results)
+                assert pool.idle_connections == 2
+                assert pool.stats["closed_overflow"] == 2
+            pool.close_all()
+
+    @pytest.mark.asyncio
+    async def test_stale_connection_is_retried(self):
+        pool = HttpConnectionPool()
+        async with LocalHttpServer() as server:
+            with patch("olmocr.pipeline.http_pool", pool):
+                await apost(server.url, {"i": 0})
+
+                # Server goes away from under the idle connection, the next request should transparently reconnect
+                server.drop_idle_connections()
+                await asyncio.sleep(0.05)
+                status, body = await apost(server.url, {"i": 1})
+
+            assert status == 200
+            assert json.loads(body)["echo"] == {"i": 1}
+            assert server.connections == 2
+            assert pool.stats["closed_stale"] + pool.stats["stale_retries"] == 1
+            pool.close_all()
+
+    @pytest.mark.asyncio
+    async def test_idle_timeout_and_recycling(self):
+        pool = HttpConnectionPool(max_requests_per_connection=2, idle_timeout_secs=60)
+        async with LocalHttpServer() as server:
+            with patch("olmocr.pipeline.http_pool", pool):
+                for i in range(4):
+                    await apost(server.url, {"i": i})
+                assert server.connections == 2
+                assert pool.stats["closed_recycled"] == 2
+
+                pool.idle_timeout_secs = 0
+                await apost(server.url, {"i": 4})
+                assert server.connections == 3
+            pool.close_all()
+
+    @pytest.mark.asyncio
+    async def test_connection_close_is_respected(self):
+        pool = HttpConnectionPool()
+        async with LocalHttpServer(connection_close=True) as server:
+            with patch("olmocr.pipeline.http_pool", pool):
+                for i in range(3):
+                    status, _ = await apost(server.url, {"i": i})
+                    assert status == 200
+
+            assert server.connections == 3
+            assert pool.idle_connections == 0
+
+
+class TestStreamedRequestBody:
+    def _page_query(self, image_base64: str) -> dict:
+        return {
+            "model": "olmocr",
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": 'Prompt with "quotes", \\ backslashes, ünïcode and\nnewlines'},
+                        {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_base64}"}},
+                    ],
+                }
+            ],
+            "max_tokens": 8000,
+            "temperature": 0.1,
+        }
+
+    def test_parts_match_json_dumps(self):
+        image_base64 = base64.b64encode(os.urandom(300_000)).decode()
+        query = self._page_query(image_base64)
+
+        parts = json_body_parts(query)
+
+        assert b"".join(parts) == json.dumps(query).encode()
+        assert any(part.nbytes == len("data:image/png;base64,") + len(image_base64) for part in parts)
+
+    def test_long_strings_needing_escapes_are_not_streamed(self):
+        query = {"a": "x" * 100_000 + '"', "b": "y" * 100_000 + "é", "c": ["z" * 100_000, "z" * 100_000]}
+        parts = json_body_parts(query)
+        assert b"".join(parts) == json.dumps(query).encode()
+
+    def test_peak_memory_below_single_string_request(self):
+        image_base64 = base64.b64encode(os.urandom(3_000_000)).decode()
+        query = self._page_query(image_base64)
+
+        def build_whole_request():
+            payload = json.dumps(query)
+            return ("POST /v1/chat/completions HTTP/1.1\r\n\r\n" + payload).encode()
+
+        def peak_allocated(fn):
+            tracemalloc.start()
+            try:
+                result = fn()
+                return tracemalloc.get_traced_memory()[1], result
+            finally:
+                tracemalloc.stop()
+
+        whole_peak, _ = peak_allocated(build_whole_request)
+        streamed_peak, _ = peak_allocated(lambda: json_body_parts(query))
+
+        # The old path holds the json string, the header+body string and the encoded bytes at once
+        assert whole_peak > 2.5 * len(image_base64)
+        assert streamed_peak < 1.2 * len(image_base64)
+
+    @pytest.mark.asyncio
+    async def test_apost_streams_large_body(self):
+        image_base64 = base64.b64encode(os.urandom(1_000_000)).decode()
+        query = self._page_query(image_base64)
+        pool = HttpConnectionPool()
+        async with LocalHttpServer() as server:
+            with patch("olmocr.pipeline.http_pool", pool):
+                status, body = await apost(server.url, query)
+            pool.close_all()
+
+        assert status == 200
+        assert json.loads(body)["echo"] == query
+
+
+VLLM_METRICS_TEXT = """# HELP vllm:num_requests_running Number of requests in model execution batches.
+# TYPE vllm:num_requests_running gauge
+vllm:num_requests_running{engine="0",model_name="olmocr"} 120.0
+vllm:num_requests_running{engine="1",model_name="olmocr"} 100.0
+# TYPE vllm:num_requests_waiting gauge
+vllm:num_requests_waiting{engine="0",model_name="olmocr"} 30.0
+vllm:num_requests_waiting{engine="1",model_name="olmocr"} 12.0
+# TYPE vllm:kv_cache_usage_perc gauge
+vllm:kv_cache_usage_perc{engine="0",model_name="olmocr"} 0.5
+vllm:kv_cache_usage_perc{engine="1",model_name="olmocr"} 0.7
+# TYPE vllm:generation_tokens_total counter
+vllm:generation_tokens_total{engine="0",model_name="olmocr"} 1000.0
+vllm:generation_tokens_total{engine="1",model_name="olmocr"} 500.0
+"""
+
+
+FRONT_MATTER = "---\nprimary_language: en\nis_rotation_valid: true\nrotation_correction: 0\nis_table: false\nis_diagram: false\n---\n"
+
+
+def completion_chunk(content=None, finish_reason=None, usage=None):
+    return {"choices": [{"delta": {"content": content} if content else {}, "finish_reason": finish_reason}], "usage": usage}
+
+
+class TestStreamingRepeatAbort:
+    def test_streamed_completion_matches_regular_response(self):
+        tokens = [FRONT_MATTER] + [f"word{i} " for i in range(200)]
+        events = [completion_chunk(token) for token in tokens] + [
+            completion_chunk(finish_reason="stop"),
+            {"choices": [], "usage": {"prompt_tokens": 900, "completion_tokens": len(tokens), "total_tokens": 900 + len(tokens)}},
+        ]
+        stream = b"".join(f"data: {json.dumps(event)}\n\n".encode() for event in events) + b"data: [DONE]\n\n"
+
+        completion = StreamedCompletion(repeat_abort_chars=1500)
+        # Network chunks don't line up with events
+        for i in range(0, len(stream), 37):
+            assert completion.feed(stream[i : i + 37])
+
+        assert completion.response_data() == {
+            "choices": [{"message": {"content": "".join(tokens)}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 900, "completion_tokens": len(tokens), "total_tokens": 900 + len(tokens)},
+        }
+        assert not completion.repeat_detected
+
+    @pytest.mark.asyncio
+    async def test_repetition_loop_aborts_request(self):
+        tokens = [FRONT_MATTER, "| Item | Value |\n"] + ["| 0 | 0 |\n"] * 3000
+        events = [completion_chunk(token) for token in tokens] + [completion_chunk(finish_reason="length")]
+
+        async def mock_build_page_query(local_pdf_path, page, target_longest_image_dim, image_rotation=0, model_name="olmocr"):
+            return {"model": model_name, "messages": [], "max_tokens": 8000}
+
+        pool = HttpConnectionPool()
+        keeper = MetricsKeeper()
+        async with LocalHttpServer(sse_events=events) as server:
+            args = MockArgs(stream_requests=True, server=server.url.removesuffix("/chat/completions"))
+            with patch("olmocr.pipeline.http_pool", pool), patch("olmocr.pipeline.metrics", keeper):
+                with patch("olmocr.pipeline.build_page_query", side_effect=mock_build_page_query):
+                    result = await try_single_page(args, "s3://bucket/doc.pdf", "doc.pdf", 1, attempt=0, rotation=0)
+
+            await asyncio.sleep(0.05)
+            assert result is None
+            assert server.sse_events_sent < 500
+            pool.close_all()
+
+        totals = keeper.get_total_metrics()
+        assert totals["repeat_aborted_requests"] == 1
+        assert totals["repeat_aborted_output_tokens"] < 500
+        assert totals["repeat_saved_output_tokens"] == 8000 - totals["repeat_aborted_output_tokens"]
+
+
+class TestCpuStage:
+    @pytest.mark.asyncio
+    async def test_document_steps_run_in_process_pool(self):
+        pool = BoundedProcessPool(1)
+        try:
+            with patch("olmocr.pipeline.cpu_pool", pool):
+                assert await run_cpu_bound(count_local_pdf_pages, "tests/gnarly_pdfs/badlines.pdf") == 10
+                fallback = await make_fallback_result("s3://bucket/badlines.pdf", "tests/gnarly_pdfs/badlines.pdf", 1)
+            assert fallback.is_fallback
+            assert fallback.response.natural_text.strip()
+            # pdftotext is a subprocess already, so fallbacks only wait on it from a thread
+            assert pool.stats["jobs"] == 1
+        finally:
+            pool.shutdown()
+
+    @pytest.mark.asyncio
+    async def test_pages_render_in_render_pool(self):
+        local_pdf_path = "tests/gnarly_pdfs/edgar.pdf"
+        pool = BoundedProcessPool(2, name="Render")
+        open_document_renderer(local_pdf_path, "pdfium")
+        try:
+            expected = document_renderers[local_pdf_path].render_page_to_png(1, 1024)
+            with patch("olmocr.pipeline.render_pool", pool), patch("olmocr.pipeline.render_page_png") as mock_render:
+                pngs = await asyncio.gather(*(get_page_png(local_pdf_path, 1, 1024) for _ in range(4)))
+            assert pngs == [expected] * 4
+            assert pool.stats["jobs"] == 4 and not mock_render.called
+        finally:
+            close_document_renderer(local_pdf_path)
+            pool.shutdown()
+
+    @pytest.mark.asyncio
+    async def test_event_loop_monitor_reports_stalls(self):
+        monitor = EventLoopMonitor(interval=0.01, stall_threshold=0.1)
+        task = asyncio.create_task(monitor.run())
+        await asyncio.sleep(0.05)
+        time.sleep(0.3)  # Blocks the event loop, like CPU work run directly on it would
+        await asyncio.sleep(0.05)
+        task.cancel()
+
+        assert monitor.stalls == 1
+        assert monitor.recent_lag()[1] >= 0.25
+        assert "1 stalls" in str(monitor)
+
+
+class TestServerMetricsPoller:
+    def test_parse_prometheus_metrics(self):
+        samples = parse_prometheus_metrics(VLLM_METRICS_TEXT + 'odd{label="has } and spaces"} 4 1700000000\nmalformed\n')
+        assert samples["vllm:num_requests_waiting"] == [30.0, 12.0]
+        assert samples["vllm:generation_tokens_total"] == [1000.0, 500.0]
+        assert samples["odd"] == [4.0]
+        assert "malformed" not in samples
+
+    def test_server_metrics_url(self):
+        assert server_metrics_url("http://localhost:30024/v1") == "http://localhost:30024/metrics"
+        assert server_metrics_url("https://api.example.com/v1/") == "https://api.example.com/metrics"
+        assert server_metrics_url("http://10.0.0.2:8000") == "http://10.0.0.2:8000/metrics"
+
+    @pytest.mark.asyncio
+    async def test_poller_publishes_queue_depth(self):
+        limiter = AdaptiveConcurrencyLimiter(100)
+        async with LocalHttpServer(metrics_text=VLLM_METRICS_TEXT) as server:
+            args = MockArgs(server=server.url.replace("/chat/completions", ""))
+            with patch("olmocr.pipeline.max_concurrent_requests_limit", limiter), patch("olmocr.pipeline.vllm_server_stats", {}) as stats:
+                task = asyncio.create_task(vllm_metrics_poller(args, interval=0.01))
+                await asyncio.sleep(0.2)
+                assert pipeline.vllm_queued_requests == 42
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+
+        assert limiter.queue_depth == 42
+        assert stats == {"running": 220, "waiting": 42, "kv_cache_usage": 0.6}
+
+    @pytest.mark.asyncio
+    async def test_poller_reads_queue_depth_of_all_endpoints(self):
+        limiter = AdaptiveConcurrencyLimiter(100)
+        second_metrics_text = VLLM_METRICS_TEXT.replace('model_name="olmocr"} 30.0', 'model_name="olmocr"} 10.0')
+        async with LocalHttpServer(metrics_text=VLLM_METRICS_TEXT) as first, LocalHttpServer(metrics_text=second_metrics_text) as second:
+            # The last endpoint has no metrics, and is left out
+            servers = [first.url.replace("/chat/completions", ""), second.url.replace("/chat/completions", ""), "http://127.0.0.1:9/v1"]
+            args = MockArgs(server=",".join(servers))
+            with patch("olmocr.pipeline.max_concurrent_requests_limit", limiter), patch("olmocr.pipeline.vllm_server_stats", {}) as stats:
+                task = asyncio.create_task(vllm_metrics_poller(args, interval=0.01))
+                await asyncio.sleep(0.2)
+                assert pipeline.vllm_queued_requests == 64
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+
+        # The limit on the queue depth is per server, so it's held against the deepest one rather than the sum
+        assert limiter.queue_depth == 42
+        assert stats == {"running": 440, "waiting": 64, "kv_cache_usage": 0.6}
+
+    @pytest.mark.asyncio
+    async def test_poller_reraises_cancelled_fetch(self):
+        async def cancelled_get(self, url, **kwargs):
+            raise asyncio.CancelledError()
+
+        limiter = AdaptiveConcurrencyLimiter(100)
+        args = MockArgs(server="http://127.0.0.1:9/v1")
+        with patch("olmocr.pipeline.max_concurrent_requests_limit", limiter), patch("httpx.AsyncClient.get", cancelled_get):
+            with pytest.raises(asyncio.CancelledError):
+                await asyncio.wait_for(vllm_metrics_poller(args, interval=0.01), timeout=5)
+
+        assert limiter.queue_depth is None
+
+    @pytest.mark.asyncio
+    async def test_poller_without_metrics_endpoint(self):
+        limiter = AdaptiveConcurrencyLimiter(100)
+        limiter.observe_queue_depth(7)
+        args = MockArgs(server="http://127.0.0.1:9/v1")
+        with patch("olmocr.pipeline.max_concurrent_requests_limit", limiter):
+            task = asyncio.create_task(vllm_metrics_poller(args, interval=0.01))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        assert limiter.queue_depth is None
+
+
+class TestEndpointRouting:
+    @pytest.mark.asyncio
+    async def test_failing_endpoint_is_ejected(self):
+        requests_by_url = {}
+
+        async def mock_build_page_query(local_pdf_path, page, target_longest_image_dim, image_rotation=0, model_name="olmocr"):
+            return {"model": model_name, "messages": [], "max_tokens": 100}
+
+        async def mock_apost(url, json_data, api_key=None):
+            requests_by_url.setdefault((url, api_key), 0)
+            requests_by_url[(url, api_key)] += 1
+            if "broken" in url:
+                return 503, b"unavailable"
+            content = "---\nprimary_language: en\nis_rotation_valid: true\nrotation_correction: 0\nis_table: false\nis_diagram: false\n---\nText"
+            response_body = {
+                "choices": [{"message": {"content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 7, "total_tokens": 17},
+            }
+            return 200, json.dumps(response_body).encode()
+
+        # The broken endpoint is weighted to get every request while it's healthy
+        args = MockArgs(server="http://broken:8000/v1;weight=100,http://working:8000/v1;api_key=secret")
+        keeper = MetricsKeeper()
+        with patch("olmocr.pipeline.apost", side_effect=mock_apost), patch("olmocr.pipeline.build_page_query", side_effect=mock_build_page_query):
+            with patch("olmocr.pipeline.metrics", keeper):
+                results = [await try_single_page(args, "s3://bucket/a.pdf", "a.pdf", 1, attempt=0, rotation=0) for _ in range(20)]
+
+        # Until it has failed enough times in a row to be ejected
+        assert requests_by_url[("http://broken:8000/v1/chat/completions", None)] == 5
+        assert requests_by_url[("http://working:8000/v1/chat/completions", "secret")] == 15
+        assert sum(result is not None for result in results) == 15
+        assert keeper.total_metrics["server_output_tokens@working:8000"] == 15 * 7
+
+
+class TestHedgedRequests:
+    def test_latency_percentile_over_window(self):
+        keeper = MetricsKeeper()
+        assert keeper.percentile("page_request_secs", 95) is None
+        for latency in range(1, 101):
+            keeper.add_sample("page_request_secs", latency / 100)
+        assert keeper.sample_count("page_request_secs") == 100
+        assert keeper.percentile("page_request_secs", 95) == 0.95
+        assert keeper.percentile("page_request_secs", 100) == 1.0
+
+    @pytest.mark.asyncio
+    async def test_straggler_is_hedged_to_another_endpoint(self):
+        cancelled_urls = []
+
+        async def mock_build_page_query(local_pdf_path, page, target_longest_image_dim, image_rotation=0, model_name="olmocr"):
+            return {"model": model_name, "messages": [], "max_tokens": 100}
+
+        async def mock_apost(url, json_data, api_key=None):
+            try:
+                await asyncio.sleep(10 if "slow" in url else 0.05)
+            except asyncio.CancelledError:
+                cancelled_urls.append(url)
+                raise
+            content = "---\nprimary_language: en\nis_rotation_valid: true\nrotation_correction: 0\nis_table: false\nis_diagram: false\n---\nText"
+            response_body = {
+                "choices": [{"message": {"content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 7, "total_tokens": 17},
+            }
+            return 200, json.dumps(response_body).encode()
+
+        # The slow endpoint gets the first request, and recent requests all took 100ms
+        args = MockArgs(server="http://slow:8000/v1;weight=100,http://fast:8000/v1", hedge_requests=True, hedge_max_fraction=0.5)
+        keeper = MetricsKeeper()
+        keeper.add_metrics(page_requests=20)
+        for _ in range(20):
+            keeper.add_sample("page_request_secs", 0.1)
+
+        with patch("olmocr.pipeline.apost", side_effect=mock_apost), patch("olmocr.pipeline.build_page_query", side_effect=mock_build_page_query):
+            with patch("olmocr.pipeline.metrics", keeper), patch("olmocr.pipeline.max_concurrent_requests_limit", AdaptiveConcurrencyLimiter(10)):
+                start = time.perf_counter()
+                result = await try_single_page(args, "s3://bucket/a.pdf", "a.pdf", 1, attempt=0, rotation=0)
+                await asyncio.sleep(0)
+
+        assert result is not None and result.response.natural_text == "Text"
+        assert time.perf_counter() - start < 1
+        assert keeper.total_metrics["hedged_requests"] == 1
+        assert keeper.total_metrics["hedge_wins"] == 1
+        assert cancelled_urls == ["http://slow:8000/v1/chat/completions"]
+
+    @pytest.mark.asyncio
+    async def test_requests_waiting_for_a_slot_are_not_hedged(self):
+        async def mock_apost(url, json_data, api_key=None):
+            await asyncio.sleep(0.3)
+            return 200, b"{}"
+
+        args = MockArgs(server="http://a:8000/v1,http://b:8000/v1", hedge_requests=True, hedge_max_fraction=1.0)
+        keeper = MetricsKeeper()
+        keeper.add_metrics(page_requests=20)
+        for _ in range(20):
+            keeper.add_sample("page_request_secs", 0.5)
+
+        # The second request waits 300ms for the only slot, which would be past the hedge latency if it counted
+        with patch("olmocr.pipeline.apost", side_effect=mock_apost), patch("olmocr.pipeline.metrics", keeper):
+            with patch("olmocr.pipeline.max_concurrent_requests_limit", AdaptiveConcurrencyLimiter(1)):
+                requests = await asyncio.gather(*(send_hedged_page_request(args, {"messages": []}) for _ in range(2)))
+
+        assert all(request.succeeded for request in requests)
+        assert keeper.total_metrics["hedged_requests"] == 0
+        assert max(latency for _, latency in list(keeper.window_samples["page_request_secs"])[-2:]) < 0.45
+
+    @pytest.mark.asyncio
+    async def test_hedges_are_capped_by_budget(self):
+        async def mock_build_page_query(local_pdf_path, page, target_longest_image_dim, image_rotation=0, model_name="olmocr"):
+            return {"model": model_name, "messages": [], "max_tokens": 100}
+
+        async def mock_apost(url, json_data, api_key=None):
+            await asyncio.sleep(0.05)
+            return 503, b"unavailable"
+
+        args = MockArgs(server="http://a:8000/v1,http://b:8000/v1", hedge_requests=True, hedge_max_fraction=0.05)
+        keeper = MetricsKeeper()
+        for _ in range(20):
+            keeper.add_sample("page_request_secs", 0.001)
+
+        with patch("olmocr.pipeline.apost", side_effect=mock_apost), patch("olmocr.pipeline.build_page_query", side_effect=mock_build_page_query):
+            with patch("olmocr.pipeline.metrics", keeper):
+                for _ in range(30):
+                    assert await try_single_page(args, "s3://bucket/a.pdf", "a.pdf", 1, attempt=0, rotation=0) is None
+
+        # Each hedge needs another 20 page requests of budget
+        assert keeper.total_metrics["hedged_requests"] == 2
+        assert keeper.total_metrics["hedge_wins"] + keeper.total_metrics["hedge_losses"] == 0
+
+
+@dataclass
+class MockDocumentArgs(MockArgs):
+    workspace: str = ""
+    apply_filter: bool = False
+    render_cache_pages: int = 0
+    max_page_error_rate: float = 0.004
+    markdown: bool = False
+    tarball_max_pending_pdfs: int = 32
+    output_compression: str = "none"
+    stats_cache_dir: str = ""
+    worker_lock_heartbeat_secs: float = 60
+
+
+class TestPageRangeShards:
+    async def _process(self, args, page_range=None):
+        async def mock_build_page_query(local_pdf_path, page, target_longest_image_dim, image_rotation=0, model_name="olmocr"):
+            return {"model": model_name, "messages": [], "page": page}
+
+        async def mock_apost(url, json_data, api_key=None):
+            page = json_data["page"]
+            content = "---\nprimary_language: en\nis_rotation_valid: true\nrotation_correction: 0\nis_table: false\nis_diagram: false\n---"
+            # Leave a blank page in the middle of the first shard, and one at the end of it
+            if page not in (2, 4):
+                content += f"\nText of page {page}"
+            response_body = {
+                "choices": [{"message": {"content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 1000, "completion_tokens": page, "total_tokens": 1000 + page},
+            }
+            return 200, json.dumps(response_body).encode()
+
+        with patch("olmocr.pipeline.apost", side_effect=mock_apost), patch("olmocr.pipeline.tracker", AsyncMock()):
+            with patch("olmocr.pipeline.build_page_query", side_effect=mock_build_page_query):
+                return await process_single_pdf(args, 0, "s3://bucket/badlines.pdf", "tests/gnarly_pdfs/badlines.pdf", page_range=page_range)
+
+    @pytest.mark.asyncio
+    async def test_merged_shards_match_whole_document(self, tmp_path):
+        args = MockDocumentArgs(workspace=str(tmp_path))
+        whole_doc = await self._process(args)
+        assert whole_doc["metadata"]["pdf-total-pages"] == 10
+
+        # The shards finish out of order, only the last one to finish merges the document
+        for page_range in [(5, 8), (1, 4)]:
+            assert await self._process(args, page_range) is None
+            assert not os.path.exists(tmp_path / "results")
+        assert await self._process(args, (9, 12)) is None
+
+        results = list((tmp_path / "results").glob("output_merged_*.jsonl"))
+        assert len(results) == 1
+        merged_doc = json.loads(results[0].read_text())
+
+        assert merged_doc["text"] == whole_doc["text"]
+        assert merged_doc["id"] == whole_doc["id"]
+        assert merged_doc["metadata"] == whole_doc["metadata"]
+        assert merged_doc["attributes"] == whole_doc["attributes"]
+        assert not os.path.exists(pipeline.get_page_shards_dir(str(tmp_path), "s3://bucket/badlines.pdf"))
+
+    @pytest.mark.asyncio
+    async def test_failed_shard_discards_document(self, tmp_path):
+        args = MockDocumentArgs(workspace=str(tmp_path))
+        real_process_pages = pipeline.process_pages
+
+        async def mock_process_pages(args, worker_id, pdf_orig_path, pdf_local_path, page_nums, num_pages=None):
+            if page_nums[0] == 5:
+                return None  # This shard exceeds the error budget on its own
+            return await real_process_pages(args, worker_id, pdf_orig_path, pdf_local_path, page_nums, num_pages)
+
+        keeper = MetricsKeeper()
+        with patch("olmocr.pipeline.process_pages", side_effect=mock_process_pages), patch("olmocr.pipeline.metrics", keeper):
+            for page_range in [(1, 4), (5, 8)]:
+                assert await self._process(args, page_range) is None
+            assert os.path.exists(tmp_path / "page_shards")
+            assert await self._process(args, (9, 12)) is None
+
+        assert not os.path.exists(tmp_path / "results")
+        assert not os.path.exists(pipeline.get_page_shards_dir(str(tmp_path), "s3://bucket/badlines.pdf"))
+        assert keeper.total_metrics["failed_shard_documents"] == 1
+
+    @pytest.mark.asyncio
+    async def test_shard_exception_fails_work_item(self, tmp_path):
+        args = MockDocumentArgs(workspace=str(tmp_path))
+        with patch("olmocr.pipeline.process_pages", side_effect=RuntimeError("boom")):
+            with pytest.raises(RuntimeError):
+                await self._process(args, (1, 4))
+            assert await self._process(args) is None
+
+        assert not os.path.exists(tmp_path / "page_shards")
+
+
+class TestFallbackBudget:
+    @pytest.mark.asyncio
+    async def test_document_aborts_once_budget_cannot_be_met(self):
+        cancelled_pages = []
+
+        async def mock_process_page(args, worker_id, pdf_orig_path, pdf_local_path, page_num):
+            # Pages 9 and 10 succeed, then 1-3 fall back, and the rest are still running when the budget runs out
+            is_fallback = page_num <= 3
+            try:
+                await asyncio.sleep({9: 0, 10: 0, 1: 0.05, 2: 0.05, 3: 0.1}.get(page_num, 30))
+            except asyncio.CancelledError:
+                cancelled_pages.append(page_num)
+                raise
+            response = PageResponse(None, True, 0, False, False, f"Page {page_num}")
+            return PageResult(pdf_orig_path, page_num, response, 0, 0, is_fallback=is_fallback, is_valid=True)
+
+        keeper = MetricsKeeper()
+        keeper.add_metrics(server_input_tokens=900, server_output_tokens=100, completed_pages=10)
+        args = MockDocumentArgs(max_page_error_rate=0.25)
+        start = time.perf_counter()
+        with patch("olmocr.pipeline.process_page", side_effect=mock_process_page), patch("olmocr.pipeline.tracker", AsyncMock()):
+            with patch("olmocr.pipeline.metrics", keeper):
+                assert await process_single_pdf(args, 0, "s3://bucket/badlines.pdf", "tests/gnarly_pdfs/badlines.pdf") is None
+
+        assert time.perf_counter() - start < 5
+        assert sorted(cancelled_pages) == [4, 5, 6, 7, 8]
+        assert keeper.total_metrics["fallback_aborted_documents"] == 1
+        assert keeper.total_metrics["fallback_aborted_pages"] == 5
+        assert keeper.total_metrics["fallback_abort_saved_tokens_est"] == 500
+        assert keeper.total_metrics["fallback_abort_saved_secs_est"] > 0
+
+    @pytest.mark.asyncio
+    async def test_document_within_budget_finishes(self):
+        async def mock_process_page(args, worker_id, pdf_orig_path, pdf_local_path, page_num):
+            response = PageResponse(None, True, 0, False, False, f"Page {page_num}")
+            return PageResult(pdf_orig_path, page_num, response, 0, 0, is_fallback=page_num <= 2, is_valid=True)
+
+        args = MockDocumentArgs(max_page_error_rate=0.25)
+        with patch("olmocr.pipeline.process_page", side_effect=mock_process_page), patch("olmocr.pipeline.tracker", AsyncMock()):
+            doc = await process_single_pdf(args, 0, "s3://bucket/badlines.pdf", "tests/gnarly_pdfs/badlines.pdf")
+
+        assert doc["metadata"]["pdf-total-pages"] == 10
+
+
+class TestTarballStreaming:
+    @pytest.mark.asyncio
+    async def test_extraction_is_bounded_by_pending_pdfs(self, tmp_path):
+        tarball_path = str(tmp_path / "batch.tar.gz")
+        with tarfile.open(tarball_path, "w:gz") as tar:
+            tar.add("tests/gnarly_pdfs/edgar.pdf", arcname="README.txt")
+            for i in range(6):
+                tar.add("tests/gnarly_pdfs/edgar.pdf", arcname=f"docs/{i}/edgar.pdf")
+
+        in_flight = 0
+        max_in_flight = 0
+        local_paths = []
+
+        async def mock_process_single_pdf(args, worker_id, pdf_orig_path, local_pdf_path):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            local_paths.append(local_pdf_path)
+            assert os.path.getsize(local_pdf_path) == os.path.getsize("tests/gnarly_pdfs/edgar.pdf")
+            await asyncio.sleep(0.05)
+            in_flight -= 1
+            return {"id": pdf_orig_path}
+
+        with patch("olmocr.pipeline.process_single_pdf", side_effect=mock_process_single_pdf):
+            docs = await process_tarball(MockDocumentArgs(tarball_max_pending_pdfs=2), 0, tarball_path)
+
+        assert sorted(doc["id"] for doc in docs) == [f"{tarball_path}::docs/{i}/edgar.pdf" for i in range(6)]
+        assert max_in_flight == 2
+        assert not any(os.path.exists(path) for path in local_paths)
+
+    @pytest.mark.asyncio
+    async def test_failure_waits_for_extraction_before_cleanup(self, tmp_path):
+        tarball_path = str(tmp_path / "batch.tar.gz")
+        with tarfile.open(tarball_path, "w:gz") as tar:
+            for i in range(3):
+                tar.add("tests/gnarly_pdfs/edgar.pdf", arcname=f"docs/{i}/edgar.pdf")
+
+        events = []
+        second_copy_started = threading.Event()
+        real_copyfileobj, real_rmtree = shutil.copyfileobj, shutil.rmtree
+
+        def slow_copyfileobj(src, dst, *args):
+            if events.count("copied") == 1:
+                second_copy_started.set()
+                time.sleep(0.3)
+            real_copyfileobj(src, dst, *args)
+            events.append("copied")
+
+        def recording_rmtree(path, *args, **kwargs):
+            events.append("rmtree")
+            real_rmtree(path, *args, **kwargs)
+
+        async def mock_process_single_pdf(args, worker_id, pdf_orig_path, local_pdf_path):
+            await asyncio.to_thread(second_copy_started.wait, 5)
+            raise RuntimeError("boom")
+
+        with patch("olmocr.pipeline.process_single_pdf", side_effect=mock_process_single_pdf):
+            with patch("shutil.copyfileobj", slow_copyfileobj), patch("shutil.rmtree", recording_rmtree):
+                with pytest.raises(ExceptionGroup):
+                    await process_tarball(MockDocumentArgs(tarball_max_pending_pdfs=2), 0, tarball_path)
+
+        # The second PDF was still being spilled when the first one failed, and the temp dir outlived it
+        assert events == ["copied", "copied", "rmtree"]
+
+
+class TestDuplicateDocuments:
+    @pytest.mark.asyncio
+    async def test_duplicates_get_copies_of_canonical_output(self, tmp_path):
+        args = MockDocumentArgs(workspace=str(tmp_path))
+        doc = {
+            "id": "abc",
+            "text": "Hello",
+            "metadata": {"Source-File": "s3://bucket/a.pdf", "pdf-total-pages": 1, "total-input-tokens": 10, "total-output-tokens": 5},
+            "attributes": {"pdf_page_numbers": [[0, 5, 1]]},
+        }
+
+        with patch.dict("olmocr.pipeline.document_duplicates", {"s3://bucket/a.pdf": ["s3://mirror/a-copy.pdf"]}):
+            await write_dolma_docs(args, "test", [doc])
+
+        written = [json.loads(line) for line in (tmp_path / "results" / "output_test.jsonl").read_text().splitlines()]
+        assert written[0] == doc
+        assert len(written) == 2
+        duplicate = written[1]
+        assert duplicate["text"] == doc["text"] and duplicate["attributes"] == doc["attributes"]
+        assert duplicate["metadata"]["Source-File"] == "s3://mirror/a-copy.pdf"
+        assert duplicate["metadata"]["duplicate-of"] == "s3://bucket/a.pdf"
+        assert duplicate["metadata"]["total-output-tokens"] == 0
+
+    @pytest.mark.asyncio
+    async def test_late_duplicates_of_done_document_are_written(self, tmp_path):
+        args = MockDocumentArgs(workspace=str(tmp_path / "workspace"), output_compression="zstd")
+        work_queue = WorkQueue(LocalBackend(args.workspace))
+        doc = {
+            "id": "abc",
+            "text": "Hello",
+            "metadata": {"Source-File": "/data/a.pdf", "pdf-total-pages": 1, "total-input-tokens": 10, "total-output-tokens": 5},
+            "attributes": {"pdf_page_numbers": [[0, 5, 1]]},
+        }
+
+        # First --pdfs run, whose work item gets done
+        paths = await dedupe_pdf_paths(args, work_queue, {"/data/a.pdf", "/data/b.pdf"}, {"/data/a.pdf": "h1", "/data/b.pdf": "h1"})
+        assert paths == {"/data/a.pdf"}
+        await work_queue.populate_queue(sorted(paths), items_per_group=1)
+        work_hash = WorkQueue._compute_workgroup_hash(["/data/a.pdf"])
+        with patch.dict("olmocr.pipeline.document_duplicates", await work_queue.load_duplicates()):
+            await write_dolma_docs(args, work_hash, [doc])
+        await work_queue.backend.create_done_flag(work_hash)
+
+        # Second run, with a new copy that nothing queued would emit
+        paths = await dedupe_pdf_paths(args, work_queue, {"/data/a.pdf", "/mirror/a.pdf"}, {"/data/a.pdf": "h1", "/mirror/a.pdf": "h1"})
+        await work_queue.populate_queue(sorted(paths), items_per_group=1)
+        assert await work_queue.load_all_items() == {work_hash: WorkItem(work_hash, ["/data/a.pdf"])}
+
+        results = glob.glob(os.path.join(args.workspace, "results", "*"))
+        assert len(results) == 2 and os.path.join(args.workspace, "results", f"output_{work_hash}.jsonl.zst") in results
+        duplicates_path = glob.glob(os.path.join(args.workspace, "results", "output_duplicates_*.jsonl.zst"))[0]
+        with open(duplicates_path, "rb") as f:
+            written = [json.loads(line) for line in decode_output_lines(duplicates_path, f.read())]
+        assert [d["metadata"]["Source-File"] for d in written] == ["/mirror/a.pdf"]
+        assert written[0]["metadata"]["duplicate-of"] == "/data/a.pdf" and written[0]["text"] == "Hello"
+
+        # Copies of a document that isn't done yet are left to its work item
+        paths = await dedupe_pdf_paths(args, work_queue, {"/data/c.pdf"}, {"/data/c.pdf": "h2"})
+        await work_queue.populate_queue(sorted(paths), items_per_group=1)
+        await dedupe_pdf_paths(args, work_queue, {"/mirror/c.pdf"}, {"/mirror/c.pdf": "h2"})
+        assert len(glob.glob(os.path.join(args.workspace, "results", "*"))) == 2
+
+
+class TestWorkerLockHeartbeat:
+    @pytest.mark.asyncio
+    async def test_heartbeat_stops_once_another_replica_holds_the_lock(self, tmp_path):
+        args = MockDocumentArgs(workspace=str(tmp_path), worker_lock_heartbeat_secs=0)
+        work_queue = WorkQueue(LocalBackend(args.workspace), replica_id="replica-1")
+        other_replica = WorkQueue(LocalBackend(args.workspace), replica_id="replica-2")
+        work_item = WorkItem("abc", ["/data/a.pdf"])
+        keeper = MetricsKeeper()
+        read_lock = work_queue.backend.read_worker_lock
+        renewals = 0
+
+        # The second heartbeat reads its own lock, and the item is taken over before it writes the renewal
+        async def read_then_take_over(work_hash):
+            nonlocal renewals
+            renewals += 1
+            lock = await read_lock(work_hash)
+            if renewals == 2:
+                await other_replica._write_lock(work_item)
+            return lock
+
+        await work_queue._write_lock(work_item)
+        with patch("olmocr.pipeline.metrics", keeper), patch.object(work_queue.backend, "read_worker_lock", side_effect=read_then_take_over):
+            await worker_lock_heartbeat(args, work_queue, work_item)
+
+        assert renewals == 2
+        assert keeper.total_metrics["worker_lock_heartbeats"] == 1
+        assert keeper.total_metrics["worker_locks_lost"] == 1
+        assert await work_queue.get_lock_owner(work_item.hash) == "replica-2"
+
+
+class TestOutputCompression:
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("compression,extension", [("none", ""), ("zstd", ".zst"), ("gzip", ".gz")])
+    async def test_compressed_results_and_markdown(self, tmp_path, compression, extension):
+        args = MockDocumentArgs(workspace=str(tmp_path), markdown=True, output_compression=compression)
+        docs = [{"id": str(i), "text": f"Text {i}", "metadata": {"Source-File": f"s3://bucket/docs/{i}.pdf"}, "attributes": {}} for i in range(20)]
+
+        await write_dolma_docs(args, "abc", docs)
+
+        output_path = tmp_path / "results" / f"output_abc.jsonl{extension}"
+        assert [json.loads(line) for line in decode_output_lines(str(output_path), output_path.read_bytes())] == docs
+        for i in range(20):
+            assert (tmp_path / "markdown" / "docs" / f"{i}.md").read_text() == f"Text {i}"
+
+
+class TestWorkspaceStats:
+    @pytest.mark.asyncio
+    async def test_only_new_results_files_are_fetched(self, tmp_path, capsys):
+        workspace = tmp_path / "workspace"
+        args = MockDocumentArgs(workspace=str(workspace), output_compression="zstd", stats_cache_dir=str(tmp_path / "stats_cache"))
+
+        def make_doc(name, tokens):
+            metadata = {"Source-File": f"s3://bucket/{name}.pdf", "pdf-total-pages": 2, "total-input-tokens": 10, "total-output-tokens": tokens}
+            return {"id": name, "text": "Text", "metadata": metadata, "attributes": {}}
+
+        await write_dolma_docs(args, "a", [make_doc("a1", 100), make_doc("a2", 200)])
+        work_items = {"a": WorkItem("a", ["s3://bucket/a1.pdf", "s3://bucket/a2.pdf"]), "b": WorkItem("b", ["s3://bucket/b1.pdf"])}
+
+        with patch("olmocr.pipeline.get_s3_bytes", side_effect=pipeline.get_s3_bytes) as mock_get:
+            print_stats(args, work_items)
+            assert mock_get.call_count == 1
+            assert "Total output tokens: 300" in capsys.readouterr().out
+
+            await write_dolma_docs(args, "b", [make_doc("b1", 50)])
+            print_stats(args, work_items)
+            assert mock_get.call_count == 2
+            out = capsys.readouterr().out
+            assert "1 summaries cached, 1 to fetch" in out
+            assert "Total output tokens: 350" in out and "Completed items: 2" in out and "Total documents skipped: 0" in out
+
+            # A rewritten results file is fetched again
+            await write_dolma_docs(args, "b", [make_doc("b1", 70)])
+            print_stats(args, work_items)
+            assert mock_get.call_count == 3
+            assert "Total output tokens: 370" in capsys.readouterr().out
+
+
+class TestPageCounting:
+    def test_counts_pdfs_and_images(self, tmp_path):
+        assert get_pdf_page_count("tests/gnarly_pdfs/badlines.pdf") == 10
+        assert get_pdf_page_count("tests/gnarly_pdfs/ambiguous.pdf") == 1
+
+        image_path = tmp_path / "scan.png"
+        create_test_image().save(image_path)
+        assert get_pdf_page_count(str(image_path)) == 1
+
+        broken_path = tmp_path / "broken.pdf"
+        broken_path.write_bytes(b"%PDF-1.4 not really")
+        assert get_pdf_page_count(str(broken_path)) is None
@@ -0,0 +1,115 @@
+import io
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import Mock
+
+from botocore.exceptions import ClientError
+
+from olmocr.result_cache import (
+    S3PageResultCache,
+    SqlitePageResultCache,
+    open_page_result_cache,
+    page_result_cache_key,
+)
+
+
+class TestPageResultCacheKey(unittest.TestCase):
+    def test_key_covers_render_prompt_model_and_dim(self):
+        key = page_result_cache_key(b"png", "prompt", "model", 1288)
+        self.assertEqual(key, page_result_cache_key(b"png", "prompt", "model", 1288))
+        self.assertNotEqual(key, page_result_cache_key(b"png2", "prompt", "model", 1288))
+        self.assertNotEqual(key, page_result_cache_key(b"png", "prompt v2", "model", 1288))
+        self.assertNotEqual(key, page_result_cache_key(b"png", "prompt", "other-model", 1288))
+        self.assertNotEqual(key, page_result_cache_key(b"png", "prompt", "model", 1024))
+
+
+class TestSqlitePageResultCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.temp_dir.name, "cache", "pages.sqlite")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_get_and_put_persist_across_opens(self):
+        cache = SqlitePageResultCache(self.db_path, "model")
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", {"response": {"natural_text": "Hello"}})
+        self.assertEqual(cache.get("a"), {"response": {"natural_text": "Hello"}})
+        self.assertEqual(cache.hit_rate, 0.5)
+        self.assertIn("50.0% hit rate", str(cache))
+        cache.close()
+
+        reopened = open_page_result_cache(self.db_path, "model")
+        self.assertIsInstance(reopened, SqlitePageResultCache)
+        self.assertEqual(reopened.get("a"), {"response": {"natural_text": "Hello"}})
+        reopened.close()
+
+    def test_expired_entries_are_missing(self):
+        cache = SqlitePageResultCache(self.db_path, "model", ttl_secs=0.05)
+        cache.put("a", {"n": 1})
+        self.assertIsNotNone(cache.get("a"))
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats["expired"], 1)
+        self.assertEqual(len(cache), 0)
+        cache.close()
+
+    def test_evicts_least_recently_used_beyond_max_entries(self):
+        cache = SqlitePageResultCache(self.db_path, "model", max_entries=2, evict_every=1)
+        cache.put("a", {"n": 1})
+        time.sleep(0.01)
+        cache.put("b", {"n": 2})
+        time.sleep(0.01)
+        cache.get("a")
+        time.sleep(0.01)
+        cache.put("c", {"n": 3})
+
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("c"))
+        self.assertEqual(cache.stats["evicted"], 1)
+        cache.close()
+
+
+class TestS3PageResultCache(unittest.TestCase):
+    def setUp(self):
+        self.objects = {}
+        self.s3_client = Mock()
+
+        def put_object(Bucket, Key, Body, **kwargs):
+            self.objects[(Bucket, Key)] = Body
+
+        def get_object(Bucket, Key):
+            if (Bucket, Key) not in self.objects:
+                raise ClientError({"Error": {"Code": "NoSuchKey", "Message": "Not Found"}}, "GetObject")
+            return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+        self.s3_client.put_object.side_effect = put_object
+        self.s3_client.get_object.side_effect = get_object
+
+    def test_get_and_put(self):
+        cache = open_page_result_cache("s3://bucket/cache/", "model", s3_client=self.s3_client)
+        self.assertIsInstance(cache, S3PageResultCache)
+
+        key = page_result_cache_key(b"png", "prompt", "model", 1288)
+        self.assertIsNone(cache.get(key))
+        cache.put(key, {"n": 1})
+        self.assertEqual(cache.get(key), {"n": 1})
+        self.assertEqual(list(self.objects), [("bucket", f"cache/{key[:2]}/{key}.json")])
+
+    def test_expired_entries_are_missing(self):
+        cache = S3PageResultCache(self.s3_client, "s3://bucket/cache", "model", ttl_secs=60)
+        self.objects[("bucket", "cache/ab/abc.json")] = json.dumps({"created": time.time() - 120, "value": {"n": 1}}).encode()
+        self.assertIsNone(cache.get("abc"))
+        self.assertEqual(cache.stats["expired"], 1)
+
+    def test_other_errors_are_raised(self):
+        self.s3_client.get_object.side_effect = ClientError({"Error": {"Code": "AccessDenied", "Message": "Denied"}}, "GetObject")
+        cache = S3PageResultCache(self.s3_client, "s3://bucket/cache", "model")
+        with self.assertRaises(ClientError):
+            cache.get("abc")
@@ -1,9 +1,20 @@
+import io
+import os
+import tempfile
 import unittest
-from unittest.mock import MagicMock, Mock
+from io import BytesIO
+from unittest.mock import MagicMock, Mock, patch
 
 from botocore.exceptions import ClientError
+from pypdf import PdfReader
 
-from olmocr.s3_utils import expand_s3_glob
+from olmocr.s3_utils import (
+    S3RangeReader,
+    download_s3_file,
+    expand_s3_glob,
+    get_s3_bytes,
+    list_s3_objects_parallel,
+)
 
 
 class TestExpandS3Glob(unittest.TestCase):
@@ -219,3 +230,106 @@ class TestExpandS3Glob(unittest.TestCase):
 
 if __name__ == "__main__":
     unittest.main()
+
+
+class TestRangedReads(unittest.TestCase):
+    PDF_PATH = "tests/gnarly_pdfs/instructions_and_schematics.pdf"
+
+    def _mock_s3_client(self, data: bytes):
+        s3_client = Mock()
+        s3_client.head_object.return_value = {"ContentLength": len(data)}
+
+        def get_object(Bucket, Key, Range=None):
+            start, end = (int(x) for x in Range[len("bytes=") :].split("-"))
+            return {"Body": BytesIO(data[start : end + 1])}
+
+        s3_client.get_object.side_effect = get_object
+        return s3_client
+
+    def test_local_ranges_match_http_semantics(self):
+        with open(self.PDF_PATH, "rb") as f:
+            data = f.read()
+
+        self.assertEqual(get_s3_bytes(None, self.PDF_PATH, 10, 19), data[10:20])
+        self.assertEqual(get_s3_bytes(None, self.PDF_PATH, 100), data[100:])
+        self.assertEqual(get_s3_bytes(None, self.PDF_PATH, None, 30), data[-30:])
+
+    def test_range_reader_seek_and_read(self):
+        with open(self.PDF_PATH, "rb") as f:
+            data = f.read()
+
+        reader = S3RangeReader(self._mock_s3_client(data), "s3://bucket/doc.pdf", block_size=1000)
+        self.assertEqual(reader.read(10), data[:10])
+        reader.seek(-2500, io.SEEK_END)
+        self.assertEqual(reader.read(2400), data[-2500:-100])
+        reader.seek(995)
+        self.assertEqual(reader.read(10), data[995:1005])
+        self.assertEqual(reader.read(), data[1005:])
+        self.assertEqual(reader.read(5), b"")
+
+    def test_page_count_from_trailer_fetches_a_fraction_of_the_file(self):
+        with open(self.PDF_PATH, "rb") as f:
+            data = f.read()
+
+        reader = S3RangeReader(self._mock_s3_client(data), "s3://bucket/doc.pdf")
+        num_pages = PdfReader(reader, strict=True).trailer["/Root"]["/Pages"]["/Count"]
+
+        self.assertEqual(num_pages, len(PdfReader(self.PDF_PATH).pages))
+        self.assertLess(reader.bytes_fetched, len(data) / 10)
+
+
+class TestDownloadS3File(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.local_path = os.path.join(self.temp_dir.name, "doc.pdf")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_streams_to_disk_with_ranged_gets_above_threshold(self):
+        s3_client = Mock()
+        s3_client.download_fileobj.side_effect = lambda bucket, key, f, Config: f.write(b"%PDF-1.4")
+
+        download_s3_file(s3_client, "s3://bucket/scans/doc.pdf", self.local_path, multipart_threshold=1024, max_concurrency=4)
+
+        bucket, key, _ = s3_client.download_fileobj.call_args[0]
+        config = s3_client.download_fileobj.call_args[1]["Config"]
+        self.assertEqual((bucket, key), ("bucket", "scans/doc.pdf"))
+        self.assertEqual((config.multipart_threshold, config.max_concurrency), (1024, 4))
+        with open(self.local_path, "rb") as f:
+            self.assertEqual(f.read(), b"%PDF-1.4")
+
+    def test_retries_transient_errors_but_not_missing_objects(self):
+        s3_client = Mock()
+        s3_client.download_fileobj.side_effect = [ConnectionError("reset"), None]
+        with patch("olmocr.s3_utils.time.sleep"):
+            download_s3_file(s3_client, "s3://bucket/doc.pdf", self.local_path)
+        self.assertEqual(s3_client.download_fileobj.call_count, 2)
+
+        s3_client.download_fileobj.reset_mock()
+        s3_client.download_fileobj.side_effect = ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+        with self.assertRaises(ClientError):
+            download_s3_file(s3_client, "s3://bucket/doc.pdf", self.local_path)
+        self.assertEqual(s3_client.download_fileobj.call_count, 1)
+
+    def test_local_files_are_copied(self):
+        download_s3_file(None, TestRangedReads.PDF_PATH, self.local_path)
+        with open(TestRangedReads.PDF_PATH, "rb") as src, open(self.local_path, "rb") as dst:
+            self.assertEqual(src.read(), dst.read())
+
+
+class TestListS3ObjectsParallel(unittest.TestCase):
+    def test_lists_every_shard_prefix(self):
+        s3_client = Mock()
+        keys = ["ws/done_flags/done_0abc.flag", "ws/done_flags/done_0def.flag", "ws/done_flags/done_f123.flag"]
+
+        def paginate(Bucket, Prefix):
+            return [{"Contents": [{"Key": key, "LastModified": key} for key in keys if key.startswith(Prefix)]}, {}]
+
+        s3_client.get_paginator.return_value.paginate.side_effect = paginate
+
+        result = list_s3_objects_parallel(s3_client, "s3://bucket/ws/done_flags/done_")
+
+        self.assertEqual(result, {f"s3://bucket/{key}": key for key in keys})
+        prefixes = sorted(call[1]["Prefix"] for call in s3_client.get_paginator.return_value.paginate.call_args_list)
+        self.assertEqual(prefixes, [f"ws/done_flags/done_{c}" for c in "0123456789abcdef"])
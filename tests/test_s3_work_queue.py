@@ -1,12 +1,25 @@
 import asyncio
+import contextlib
 import datetime
+import io
+import json
 import unittest
 from unittest.mock import Mock, patch
 
 from botocore.exceptions import ClientError
 
 # Import the classes we're testing
-from olmocr.work_queue import S3Backend, WorkItem, WorkQueue
+from olmocr.work_queue import (
+    DUPLICATES_INDEX,
+    INDEX_MANIFEST,
+    LEGACY_INDEX,
+    S3Backend,
+    WorkItem,
+    WorkQueue,
+    make_page_range_path,
+    pack_paths_by_pages,
+    parse_page_range_path,
+)
 
 
 class TestS3WorkQueue(unittest.TestCase):
@@ -26,6 +39,18 @@ class TestS3WorkQueue(unittest.TestCase):
         """Clean up after each test method."""
         pass
 
+    @contextlib.contextmanager
+    def index_store(self, store):
+        """Patches index file reads and writes to go to a dict of S3 path to lines"""
+        with patch("olmocr.work_queue.download_zstd_csv", side_effect=lambda client, path: list(store.get(path, []))):
+            with patch("olmocr.work_queue.upload_zstd_csv", side_effect=lambda client, path, lines: store.__setitem__(path, list(lines))) as mock_upload:
+                yield mock_upload
+
+    @staticmethod
+    def index_lines(store):
+        """All index rows in the store, across shards"""
+        return [line for path, lines in store.items() if not path.endswith(INDEX_MANIFEST) for line in lines]
+
     def test_compute_workgroup_hash(self):
         """Test hash computation is deterministic and correct"""
         paths = [
@@ -72,23 +97,27 @@ class TestS3WorkQueue(unittest.TestCase):
     @async_test
     async def test_populate_queue_new_items(self):
         """Test populating queue with new items"""
-        # Mock empty existing index
-        with patch("olmocr.work_queue.download_zstd_csv", return_value=[]):
-            with patch("olmocr.work_queue.upload_zstd_csv") as mock_upload:
-                await self.work_queue.populate_queue(self.sample_paths, items_per_group=2)
-
-                # Verify upload was called with correct data
-                self.assertEqual(mock_upload.call_count, 1)
-                _, _, lines = mock_upload.call_args[0]
-
-                # Should create 2 work groups (2 files + 1 file)
-                self.assertEqual(len(lines), 2)
-
-                # Verify format of uploaded lines
-                for line in lines:
-                    parts = WorkQueue._decode_csv_row(line)
-                    self.assertGreaterEqual(len(parts), 2)  # Hash + at least one path
-                    self.assertEqual(len(parts[0]), 40)  # SHA1 hash length
+        store = {}
+        with self.index_store(store):
+            await self.work_queue.populate_queue(self.sample_paths, items_per_group=2)
+
+        # Should create 2 work groups (2 files + 1 file), in shards named by the first digit of their hash
+        lines = self.index_lines(store)
+        self.assertEqual(len(lines), 2)
+
+        manifest = [WorkQueue._decode_csv_row(line) for line in store[f"s3://test-bucket/workspace/{INDEX_MANIFEST}"]]
+        self.assertEqual(sum(int(count) for _, count in manifest), 2)
+        for name, count in manifest:
+            shard_lines = store[f"s3://test-bucket/workspace/{name}"]
+            self.assertEqual(len(shard_lines), int(count))
+            for line in shard_lines:
+                self.assertTrue(name.startswith(f"work_index/{line[0]}/"))
+
+        # Verify format of uploaded lines
+        for line in lines:
+            parts = WorkQueue._decode_csv_row(line)
+            self.assertGreaterEqual(len(parts), 2)  # Hash + at least one path
+            self.assertEqual(len(parts[0]), 40)  # SHA1 hash length
 
     @async_test
     async def test_populate_queue_existing_items(self):
@@ -100,14 +129,167 @@ class TestS3WorkQueue(unittest.TestCase):
         existing_hash = WorkQueue._compute_workgroup_hash(existing_paths)
         existing_line = WorkQueue._encode_csv_row([existing_hash] + existing_paths)
 
-        with patch("olmocr.work_queue.download_zstd_csv", return_value=[existing_line]):
-            with patch("olmocr.work_queue.upload_zstd_csv") as mock_upload:
-                await self.work_queue.populate_queue(existing_paths + new_paths, items_per_group=1)
+        # A workspace from before the index was sharded
+        legacy_path = f"s3://test-bucket/workspace/{LEGACY_INDEX}"
+        store = {legacy_path: [existing_line]}
+        with self.index_store(store):
+            await self.work_queue.populate_queue(existing_paths + new_paths, items_per_group=1)
 
-                # Verify upload called with both existing and new items
-                _, _, lines = mock_upload.call_args[0]
-                self.assertEqual(len(lines), 2)
-                self.assertIn(existing_line, lines)
+        # The legacy index is kept as is and listed in the manifest as a shard, alongside the shard with the new item
+        lines = self.index_lines(store)
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(store[legacy_path], [existing_line])
+        manifest = [WorkQueue._decode_csv_row(line) for line in store[f"s3://test-bucket/workspace/{INDEX_MANIFEST}"]]
+        self.assertEqual(manifest[0], [LEGACY_INDEX, "1"])
+        self.assertEqual(len(manifest), 2)
+
+    @async_test
+    async def test_populate_queue_appends_shards(self):
+        """Test that adding paths writes new shards and the manifest, without rewriting existing shards"""
+        store = {}
+        with self.index_store(store):
+            await self.work_queue.populate_queue(self.sample_paths, items_per_group=1)
+            before = dict(store)
+
+            new_paths = [f"s3://test-bucket/data/new{i}.pdf" for i in range(3)]
+            with patch.object(self.backend, "save_index_lines", wraps=self.backend.save_index_lines) as mock_save:
+                await self.work_queue.populate_queue(self.sample_paths + new_paths, items_per_group=1)
+
+        saved_names = [call[0][1] for call in mock_save.call_args_list]
+        self.assertEqual(saved_names[-1], INDEX_MANIFEST)
+        self.assertFalse(any(f"s3://test-bucket/workspace/{name}" in before for name in saved_names[:-1]))
+        for path, lines in before.items():
+            if not path.endswith(INDEX_MANIFEST):
+                self.assertEqual(store[path], lines)
+
+        paths = sorted(p for line in self.index_lines(store) for p in WorkQueue._decode_index_row(line).work_paths)
+        self.assertEqual(paths, sorted(self.sample_paths + new_paths))
+
+    @async_test
+    async def test_dedupe_by_content_keeps_canonical_paths(self):
+        """Test that one path per content hash is kept, across calls, with the others recorded as its duplicates"""
+        store = {}
+        with self.index_store(store):
+            canonical, late_duplicates = await self.work_queue.dedupe_by_content(
+                {
+                    "s3://test-bucket/data/b.pdf": "etag:1",
+                    "s3://test-bucket/data/a.pdf": "etag:1",
+                    "s3://test-bucket/data/c.pdf": "etag:2",
+                }
+            )
+            self.assertEqual(canonical, {"s3://test-bucket/data/a.pdf", "s3://test-bucket/data/c.pdf"})
+            self.assertEqual(late_duplicates, {})
+
+            # A later copy of a known document keeps the earlier canonical path, even if it sorts first
+            canonical, late_duplicates = await self.work_queue.dedupe_by_content(
+                {"s3://test-bucket/copies/a.pdf": "etag:1", "s3://test-bucket/data/b.pdf": "etag:1"}
+            )
+            self.assertEqual(canonical, {"s3://test-bucket/data/a.pdf"})
+            self.assertEqual(late_duplicates, {"s3://test-bucket/data/a.pdf": ["s3://test-bucket/copies/a.pdf"]})
+
+            duplicates = await self.work_queue.load_duplicates()
+
+        self.assertIn(f"s3://test-bucket/workspace/{DUPLICATES_INDEX}", store)
+        self.assertEqual(duplicates, {"s3://test-bucket/data/a.pdf": ["s3://test-bucket/data/b.pdf", "s3://test-bucket/copies/a.pdf"]})
+
+    @async_test
+    async def test_initialize_queue_loads_shards_lazily(self):
+        """Test that shards are only loaded once the queue runs dry, skipping completed items"""
+        store = {}
+        paths = [f"s3://test-bucket/data/doc{i}.pdf" for i in range(40)]
+        with self.index_store(store):
+            await self.work_queue.populate_queue(paths, items_per_group=1)
+        num_shards = len(store) - 1
+        self.assertGreater(num_shards, 1)
+
+        done_hash = WorkQueue._compute_workgroup_hash([paths[0]])
+        completed_items = {f"s3://test-bucket/workspace/done_flags/done_{done_hash}.flag": datetime.datetime.now(datetime.timezone.utc)}
+
+        with self.index_store(store) as mock_upload:
+            with patch("olmocr.work_queue.download_zstd_csv", side_effect=lambda client, path: list(store.get(path, []))) as mock_download:
+                with patch("olmocr.work_queue.list_s3_objects_parallel", return_value=completed_items):
+                    count = await self.work_queue.initialize_queue()
+
+                    # Only the manifest and a single shard are read up front, items of unread shards still count towards the size
+                    self.assertEqual(mock_download.call_count, 2)
+                    self.assertIn(count, (39, 40))
+
+                    self.s3_client.head_object.side_effect = ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+                    claimed = []
+                    while (work_item := await self.work_queue.get_work()) is not None:
+                        claimed.append(work_item.work_paths[0])
+
+                    self.assertEqual(mock_download.call_count, 1 + num_shards)
+            mock_upload.assert_not_called()
+
+        self.assertEqual(sorted(claimed), sorted(paths[1:]))
+        self.assertEqual(self.work_queue.size, 0)
+
+    @async_test
+    async def test_populate_queue_splits_long_documents(self):
+        """Test that documents over max_pages_per_item become one work item per page range"""
+        page_counts = {self.sample_paths[0]: 1200, self.sample_paths[1]: 10, self.sample_paths[2]: 500}
+
+        store = {}
+        with self.index_store(store):
+            await self.work_queue.populate_queue(self.sample_paths, items_per_group=10, page_counts=page_counts, max_pages_per_item=500)
+
+        lines = self.index_lines(store)
+        groups = [(item.work_paths, item.page_counts) for item in map(WorkQueue._decode_index_row, lines)]
+        self.assertIn(([make_page_range_path(self.sample_paths[0], 1, 500)], [500]), groups)
+        self.assertIn(([make_page_range_path(self.sample_paths[0], 501, 1000)], [500]), groups)
+        # The last shard runs to the end of the document, however many pages it turns out to have
+        self.assertIn(([make_page_range_path(self.sample_paths[0], 1001, None)], [200]), groups)
+        self.assertIn(([self.sample_paths[1], self.sample_paths[2]], [10, 500]), groups)
+        self.assertEqual(len(groups), 4)
+
+        # Adding the same documents again doesn't queue them a second time
+        with self.index_store(store) as mock_upload:
+            await self.work_queue.populate_queue(self.sample_paths, items_per_group=10, page_counts=page_counts, max_pages_per_item=500)
+            mock_upload.assert_not_called()
+
+    def test_parse_page_range_path(self):
+        """Test page range work paths round trip, and that other paths are left alone"""
+        self.assertEqual(parse_page_range_path(make_page_range_path("s3://bucket/a.pdf", 3, 9)), ("s3://bucket/a.pdf", (3, 9)))
+        self.assertEqual(parse_page_range_path(make_page_range_path("s3://bucket/a.pdf", 3, None)), ("s3://bucket/a.pdf", (3, None)))
+        self.assertEqual(parse_page_range_path("s3://bucket/a.pdf"), ("s3://bucket/a.pdf", None))
+        self.assertEqual(parse_page_range_path("s3://bucket/b.tar.gz::inner.pdf"), ("s3://bucket/b.tar.gz::inner.pdf", None))
+
+    @async_test
+    async def test_populate_queue_packs_by_page_count(self):
+        """Test that groups are bin-packed to about pages_per_group pages, and counts are kept through a reload"""
+        paths = [f"s3://test-bucket/data/doc{i}.pdf" for i in range(20)]
+        page_counts = {path: count for path, count in zip(paths, [400, 300, 250, 5, 5, 5, 5, 10, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100, 150, 220])}
+
+        store = {}
+        with self.index_store(store):
+            await self.work_queue.populate_queue(paths, items_per_group=5, page_counts=page_counts, pages_per_group=500)
+
+        lines = self.index_lines(store)
+        items = [WorkQueue._decode_index_row(line) for line in lines]
+        group_pages = sorted(sum(item.page_counts) for item in items)
+
+        self.assertEqual(sum(group_pages), sum(page_counts.values()))
+        self.assertEqual(len(items), 4)
+        self.assertLessEqual(group_pages[-1] - group_pages[0], 100)
+        for item in items:
+            self.assertEqual(item.page_counts, [page_counts[p] for p in item.work_paths])
+            self.assertEqual(item.hash, WorkQueue._compute_workgroup_hash(item.work_paths))
+
+        with self.index_store(store):
+            loaded = {work_hash: item.page_counts for work_hash, item in (await self.work_queue.load_all_items()).items()}
+        self.assertEqual(loaded, {item.hash: item.page_counts for item in items})
+
+    def test_pack_paths_with_unknown_counts(self):
+        """Test that paths without a page count are packed as average length documents"""
+        groups = pack_paths_by_pages(["a", "b", "c", "d"], {"a": 100, "b": 100}, pages_per_group=200)
+        self.assertEqual(sorted(sorted(g) for g in groups), [["a", "c"], ["b", "d"]])
+
+    def test_legacy_index_rows(self):
+        """Test that rows written before page counts were stored still decode"""
+        item = WorkQueue._decode_index_row(WorkQueue._encode_csv_row(["abc", "s3://bucket/a.pdf", "s3://bucket/b.pdf"]))
+        self.assertEqual(item, WorkItem(hash="abc", work_paths=["s3://bucket/a.pdf", "s3://bucket/b.pdf"]))
+        self.assertEqual(WorkQueue._decode_index_row(WorkQueue._encode_index_row(item)), item)
 
     @async_test
     async def test_initialize_queue(self):
@@ -117,10 +299,10 @@ class TestS3WorkQueue(unittest.TestCase):
         work_hash = WorkQueue._compute_workgroup_hash(work_paths)
         work_line = WorkQueue._encode_csv_row([work_hash] + work_paths)
 
-        completed_items = [f"s3://test-bucket/workspace/done_flags/done_{work_hash}.flag"]
+        completed_items = {f"s3://test-bucket/workspace/done_flags/done_{work_hash}.flag": datetime.datetime.now(datetime.timezone.utc)}
 
-        with patch("olmocr.work_queue.download_zstd_csv", return_value=[work_line]):
-            with patch("olmocr.work_queue.expand_s3_glob", return_value=completed_items):
+        with self.index_store({f"s3://test-bucket/workspace/{LEGACY_INDEX}": [work_line]}):
+            with patch("olmocr.work_queue.list_s3_objects_parallel", return_value=completed_items):
                 count = await self.work_queue.initialize_queue()
 
                 # Queue should be empty since all work is completed
@@ -200,6 +382,93 @@ class TestS3WorkQueue(unittest.TestCase):
         result = await self.work_queue.get_work()
         self.assertEqual(result, work_item)  # Should take work with stale lock
 
+    @async_test
+    async def test_renewed_lock_is_not_stale(self):
+        """Test locks record their holder, and heartbeats keep items claimed long ago from being taken over"""
+        work_item = WorkItem(hash="testhash123", work_paths=["s3://test/file1.pdf"])
+        work_queue = WorkQueue(self.backend, replica_id="replica-1")
+        await work_queue._queue.put(work_item)
+
+        self.s3_client.head_object.side_effect = ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+        self.assertEqual(await work_queue.get_work(), work_item)
+        lock_body = self.s3_client.put_object.call_args[1]["Body"]
+        self.s3_client.get_object.return_value = {"Body": io.BytesIO(lock_body), "ETag": '"etag-1"'}
+        self.assertTrue(await work_queue.renew_lock(work_item))
+
+        lock = json.loads(self.s3_client.put_object.call_args[1]["Body"])
+        self.assertEqual(lock["replica_id"], "replica-1")
+        self.assertEqual(self.s3_client.put_object.call_args[1]["IfMatch"], '"etag-1"')
+        self.assertEqual(self.s3_client.put_object.call_count, 2)
+
+        # The lock was last written by a heartbeat a minute ago, so it's taken no matter when the item was claimed
+        heartbeat_time = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=1)
+        self.s3_client.head_object.side_effect = None
+        self.s3_client.head_object.return_value = {"LastModified": heartbeat_time}
+        self.assertTrue(await self.backend.is_worker_lock_taken(work_item.hash, worker_lock_timeout_secs=600))
+
+    @async_test
+    async def test_lock_taken_over_by_another_replica_is_not_renewed(self):
+        """Test that a heartbeat doesn't overwrite the lock of a replica that took the item over after it went stale"""
+        work_item = WorkItem(hash="testhash123", work_paths=["s3://test/file1.pdf"])
+        work_queue = WorkQueue(self.backend, replica_id="replica-1")
+
+        self.s3_client.get_object.return_value = {"Body": io.BytesIO(json.dumps({"replica_id": "replica-2"}).encode()), "ETag": '"etag-2"'}
+        self.assertFalse(await work_queue.renew_lock(work_item))
+        self.s3_client.put_object.assert_not_called()
+
+        # A lock that's gone, ex. deleted by hand, gets recreated unless someone else creates it first
+        self.s3_client.get_object.return_value = None
+        self.s3_client.get_object.side_effect = ClientError({"Error": {"Code": "NoSuchKey", "Message": "Not Found"}}, "GetObject")
+        self.assertTrue(await work_queue.renew_lock(work_item))
+        self.s3_client.put_object.assert_called_once()
+        self.assertEqual(self.s3_client.put_object.call_args[1]["IfNoneMatch"], "*")
+
+    @async_test
+    async def test_takeover_between_read_and_renewal_wins(self):
+        """Test that a heartbeat which read its own lock doesn't overwrite a replica that took the item over right after"""
+        work_item = WorkItem(hash="testhash123", work_paths=["s3://test/file1.pdf"])
+        work_queue = WorkQueue(self.backend, replica_id="replica-1")
+
+        # The lock still names replica-1 when read, but has a new ETag by the time of the conditional put
+        self.s3_client.get_object.return_value = {"Body": io.BytesIO(json.dumps({"replica_id": "replica-1"}).encode()), "ETag": '"etag-1"'}
+        self.s3_client.put_object.side_effect = ClientError(
+            {"Error": {"Code": "PreconditionFailed", "Message": "At least one precondition failed"}}, "PutObject"
+        )
+        self.assertFalse(await work_queue.renew_lock(work_item))
+        self.assertEqual(self.s3_client.put_object.call_args[1]["IfMatch"], '"etag-1"')
+
+    @async_test
+    async def test_get_work_uses_snapshot(self):
+        """Test that done and locked items are skipped without any requests, and only the claimed item is confirmed"""
+        done_item, locked_item, free_item = (WorkItem(hash=h, work_paths=[f"s3://test/{h}.pdf"]) for h in ("aa11", "bb22", "cc33"))
+        now = datetime.datetime.now(datetime.timezone.utc)
+        listed = {
+            f"s3://test-bucket/workspace/done_flags/done_{done_item.hash}.flag": now,
+            f"s3://test-bucket/workspace/worker_locks/worker_{locked_item.hash}.lock": now,
+        }
+
+        with patch("olmocr.work_queue.list_s3_objects_parallel", return_value=listed) as mock_list:
+            await self.work_queue.refresh_snapshot()
+
+        # One listing of done flags and one of locks, each split by the first hex digit of the hash
+        prefixes = sorted(call[0][1] for call in mock_list.call_args_list)
+        self.assertEqual(prefixes, ["s3://test-bucket/workspace/done_flags/done_", "s3://test-bucket/workspace/worker_locks/worker_"])
+
+        for item in (done_item, locked_item, free_item):
+            await self.work_queue._queue.put(item)
+
+        self.s3_client.head_object.side_effect = ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+        result = await self.work_queue.get_work()
+
+        self.assertEqual(result, free_item)
+        self.assertEqual(self.s3_client.head_object.call_count, 2)
+        checked_keys = {call[1]["Key"] for call in self.s3_client.head_object.call_args_list}
+        self.assertEqual(checked_keys, {f"workspace/done_flags/done_{free_item.hash}.flag", f"workspace/worker_locks/worker_{free_item.hash}.lock"})
+
+        # Items finished by this worker go straight into the snapshot
+        await self.work_queue.mark_done(result)
+        self.assertIn(free_item.hash, self.work_queue._completed_hash_cache)
+
     @async_test
     async def test_mark_done(self):
         """Test marking work as done"""
@@ -226,40 +495,36 @@ class TestS3WorkQueue(unittest.TestCase):
         # Create paths with commas in them
         paths_with_commas = ["s3://test-bucket/data/file1,with,commas.pdf", "s3://test-bucket/data/file2,comma.pdf", "s3://test-bucket/data/file3.pdf"]
 
-        # Mock empty existing index for initial population
-        with patch("olmocr.work_queue.download_zstd_csv", return_value=[]):
-            with patch("olmocr.work_queue.upload_zstd_csv") as mock_upload:
-                # Populate the queue with these paths
-                await self.work_queue.populate_queue(paths_with_commas, items_per_group=3)
-
-                # Capture what would be written to the index
-                _, _, lines = mock_upload.call_args[0]
+        # Start from an empty index
+        store = {}
+        with self.index_store(store):
+            # Populate the queue with these paths
+            await self.work_queue.populate_queue(paths_with_commas, items_per_group=3)
 
-                # Now simulate reading back these lines (which have commas in the paths)
-                with patch("olmocr.work_queue.download_zstd_csv", return_value=lines):
-                    with patch("olmocr.work_queue.expand_s3_glob", return_value=[]):
-                        # Initialize a fresh queue from these lines
-                        await self.work_queue.initialize_queue()
+            # Now read back what was written to the index (which has commas in the paths)
+            with patch("olmocr.work_queue.list_s3_objects_parallel", return_value={}):
+                # Initialize a fresh queue from these lines
+                await self.work_queue.initialize_queue()
 
-                        # Mock ClientError for head_object (file doesn't exist) - need to handle multiple calls
-                        self.s3_client.head_object.side_effect = [
-                            ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject"),  # done flag check
-                            ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject"),  # worker lock check
-                        ]
+                # Mock ClientError for head_object (file doesn't exist) - need to handle multiple calls
+                self.s3_client.head_object.side_effect = [
+                    ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject"),  # done flag check
+                    ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject"),  # worker lock check
+                ]
 
-                        # Get a work item
-                        work_item = await self.work_queue.get_work()
+                # Get a work item
+                work_item = await self.work_queue.get_work()
 
-                        # Now verify we get a work item
-                        self.assertIsNotNone(work_item, "Should get a work item")
+                # Now verify we get a work item
+                self.assertIsNotNone(work_item, "Should get a work item")
 
-                        # Verify the work item has the correct number of paths
-                        self.assertEqual(len(work_item.work_paths), len(paths_with_commas), "Work item should have the correct number of paths")
+                # Verify the work item has the correct number of paths
+                self.assertEqual(len(work_item.work_paths), len(paths_with_commas), "Work item should have the correct number of paths")
 
-                        # Check that all original paths with commas are preserved
-                        for path in paths_with_commas:
-                            print(path)
-                            self.assertIn(path, work_item.work_paths, f"Path with commas should be preserved: {path}")
+                # Check that all original paths with commas are preserved
+                for path in paths_with_commas:
+                    print(path)
+                    self.assertIn(path, work_item.work_paths, f"Path with commas should be preserved: {path}")
 
     def test_queue_size(self):
         """Test queue size property"""